@@ -0,0 +1,48 @@
+import gc
+import sys
+from time import ticks_us, ticks_diff
+# Import the modules the library uses first, so they aren't counted against it
+import bluetooth
+import micropython
+import struct
+import array
+import errno
+import random
+
+# Each role, and the names it imports from the library
+ROLES = (
+    ("package only", ()),
+    ("advertising", ("advertising_payload",)),
+    ("peripheral", ("BLEPeripheral",)),
+    ("central", ("BLECentral",)),
+    ("peripheral with stats", ("BLEPeripheral", "BLEStats")),
+    ("central with stats", ("BLECentral", "BLEStats")),
+    ("multiple peripherals", ("BLEMultiCentral",)),
+    ("broadcast", ("BLEBroadcaster",)),
+    ("everything", ("BLEPeripheral", "BLECentral", "BLEMultiCentral", "BLEBroadcaster", "BLEStats", "TraceRecorder", "ClockSync", "L2CAPChannel")),
+)
+
+# Forget every part of the library imported so far
+def unload():
+    for name in list(sys.modules):
+        if name.startswith("KitronikPicoWBluetooth"):
+            del sys.modules[name]
+    gc.collect()
+
+# Import the library and then each name given, returns (time in us, bytes of RAM used)
+def measure(names):
+    unload()
+    free = gc.mem_free()
+    start = ticks_us()
+    import KitronikPicoWBluetooth
+    for name in names:
+        getattr(KitronikPicoWBluetooth, name)
+    elapsed = ticks_diff(ticks_us(), start)
+    gc.collect()
+    return elapsed, free - gc.mem_free()
+
+print("Role                     Import time    RAM used")
+for role, names in ROLES:
+    elapsed, used = measure(names)
+    print("%-22s %9d us %7d bytes" % (role, elapsed, used))
+unload()
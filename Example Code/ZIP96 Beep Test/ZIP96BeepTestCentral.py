@@ -1,7 +1,7 @@
 from bluetooth import BLE
-from time import sleep_ms, ticks_ms
+from time import sleep_ms, ticks_ms, ticks_us
 from ZIP96Pico import *
-from KitronikPicoWBluetooth import BLECentral
+from KitronikPicoWBluetooth import BLECentral, STAMP_SIZE
 from random import randint
 
 # Setup the gamer and screen variables
@@ -47,10 +47,12 @@ screen.show()
 
 # Set notify callback, to process a notify event
 def notifyCallback(value):
-    global received
+    global received, receivedUs
     received = bytes(value)
+    receivedUs = ticks_us()
 
 received = None
+receivedUs = 0
 central.notifyCallback = notifyCallback
 start = 0
 
@@ -70,6 +72,9 @@ while central.readCallback is not None:
 screen.fill((0, 100, 0))
 screen.show()
 
+# Share a clock with the peripheral, so each side can time the other's messages one way
+clock = central.syncClock()
+
 # Loop while still connected to peripheral
 while central.isConnected():
     if gamer.Up.pressed():
@@ -91,8 +96,10 @@ while central.isConnected():
     if gamer.A.pressed():
         start = ticks_ms()
         tone = randint(3, 30)
-        # Write position to peripheral service charactistic
-        central.write(bytes([playerX, playerY, tone]))
+        # Write position to peripheral service charactistic with the time it was sent
+        message = bytearray([playerX, playerY, tone] + [0] * STAMP_SIZE)
+        clock.stamp(message, 3)
+        central.write(message)
         gamer.Buzzer.playTone_Length(tone * 100, 50)
     
     screen.fill(screen.BLACK)
@@ -109,9 +116,13 @@ while central.isConnected():
             print("Full time (ms):", end - start)
             print("Half time (ms):", (end - start) / 2)
         else:
+            if len(config) == 3 + STAMP_SIZE and clock.synced:
+                print("One way time (ms):", clock.latency(config, 3, receivedUs) / 1000)
             screen.setLEDMatrix(config[0], config[1], screen.CYAN)
             screen.show()
             gamer.Buzzer.playTone_Length(config[2] * 100, 50)
             central.write(bytes([config[2]]))
     
+    # Send clock sync requests
+    central.poll()
     sleep_ms(125)
@@ -1,7 +1,7 @@
 from bluetooth import BLE
-from time import sleep_ms, ticks_ms
+from time import sleep_ms, ticks_ms, ticks_us
 from ZIP96Pico import *
-from KitronikPicoWBluetooth import BLEPeripheral
+from KitronikPicoWBluetooth import BLEPeripheral, STAMP_SIZE
 from random import randint
 
 # Setup the gamer and screen variables
@@ -31,10 +31,12 @@ screen.show()
 
 # Set write callback, to process a write event
 def writeCallback(value):
-    global received
+    global received, receivedUs
     received = bytes(value)
+    receivedUs = ticks_us()
 
 received = None
+receivedUs = 0
 peripheral.writeCallback = writeCallback
 start = 0
 
@@ -52,6 +54,9 @@ while peripheral.readCallback is not None:
 screen.fill((0, 100, 0))
 screen.show()
 
+# Share a clock with the central, so each side can time the other's messages one way
+clock = peripheral.syncClock()
+
 # Loop while central still connected
 while peripheral.isConnected():
     if gamer.Up.pressed():
@@ -73,8 +78,10 @@ while peripheral.isConnected():
     if gamer.A.pressed():
         start = ticks_ms()
         tone = randint(3, 30)
-        # Notify central of updated position using service charactistic
-        peripheral.notify(bytes([playerX, playerY, tone]))
+        # Notify central of updated position using service charactistic with the time it was sent
+        message = bytearray([playerX, playerY, tone] + [0] * STAMP_SIZE)
+        clock.stamp(message, 3)
+        peripheral.notify(message)
         gamer.Buzzer.playTone_Length(tone * 100, 50)
     
     screen.fill(screen.BLACK)
@@ -91,6 +98,8 @@ while peripheral.isConnected():
             print("Full time (ms):", end - start)
             print("Half time (ms):", (end - start) / 2)
         else:
+            if len(config) == 3 + STAMP_SIZE and clock.synced:
+                print("One way time (ms):", clock.latency(config, 3, receivedUs) / 1000)
             screen.setLEDMatrix(config[0], config[1], screen.CYAN)
             screen.show()
             gamer.Buzzer.playTone_Length(config[2] * 100, 50)
@@ -0,0 +1,424 @@
+'''
+This code was written and modified by Kitronik Ltd.
+
+Benchmarks for the KitronikPicoWBluetooth library, run on a computer against
+the simulated bluetooth module in blesim.py:
+
+    python3 "Host Tools/benchmark.py"
+
+Times are in virtual time, so they show how the library and the connection
+settings affect a real link and are the same on every run. Allocations are
+measured with tracemalloc around calls to the library's interrupt handlers.
+The cost of dispatching each event is CPU time on this computer, so compare
+its columns with each other rather than with a Pico W.
+'''
+
+import os
+import sys
+import time
+import tracemalloc
+
+# The library lives in the folder above this one
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from blesim import air
+import bluetooth
+from time import ticks_ms, ticks_us, ticks_diff, sleep_ms
+from KitronikPicoWBluetooth import BLEPeripheral, BLECentral, advertising_payload, MES_SERVICE_UUID, SCAN_BEST, STAMP_SIZE
+
+# Start a peripheral and a central on a fresh radio and connect them
+def connected_pair(mtu=247, **radio):
+    air.reset(**radio)
+    peripheral = BLEPeripheral(bluetooth.BLE(), mtu=mtu)
+    central = BLECentral(bluetooth.BLE(), mtu=mtu)
+    central.scan(lambda addr_type, addr, name: central.connect())
+    if not air.wait(central.isConnected):
+        raise RuntimeError("Simulated connection failed")
+    # Let the MTU exchange finish
+    sleep_ms(100)
+    return peripheral, central
+
+'''
+Notify throughput
+'''
+
+# Notify as fast as the stack accepts values for duration_ms, returns bytes per second received
+def notify_throughput(conn_interval_us, mtu, duration_ms=2000):
+    peripheral, central = connected_pair(mtu, conn_interval_us=conn_interval_us)
+    size = peripheral.payloadSize()
+    value = bytes(size)
+    received = [0]
+
+    def onNotify(data):
+        received[0] += len(data)
+
+    central.notifyCallback = onNotify
+    start = ticks_ms()
+    while ticks_diff(ticks_ms(), start) < duration_ms:
+        if not peripheral.notify(value):
+            # The stack is full, wait for the next connection event
+            sleep_ms(1)
+
+    return received[0] * 1000 // duration_ms, size
+
+'''
+L2CAP stream throughput
+'''
+
+# Stream from the peripheral to the central over an L2CAP channel for duration_ms, with the central
+# reading whatever has arrived every millisecond. Returns bytes per second received
+def l2cap_throughput(conn_interval_us, duration_ms=2000):
+    peripheral, central = connected_pair(conn_interval_us=conn_interval_us)
+    sender = peripheral.openStream()
+    receiver = central.openStream()
+    if not air.wait(receiver.isOpen):
+        raise RuntimeError("Simulated L2CAP channel failed")
+
+    value = bytes(4096)
+    buffer = bytearray(receiver.mtu)
+    received = 0
+    start = ticks_ms()
+    while ticks_diff(ticks_ms(), start) < duration_ms:
+        sender.write(value)
+        received += receiver.readinto(buffer)
+        sleep_ms(1)
+
+    return received * 1000 // duration_ms
+
+'''
+Write round trip
+'''
+
+# Time from central.write to the peripheral's echo arriving as a notification, as the ZIP96 Beep Test
+# "Full time" measures it. Returns (min, mean, max) in milliseconds
+def write_round_trip(conn_interval_us, count=50):
+    peripheral, central = connected_pair(conn_interval_us=conn_interval_us)
+    peripheral.writeCallback = peripheral.notify
+    echoed = [False]
+
+    def onNotify(data):
+        echoed[0] = True
+
+    central.notifyCallback = onNotify
+    times = []
+    for i in range(count):
+        echoed[0] = False
+        start = ticks_us()
+        central.write(bytes([i]))
+        air.wait(lambda: echoed[0], step_us=100)
+        times.append(ticks_diff(ticks_us(), start) / 1000)
+        # Start the next write part way through a connection interval
+        sleep_ms(7)
+
+    return min(times), sum(times) / count, max(times)
+
+'''
+One-way latency
+'''
+
+# One-way latency of frames stamped with the shared clock from syncClock, from the central's writes to the
+# peripheral and from the peripheral's notifications to the central. Returns (error, to_peripheral, to_central),
+# with the most the synced clock can be out by and each direction's (mean, jitter) in milliseconds
+def one_way_latency(conn_interval_us, count=50):
+    peripheral, central = connected_pair(conn_interval_us=conn_interval_us)
+    peripheral_clock = peripheral.syncClock()
+    central_clock = central.syncClock()
+    while central_clock.count < central_clock.capacity:
+        central.poll()
+        sleep_ms(1)
+
+    def onWrite(data):
+        peripheral_clock.latency(data)
+
+    def onNotify(data):
+        central_clock.latency(data)
+
+    peripheral.writeCallback = onWrite
+    central.notifyCallback = onNotify
+    frame = bytearray(STAMP_SIZE)
+    for i in range(count):
+        central_clock.stamp(frame)
+        central.write(frame)
+        sleep_ms(3)
+        peripheral_clock.stamp(frame)
+        peripheral.notify(frame)
+        # Send the next frames part way through a connection interval
+        sleep_ms(7)
+    sleep_ms(200)
+
+    return (central_clock.error / 1000,
+            (peripheral_clock.meanLatency() / 1000, peripheral_clock.jitter / 1000),
+            (central_clock.meanLatency() / 1000, central_clock.jitter / 1000))
+
+'''
+Scan to connected
+'''
+
+# Time from central.scan to the connect callback, split into the scan, the wait for the link to come up,
+# and discovery. Returns a (scan, link, discovery) tuple in milliseconds for the first connection and for
+# a reconnection using the discovery cache
+def scan_to_connected(conn_interval_us):
+    air.reset(conn_interval_us=conn_interval_us)
+    BLEPeripheral(bluetooth.BLE())
+    central = BLECentral(bluetooth.BLE())
+    central.cacheDiscovery()
+    times = []
+
+    def onEvent(device, event, data):
+        # Note when _IRQ_PERIPHERAL_CONNECT reaches the central
+        if device is central._ble and event == 7:
+            marks.append(ticks_ms())
+
+    air.irq_hook = onEvent
+    for attempt in range(2):
+        marks = []
+
+        def onConnect():
+            marks.append(ticks_ms())
+
+        def onScan(addr_type, addr, name):
+            marks.append(ticks_ms())
+            central.connect(callback=onConnect)
+
+        start = ticks_ms()
+        central.scan(onScan)
+        if not air.wait(lambda: len(marks) == 3):
+            raise RuntimeError("Simulated connection failed")
+        times.append((ticks_diff(marks[0], start), ticks_diff(marks[1], marks[0]), ticks_diff(marks[2], marks[1])))
+
+        central.disconnect()
+        sleep_ms(200)
+
+    air.irq_hook = None
+    return times
+
+'''
+Allocations per event
+'''
+
+# Bytes allocated while handling one event, the most seen over count calls
+def _allocated(handler, event, data, count):
+    # Warm up so anything created once isn't counted
+    handler(event, data)
+    tracemalloc.start()
+    most = 0
+    for _ in range(count):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        handler(event, data)
+        most = max(most, tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+    return most
+
+# CPython allocates another block for its stack of frames when a call goes past the end of the current one,
+# so measure at two stack depths and keep the lower result, which is only what the handler allocates
+def allocated(handler, event, data, count=100):
+    def nested():
+        return _allocated(handler, event, data, count)
+    return min(_allocated(handler, event, data, count), nested())
+
+def allocations_per_event():
+    peripheral, central = connected_pair()
+    results = []
+
+    # Scan results from a device we aren't looking for, and repeated results from one we are
+    other = advertising_payload(name="other", services=[bluetooth.UUID(0x180F)])
+    ours = advertising_payload(name="mpy-peripheral", services=[MES_SERVICE_UUID])
+    addr = memoryview(bytes(6))
+    central.scan(None, mode=SCAN_BEST)
+    central.stopScan()
+    air.run(1000)
+    results.append(("central scan result (other)", allocated(central._irq, 5, (0, addr, 0, -50, memoryview(other)))))
+    results.append(("central scan result (ours)", allocated(central._irq, 5, (0, addr, 0, -50, memoryview(ours)))))
+
+    # Notifications with a callback that only looks at the value
+    value = memoryview(bytes(20))
+    central.notifyCallback = len
+    conn_handle = central._conn_handle
+    value_handle = central._value_handle
+    results.append(("central notify", allocated(central._irq, 18, (conn_handle, value_handle, value))))
+
+    # 20 byte writes on the peripheral, straight to writeCallback and through the write buffer
+    peripheral._ble.gatts_write(peripheral._handle, bytes(20))
+    peripheral.writeCallback = len
+    peripheral_conn = next(iter(peripheral._connections))
+    results.append(("peripheral write", allocated(peripheral._irq, 3, (peripheral_conn, peripheral._handle))))
+    peripheral.bufferWrites(scheduled=False)
+
+    def bufferedWrite(event, data):
+        peripheral._irq(event, data)
+        peripheral.poll()
+
+    # Go round every slot once, so the memoryview each slot keeps for the value's length has been made
+    for _ in range(len(peripheral.writeBuffer.lengths)):
+        bufferedWrite(3, (peripheral_conn, peripheral._handle))
+    results.append(("peripheral buffered write", allocated(bufferedWrite, 3, (peripheral_conn, peripheral._handle))))
+
+    # Emptying the write buffer on its own, each value put in before tracing starts
+    value = bytes(20)
+    most = 0
+    tracemalloc.start()
+    for _ in range(100):
+        peripheral.writeBuffer.put(peripheral_conn, peripheral._handle, value)
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        peripheral.poll()
+        most = max(most, tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+    results.append(("peripheral buffered drain", most))
+    return results
+
+'''
+Dispatch cost per event
+'''
+
+# Mean ns for each handler to handle one event, the best of repeats runs of count events.
+# The handlers take turns, so a busy moment on this computer doesn't only slow one of them
+def _handler_ns(handlers, device, event, data, count, repeats):
+    best = [None] * len(handlers)
+    for _ in range(repeats):
+        for i, handler in enumerate(handlers):
+            start = time.perf_counter_ns()
+            for _ in range(count):
+                handler(device, event, data)
+            elapsed = time.perf_counter_ns() - start
+            best[i] = elapsed if best[i] is None else min(best[i], elapsed)
+    return [ns / count for ns in best]
+
+# The if/elif chains the interrupt handlers used before the dispatch table, testing each event against
+# the event numbers in the same order they did, then calling the library's handler for it
+def _central_chain(central, event, data):
+    if event == 5:
+        return central._on_scan_result(event, data)
+    elif event == 6:
+        return central._on_scan_done(event, data)
+    elif event == 7:
+        return central._on_connect(event, data)
+    elif event == 8:
+        return central._on_disconnect(event, data)
+    elif event == 9:
+        return central._on_service_result(event, data)
+    elif event == 10:
+        return central._on_service_done(event, data)
+    elif event == 11:
+        return central._on_characteristic_result(event, data)
+    elif event == 12:
+        return central._on_characteristic_done(event, data)
+    elif event == 15:
+        return central._on_read_result(event, data)
+    elif event == 16:
+        return central._on_read_done(event, data)
+    elif event == 17:
+        return central._on_write_done(event, data)
+    elif event == 18:
+        return central._on_notify(event, data)
+    elif event == 19:
+        return central._on_indicate(event, data)
+    elif event == 21:
+        return central._on_mtu_exchanged(event, data)
+    elif event == 27:
+        return central._on_connection_update(event, data)
+
+def _peripheral_chain(peripheral, event, data):
+    if event == 1:
+        return peripheral._on_connect(event, data)
+    elif event == 2:
+        return peripheral._on_disconnect(event, data)
+    elif event == 3:
+        return peripheral._on_write(event, data)
+    elif event == 4:
+        return peripheral._on_read_request(event, data)
+    elif event == 20:
+        return peripheral._on_indicate_done(event, data)
+    elif event == 21:
+        return peripheral._on_mtu_exchanged(event, data)
+    elif event == 27:
+        return peripheral._on_connection_update(event, data)
+
+# Time an if/elif chain and the library's _irq on the same connected peripheral and central, with events
+# that leave the connection as it was. Both call the same handlers, so the difference is the dispatch.
+# Returns (name, ns with the chain, ns with _irq) for each event
+def dispatch_cost(count=2000, repeats=50):
+    peripheral, central = connected_pair()
+    other = memoryview(advertising_payload(name="other", services=[bluetooth.UUID(0x180F)]))
+    ours = memoryview(advertising_payload(name="mpy-peripheral", services=[MES_SERVICE_UUID]))
+    addr = memoryview(bytes(6))
+    central.scan(None, mode=SCAN_BEST)
+    central.stopScan()
+    air.run(1000)
+
+    value = memoryview(bytes(20))
+    central.notifyCallback = len
+    central.indicateCallback = len
+    central.readCallback = len
+    conn_handle = central._conn_handle
+    value_handle = central._value_handle
+    peripheral.writeCallback = len
+    peripheral._ble.gatts_write(peripheral._handle, bytes(20))
+    peripheral_conn = next(iter(peripheral._connections))
+
+    events = (
+        ("central scan result (other)", _central_chain, central, 5, (0, addr, 0, -50, other)),
+        ("central scan result (ours)", _central_chain, central, 5, (0, addr, 0, -50, ours)),
+        ("central scan done", _central_chain, central, 6, ()),
+        ("central read result", _central_chain, central, 15, (conn_handle, value_handle, value)),
+        ("central read done", _central_chain, central, 16, (conn_handle, value_handle, 0)),
+        ("central write done", _central_chain, central, 17, (conn_handle, value_handle, 0)),
+        ("central notify", _central_chain, central, 18, (conn_handle, value_handle, value)),
+        ("central indicate", _central_chain, central, 19, (conn_handle, value_handle, value)),
+        ("central MTU exchanged", _central_chain, central, 21, (conn_handle, 247)),
+        ("central connection update", _central_chain, central, 27, (conn_handle, 6, 0, 400, 0)),
+        ("peripheral write", _peripheral_chain, peripheral, 3, (peripheral_conn, peripheral._handle)),
+        ("peripheral read request", _peripheral_chain, peripheral, 4, (peripheral_conn, peripheral._handle)),
+        ("peripheral indicate done", _peripheral_chain, peripheral, 20, (peripheral_conn, peripheral._handle, 0)),
+        ("peripheral MTU exchanged", _peripheral_chain, peripheral, 21, (peripheral_conn, 247)),
+        ("peripheral connection update", _peripheral_chain, peripheral, 27, (peripheral_conn, 6, 0, 400, 0)),
+    )
+
+    results = []
+    for name, chain, device, event, data in events:
+        before, now = _handler_ns((chain, type(device)._irq), device, event, data, count, repeats)
+        results.append((name, before, now))
+    return results
+
+'''
+Report
+'''
+
+def main():
+    print("Notify throughput")
+    for conn_interval_us in (7500, 30000):
+        for mtu in (23, 247):
+            rate, size = notify_throughput(conn_interval_us, mtu)
+            print("  interval %5.1f ms  payload %3d bytes  %7d bytes/s" % (conn_interval_us / 1000, size, rate))
+
+    print("L2CAP stream throughput")
+    for conn_interval_us in (7500, 30000):
+        print("  interval %5.1f ms  %7d bytes/s" % (conn_interval_us / 1000, l2cap_throughput(conn_interval_us)))
+
+    print("Write round trip")
+    for conn_interval_us in (7500, 30000):
+        low, mean, high = write_round_trip(conn_interval_us)
+        print("  interval %5.1f ms  min %6.1f ms  mean %6.1f ms  max %6.1f ms" % (conn_interval_us / 1000, low, mean, high))
+
+    print("One-way latency")
+    for conn_interval_us in (7500, 30000):
+        error, to_peripheral, to_central = one_way_latency(conn_interval_us)
+        print("  interval %5.1f ms  sync error %5.1f ms  to peripheral %6.1f ms (jitter %5.1f)  to central %6.1f ms (jitter %5.1f)" %
+              (conn_interval_us / 1000, error, to_peripheral[0], to_peripheral[1], to_central[0], to_central[1]))
+
+    print("Scan to connected")
+    for conn_interval_us in (7500, 30000):
+        first, cached = scan_to_connected(conn_interval_us)
+        print("  interval %5.1f ms  scan %4d ms  link %4d ms  discovery %4d ms  cached discovery %4d ms" % (conn_interval_us / 1000, first[0], first[1], first[2], cached[2]))
+
+    print("Allocations per event")
+    for name, size in allocations_per_event():
+        print("  %-28s %5d bytes" % (name, size))
+
+    print("Dispatch cost per event")
+    for name, chain, table in dispatch_cost():
+        print("  %-28s if/elif chain %7.1f ns  dispatch table %7.1f ns" % (name, chain, table))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,856 @@
+'''
+This code was written and modified by Kitronik Ltd.
+
+Host-side simulation of the MicroPython bluetooth module, for running and
+benchmarking the KitronikPicoWBluetooth library on a computer with CPython.
+
+Every BLE() created in the same Python process shares one simulated radio
+(`air`), so a BLEPeripheral and a BLECentral can talk to each other without
+any hardware. Time is virtual: nothing happens on the radio until the clock is
+advanced with air.run(), sleep_ms() or air.wait(), which also makes every run
+reproducible. air.reset() sets the connection interval, packet loss, latency
+and how many packets the stack can hold before reporting ENOMEM.
+
+The MicroPython only parts of the time module (ticks_ms, ticks_us, ticks_diff,
+ticks_add, sleep_ms, sleep_us) are installed onto CPython's time module and
+read the virtual clock.
+'''
+
+import heapq
+import random
+import time as _time
+
+_TICKS_PERIOD = 1 << 30
+_TICKS_MAX = _TICKS_PERIOD - 1
+_TICKS_HALF = _TICKS_PERIOD // 2
+
+# Same values as MicroPython's bluetooth module
+FLAG_BROADCAST = 0x0001
+FLAG_READ = 0x0002
+FLAG_WRITE_NO_RESPONSE = 0x0004
+FLAG_WRITE = 0x0008
+FLAG_NOTIFY = 0x0010
+FLAG_INDICATE = 0x0020
+
+_IRQ_CENTRAL_CONNECT = 1
+_IRQ_CENTRAL_DISCONNECT = 2
+_IRQ_GATTS_WRITE = 3
+_IRQ_GATTS_READ_REQUEST = 4
+_IRQ_SCAN_RESULT = 5
+_IRQ_SCAN_DONE = 6
+_IRQ_PERIPHERAL_CONNECT = 7
+_IRQ_PERIPHERAL_DISCONNECT = 8
+_IRQ_GATTC_SERVICE_RESULT = 9
+_IRQ_GATTC_SERVICE_DONE = 10
+_IRQ_GATTC_CHARACTERISTIC_RESULT = 11
+_IRQ_GATTC_CHARACTERISTIC_DONE = 12
+_IRQ_GATTC_READ_RESULT = 15
+_IRQ_GATTC_READ_DONE = 16
+_IRQ_GATTC_WRITE_DONE = 17
+_IRQ_GATTC_NOTIFY = 18
+_IRQ_GATTC_INDICATE = 19
+_IRQ_GATTS_INDICATE_DONE = 20
+_IRQ_MTU_EXCHANGED = 21
+_IRQ_L2CAP_ACCEPT = 22
+_IRQ_L2CAP_CONNECT = 23
+_IRQ_L2CAP_DISCONNECT = 24
+_IRQ_L2CAP_RECV = 25
+_IRQ_L2CAP_SEND_READY = 26
+_IRQ_CONNECTION_UPDATE = 27
+
+_ADV_IND = 0x00
+_ADV_NONCONN_IND = 0x03
+_ADV_SCAN_RSP = 0x04
+
+_ATT_ERROR_INVALID_HANDLE = 0x01
+_ATT_ERROR_READ_NOT_PERMITTED = 0x02
+
+_EALREADY = 114
+_ENOMEM = 12
+_ENOTCONN = 107
+
+_DEFAULT_ATTR_LEN = 20
+_DEFAULT_MTU = 23
+_CCCD_UUID = 0x2902
+
+# Largest L2CAP PDU, one link layer packet, and how many MTUs of unread data a channel buffers
+_L2CAP_MPS = 247
+_L2CAP_RX_SDUS = 3
+_L2CAP_PSM_NOT_SUPPORTED = 0x0002
+
+'''
+Virtual clock and radio
+'''
+
+class Air:
+    def __init__(self):
+        self.reset()
+
+    # Clear every device and event, and set the radio conditions for the next run
+    #   conn_interval_us  default connection interval when gap_connect does not ask for one
+    #   latency_us        extra air/controller latency added to every packet
+    #   loss              probability that a packet is lost and retried at the next connection event
+    #   packets_per_event packets each direction may send in one connection event
+    #   tx_buffers        packets a device may have queued on a link before the stack reports ENOMEM
+    #   rssi              default signal strength of new devices
+    def reset(self, conn_interval_us=30000, latency_us=0, loss=0.0, packets_per_event=4, tx_buffers=8, rssi=-60, seed=1):
+        self.now_us = 0
+        self.conn_interval_us = conn_interval_us
+        self.latency_us = latency_us
+        self.loss = loss
+        self.packets_per_event = packets_per_event
+        self.tx_buffers = tx_buffers
+        self.rssi = rssi
+        self.random = random.Random(seed)
+        self.devices = []
+        self.links = []
+        self._events = []
+        self._seq = 0
+        self._scheduled = []
+        self.schedule_depth = 8
+        self.irq_count = 0
+        self.irq_hook = None
+
+    # Run fn(*args) after delay_us of virtual time
+    def at(self, delay_us, fn, *args):
+        self._seq += 1
+        heapq.heappush(self._events, (self.now_us + max(0, int(delay_us)), self._seq, fn, args))
+
+    # micropython.schedule() equivalent, runs after the current event has been handled
+    def schedule(self, fn, arg):
+        if len(self._scheduled) >= self.schedule_depth:
+            raise RuntimeError("schedule queue full")
+        self._scheduled.append((fn, arg))
+
+    def _run_scheduled(self):
+        while self._scheduled:
+            fn, arg = self._scheduled.pop(0)
+            fn(arg)
+
+    # Advance the virtual clock by us, handling every event that falls due
+    def run(self, us):
+        until = self.now_us + int(us)
+        self._run_scheduled()
+        while self._events and self._events[0][0] <= until:
+            t, _, fn, args = heapq.heappop(self._events)
+            self.now_us = t
+            fn(*args)
+            self._run_scheduled()
+        self.now_us = until
+
+    # Advance the clock in steps until cond() is true, returns False on timeout
+    def wait(self, cond, timeout_ms=10000, step_us=1000):
+        end = self.now_us + timeout_ms * 1000
+        while not cond():
+            if self.now_us >= end:
+                return False
+            self.run(step_us)
+        return True
+
+    # Force a connection to drop, as if the supervision timeout expired
+    def drop(self, link, reason=0x08):
+        link.close(reason)
+
+    def _deliver(self, dev, event, data, scratch=()):
+        self.irq_count += 1
+        if self.irq_hook:
+            self.irq_hook(dev, event, data)
+        result = dev._dispatch(event, data)
+        for buf in scratch:
+            # Memoryviews handed to the IRQ are only valid during the handler
+            buf[:] = b"\xee" * len(buf)
+        return result
+
+air = Air()
+
+def ticks_us():
+    return air.now_us & _TICKS_MAX
+
+def ticks_ms():
+    return (air.now_us // 1000) & _TICKS_MAX
+
+def ticks_cpu():
+    return air.now_us & _TICKS_MAX
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & _TICKS_MAX
+
+def ticks_diff(ticks1, ticks2):
+    return ((ticks1 - ticks2 + _TICKS_HALF) & _TICKS_MAX) - _TICKS_HALF
+
+def sleep_ms(ms):
+    air.run(ms * 1000)
+
+def sleep_us(us):
+    air.run(us)
+
+for _name, _fn in (("ticks_us", ticks_us), ("ticks_ms", ticks_ms), ("ticks_cpu", ticks_cpu), ("ticks_add", ticks_add),
+                   ("ticks_diff", ticks_diff), ("sleep_ms", sleep_ms), ("sleep_us", sleep_us)):
+    setattr(_time, _name, _fn)
+
+def _mv(data, scratch):
+    buf = bytearray(data)
+    scratch.append(buf)
+    return memoryview(buf)
+
+'''
+UUID
+'''
+
+class UUID:
+    def __init__(self, value):
+        if isinstance(value, UUID):
+            self._bytes = value._bytes
+        elif isinstance(value, int):
+            if -0x8000 <= value < 0:
+                # MicroPython stores small negative values as their 16-bit pattern
+                value &= 0xFFFF
+            # Like MicroPython, only 16 bit UUIDs can be made from a number
+            if value < 0 or value > 0xFFFF:
+                raise ValueError("invalid UUID")
+            self._bytes = value.to_bytes(2, "little")
+        elif isinstance(value, str):
+            hexdigits = value.replace("-", "")
+            if len(hexdigits) != 32:
+                raise ValueError("invalid UUID")
+            self._bytes = bytes.fromhex(hexdigits)[::-1]
+        else:
+            value = bytes(value)
+            if len(value) not in (2, 4, 16):
+                raise ValueError("invalid UUID")
+            self._bytes = value
+
+    def __bytes__(self):
+        return self._bytes
+
+    def __eq__(self, other):
+        return isinstance(other, UUID) and other._bytes == self._bytes
+
+    def __hash__(self):
+        return hash(self._bytes)
+
+    def __repr__(self):
+        if len(self._bytes) == 16:
+            h = self._bytes[::-1].hex()
+            return "UUID('%s-%s-%s-%s-%s')" % (h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+        return "UUID(0x%04x)" % int.from_bytes(self._bytes, "little")
+
+'''
+Connections
+'''
+
+class _Attr:
+    def __init__(self, uuid, flags):
+        self.uuid = uuid
+        self.flags = flags
+        self.value = bytearray()
+        self.max_len = _DEFAULT_ATTR_LEN
+        self.append = False
+
+class Link:
+    def __init__(self, central, peripheral, interval_us):
+        self.central = central
+        self.peripheral = peripheral
+        self.interval_us = interval_us
+        self.latency = 0
+        self.supervision_timeout_ms = 4000
+        self.mtu = _DEFAULT_MTU
+        self.anchor_us = air.now_us
+        self.open = True
+        self.handles = {central: central._new_handle(), peripheral: peripheral._new_handle()}
+        # Per direction connection event bookkeeping, keyed by sending device
+        self._slot_time = {central: -1, peripheral: -1}
+        self._slot_used = {central: 0, peripheral: 0}
+        self._last_delivery = {central: 0, peripheral: 0}
+        self.queued = {central: 0, peripheral: 0}
+        self.indicating = False
+        self.writing = False
+        self.sent_packets = 0
+        self.channels = {}
+        central._links[self.handles[central]] = self
+        peripheral._links[self.handles[peripheral]] = self
+        air.links.append(self)
+
+    def peer(self, dev):
+        return self.peripheral if dev is self.central else self.central
+
+    # Time of the connection event that will carry the next packet from dev.
+    # A packet queued during a connection event goes out in the next one, so a request
+    # and its response never share an event.
+    def _event_time(self, dev):
+        k = (air.now_us - self.anchor_us) // self.interval_us + 1
+        t = self.anchor_us + k * self.interval_us
+        t = max(t, self._last_delivery[dev] - air.latency_us)
+        while True:
+            if t == self._slot_time[dev] and self._slot_used[dev] >= air.packets_per_event:
+                t += self.interval_us
+                continue
+            if air.loss and air.random.random() < air.loss:
+                t += self.interval_us
+                continue
+            break
+        if t != self._slot_time[dev]:
+            self._slot_time[dev] = t
+            self._slot_used[dev] = 0
+        self._slot_used[dev] += 1
+        return t
+
+    # Queue a packet from dev, fn runs when the peer receives it
+    def send(self, dev, fn, *args, buffered=True):
+        if not self.open:
+            raise OSError(_ENOTCONN)
+        if buffered:
+            if self.queued[dev] >= air.tx_buffers:
+                raise OSError(_ENOMEM)
+            self.queued[dev] += 1
+        t = self._event_time(dev) + air.latency_us
+        self._last_delivery[dev] = t
+        self.sent_packets += 1
+        air.at(t - air.now_us, self._arrive, dev, buffered, fn, args)
+
+    def _arrive(self, dev, buffered, fn, args):
+        if buffered:
+            self.queued[dev] -= 1
+        if self.open:
+            fn(*args)
+
+    # Change the connection parameters and report it to both sides
+    def update(self, interval_us=None, latency=None, supervision_timeout_ms=None, status=0):
+        if interval_us:
+            self.interval_us = interval_us
+            self.anchor_us = air.now_us
+        if latency is not None:
+            self.latency = latency
+        if supervision_timeout_ms is not None:
+            self.supervision_timeout_ms = supervision_timeout_ms
+        for dev in (self.central, self.peripheral):
+            air._deliver(dev, _IRQ_CONNECTION_UPDATE, (self.handles[dev], self.interval_us * 4 // 5000, self.latency, self.supervision_timeout_ms // 10, status))
+
+    def close(self, reason=0x13):
+        if not self.open:
+            return
+        self.open = False
+        if self in air.links:
+            air.links.remove(self)
+        for channel in list(self.channels.values()):
+            channel.close(0)
+        self.channels.clear()
+        for dev, event in ((self.central, _IRQ_PERIPHERAL_DISCONNECT), (self.peripheral, _IRQ_CENTRAL_DISCONNECT)):
+            handle = self.handles[dev]
+            dev._links.pop(handle, None)
+            peer = self.peer(dev)
+            scratch = []
+            air._deliver(dev, event, (handle, peer._addr_type, _mv(peer._addr, scratch)), scratch)
+
+'''
+L2CAP connection-oriented channel
+'''
+
+# One channel between the two devices of a link. Data goes as SDUs (a 2 byte length then the data)
+# split into PDUs of up to _L2CAP_MPS bytes, and each PDU costs the sender one credit. The receiver
+# starts the sender with enough credits for _L2CAP_RX_SDUS MTUs, and hands them back once its
+# application has read everything received, as MicroPython does.
+class _Channel:
+    def __init__(self, link, psm, initiator, mtu, acceptor, accept_mtu):
+        self.link = link
+        self.psm = psm
+        self.open = True
+        self.cids = {initiator: initiator._new_cid(), acceptor: acceptor._new_cid()}
+        # MTU each device receives with
+        self.mtus = {initiator: mtu, acceptor: accept_mtu}
+        self.credits = {dev: -(-_L2CAP_RX_SDUS * self.mtus[self.link.peer(dev)] // _L2CAP_MPS) for dev in (initiator, acceptor)}
+        self.queue = {initiator: [], acceptor: []}
+        self.stalled = {initiator: False, acceptor: False}
+        self.rx = {initiator: bytearray(), acceptor: bytearray()}
+        self._sdu = {initiator: None, acceptor: None}
+        self._expected = {initiator: 0, acceptor: 0}
+        self._partial_pdus = {initiator: 0, acceptor: 0}
+        self._held_pdus = {initiator: 0, acceptor: 0}
+        for dev in (initiator, acceptor):
+            link.channels[(dev, self.cids[dev])] = self
+
+    def data(self, dev):
+        return (self.link.handles[dev], self.cids[dev], self.psm, self.mtus[dev], self.mtus[self.link.peer(dev)])
+
+    # Queue an SDU from dev, returns False if it is left waiting for credits
+    def send(self, dev, data):
+        if self.stalled[dev]:
+            raise OSError(_ENOMEM)
+        if len(data) > self.mtus[self.link.peer(dev)]:
+            raise ValueError("SDU larger than the peer's MTU")
+        sdu = len(data).to_bytes(2, "little") + bytes(data)
+        self.queue[dev].extend(sdu[i : i + _L2CAP_MPS] for i in range(0, len(sdu), _L2CAP_MPS))
+        self._pump(dev)
+        if self.queue[dev]:
+            self.stalled[dev] = True
+            return False
+        return True
+
+    def _pump(self, dev):
+        queue = self.queue[dev]
+        while queue and self.credits[dev] and self.open:
+            self.credits[dev] -= 1
+            self.link.send(dev, self._pdu, self.link.peer(dev), queue.pop(0), buffered=False)
+
+    def _pdu(self, dev, pdu):
+        if not self.open:
+            return
+        if self._sdu[dev] is None:
+            self._expected[dev] = int.from_bytes(pdu[:2], "little")
+            self._sdu[dev] = bytearray(pdu[2:])
+        else:
+            self._sdu[dev] += pdu
+        self._partial_pdus[dev] += 1
+        if len(self._sdu[dev]) >= self._expected[dev]:
+            self.rx[dev] += self._sdu[dev]
+            self._sdu[dev] = None
+            self._held_pdus[dev] += self._partial_pdus[dev]
+            self._partial_pdus[dev] = 0
+            air._deliver(dev, _IRQ_L2CAP_RECV, (self.link.handles[dev], self.cids[dev]))
+
+    # The application on dev has read n bytes, once it has read everything the credits go back
+    def read(self, dev, buf):
+        rx = self.rx[dev]
+        if buf is None:
+            return len(rx)
+        n = min(len(buf), len(rx))
+        buf[:n] = rx[:n]
+        del rx[:n]
+        if not rx and self._held_pdus[dev]:
+            credits = self._held_pdus[dev]
+            self._held_pdus[dev] = 0
+            self.link.send(dev, self._credit, self.link.peer(dev), credits, buffered=False)
+        return n
+
+    def _credit(self, dev, credits):
+        if not self.open:
+            return
+        self.credits[dev] += credits
+        self._pump(dev)
+        if self.stalled[dev] and not self.queue[dev]:
+            self.stalled[dev] = False
+            air._deliver(dev, _IRQ_L2CAP_SEND_READY, (self.link.handles[dev], self.cids[dev], 0))
+
+    def close(self, status=0):
+        if not self.open:
+            return
+        self.open = False
+        for dev in self.cids:
+            self.link.channels.pop((dev, self.cids[dev]), None)
+            air._deliver(dev, _IRQ_L2CAP_DISCONNECT, (self.link.handles[dev], self.cids[dev], self.psm, status))
+
+'''
+BLE device
+'''
+
+class BLE:
+    def __init__(self, addr=None, rssi=None):
+        self._addr_type = 0
+        self._addr = bytes(addr) if addr else bytes(air.random.getrandbits(8) for _ in range(6))
+        self.rssi = air.rssi if rssi is None else rssi
+        self._active = False
+        self._handler = None
+        self._mtu = _DEFAULT_MTU
+        self._gap_name = b"MPY BTSTACK"
+        self._links = {}
+        self._next_handle = 64
+        self._db = {}
+        self._services = []
+        self._adv = None
+        self._adv_gen = 0
+        self._scan = None
+        self._scan_gen = 0
+        self._connecting = None
+        self._l2cap_listen = None
+        self._next_cid = 0x40
+        air.devices.append(self)
+
+    def _new_handle(self):
+        self._next_handle += 1
+        return self._next_handle
+
+    def _new_cid(self):
+        self._next_cid += 1
+        return self._next_cid
+
+    def _link(self, conn_handle):
+        link = self._links.get(conn_handle)
+        if link is None or not link.open:
+            raise OSError(_ENOTCONN)
+        return link
+
+    def _dispatch(self, event, data):
+        if self._active and self._handler:
+            return self._handler(event, data)
+        return None
+
+    def active(self, active=None):
+        if active is None:
+            return self._active
+        self._active = bool(active)
+        return self._active
+
+    def irq(self, handler):
+        self._handler = handler
+
+    def config(self, *args, **kwargs):
+        if args:
+            name = args[0]
+            if name == "mac":
+                return (self._addr_type, self._addr)
+            if name == "mtu":
+                return self._mtu
+            if name == "gap_name":
+                return self._gap_name
+            raise ValueError("unknown config param")
+        for name, value in kwargs.items():
+            if name == "mtu":
+                if value < _DEFAULT_MTU or value > 517:
+                    raise ValueError("invalid MTU")
+                self._mtu = value
+            elif name == "gap_name":
+                self._gap_name = bytes(value, "utf-8") if isinstance(value, str) else bytes(value)
+            elif name in ("rxbuf", "io", "le_secure", "mitm", "bond", "addr_mode"):
+                pass
+            else:
+                raise ValueError("unknown config param")
+
+    '''
+    GAP
+    '''
+
+    def gap_advertise(self, interval_us, adv_data=None, resp_data=None, connectable=True):
+        self._adv_gen += 1
+        if interval_us is None:
+            self._adv = None
+            return
+        if adv_data is None and self._adv:
+            adv_data = self._adv[1]
+        self._adv = (max(20000, interval_us), bytes(adv_data or b""), bytes(resp_data or b""), connectable)
+        air.at(air.random.randrange(0, 10000), self._adv_event, self._adv_gen)
+
+    def _adv_event(self, gen):
+        if gen != self._adv_gen or self._adv is None:
+            return
+        interval_us, adv_data, resp_data, connectable = self._adv
+        for dev in air.devices:
+            if dev is not self and dev._scan and dev._active:
+                dev._scan_report(self, adv_data, resp_data, connectable)
+        # Advertising events are spread with 0-10 ms of random delay, as in the spec
+        air.at(interval_us + air.random.randrange(0, 10000), self._adv_event, gen)
+
+    def gap_scan(self, duration_ms, interval_us=1280000, window_us=11250, active=False):
+        self._scan_gen += 1
+        if duration_ms is None:
+            if self._scan:
+                self._scan = None
+                air.at(0, air._deliver, self, _IRQ_SCAN_DONE, (0,))
+            return
+        self._scan = (interval_us, window_us, active)
+        if duration_ms:
+            air.at(duration_ms * 1000, self._scan_done, self._scan_gen)
+
+    def _scan_done(self, gen):
+        if gen == self._scan_gen and self._scan:
+            self._scan = None
+            air._deliver(self, _IRQ_SCAN_DONE, (0,))
+
+    def _scan_report(self, adv, adv_data, resp_data, connectable):
+        interval_us, window_us, active = self._scan
+        if air.loss and air.random.random() < air.loss:
+            return
+        if window_us < interval_us and air.random.random() > window_us / interval_us:
+            return
+        rssi = max(-127, min(20, adv.rssi + air.random.randint(-3, 3)))
+        scratch = []
+        air._deliver(self, _IRQ_SCAN_RESULT, (adv._addr_type, _mv(adv._addr, scratch), _ADV_IND if connectable else _ADV_NONCONN_IND, rssi, _mv(adv_data, scratch)), scratch)
+        if active and resp_data and self._scan:
+            scratch = []
+            air._deliver(self, _IRQ_SCAN_RESULT, (adv._addr_type, _mv(adv._addr, scratch), _ADV_SCAN_RSP, rssi, _mv(resp_data, scratch)), scratch)
+
+    def gap_connect(self, addr_type, addr, scan_duration_ms=2000, min_conn_interval_us=None, max_conn_interval_us=None):
+        if addr_type is None:
+            self._connecting = None
+            return
+        if self._connecting:
+            raise OSError(_EALREADY)
+        interval_us = min_conn_interval_us or max_conn_interval_us or air.conn_interval_us
+        self._connecting = (addr_type, bytes(addr), air.now_us + scan_duration_ms * 1000, interval_us)
+        air.at(0, self._connect_poll, self._connecting)
+
+    def _connect_poll(self, attempt):
+        if self._connecting is not attempt:
+            return
+        addr_type, addr, deadline, interval_us = attempt
+        for dev in air.devices:
+            if dev._addr == addr and dev._adv and dev._adv[3] and dev._active:
+                self._connecting = None
+                # Connect request goes out on the peripheral's next advertising event
+                air.at(air.random.randrange(0, dev._adv[0]) + air.latency_us, self._connect, dev, interval_us)
+                return
+        if air.now_us >= deadline:
+            self._connecting = None
+            scratch = []
+            air._deliver(self, _IRQ_PERIPHERAL_DISCONNECT, (0xFFFF, addr_type, _mv(addr, scratch)), scratch)
+            return
+        air.at(5000, self._connect_poll, attempt)
+
+    def _connect(self, dev, interval_us):
+        if not dev._adv or not dev._active:
+            scratch = []
+            air._deliver(self, _IRQ_PERIPHERAL_DISCONNECT, (0xFFFF, dev._addr_type, _mv(dev._addr, scratch)), scratch)
+            return
+        # Peripherals stop advertising once connected
+        dev._adv = None
+        dev._adv_gen += 1
+        link = Link(self, dev, interval_us)
+        scratch = []
+        air._deliver(self, _IRQ_PERIPHERAL_CONNECT, (link.handles[self], dev._addr_type, _mv(dev._addr, scratch)), scratch)
+        scratch = []
+        air._deliver(dev, _IRQ_CENTRAL_CONNECT, (link.handles[dev], self._addr_type, _mv(self._addr, scratch)), scratch)
+
+    def gap_disconnect(self, conn_handle):
+        link = self._links.get(conn_handle)
+        if link is None or not link.open:
+            return False
+        air.at(link.interval_us, link.close, 0x16)
+        return True
+
+    '''
+    GATT server
+    '''
+
+    def gatts_register_services(self, services):
+        self._db = {}
+        self._services = []
+        handle = 0
+        result = []
+        for service_uuid, characteristics in services:
+            handle += 1
+            start = handle
+            chars = []
+            handles = []
+            for characteristic in characteristics:
+                char_uuid, flags = characteristic[0], characteristic[1]
+                descriptors = characteristic[2] if len(characteristic) > 2 else ()
+                handle += 2
+                value_handle = handle
+                self._db[value_handle] = _Attr(char_uuid, flags)
+                handles.append(value_handle)
+                if flags & (FLAG_NOTIFY | FLAG_INDICATE):
+                    handle += 1
+                    cccd = _Attr(UUID(_CCCD_UUID), FLAG_READ | FLAG_WRITE)
+                    cccd.value = bytearray(2)
+                    self._db[handle] = cccd
+                for descriptor_uuid, descriptor_flags in descriptors:
+                    handle += 1
+                    self._db[handle] = _Attr(descriptor_uuid, descriptor_flags)
+                    handles.append(handle)
+                chars.append((value_handle, char_uuid, flags))
+            self._services.append((start, handle, service_uuid, chars))
+            result.append(tuple(handles))
+        return tuple(result)
+
+    def _attr(self, value_handle):
+        attr = self._db.get(value_handle)
+        if attr is None:
+            raise OSError(_ENOTCONN)
+        return attr
+
+    def gatts_read(self, value_handle):
+        return bytes(self._attr(value_handle).value)
+
+    def gatts_write(self, value_handle, data, send_update=False):
+        attr = self._attr(value_handle)
+        attr.value = bytearray(data)
+        if send_update:
+            for link in list(self._links.values()):
+                cccd = self._db.get(value_handle + 1)
+                if cccd and len(cccd.value) == 2 and cccd.value[0] & 1:
+                    self.gatts_notify(link.handles[self], value_handle)
+
+    def gatts_set_buffer(self, value_handle, length, append=False):
+        attr = self._attr(value_handle)
+        attr.max_len = length
+        attr.append = append
+
+    def gatts_notify(self, conn_handle, value_handle, data=None):
+        link = self._link(conn_handle)
+        value = bytes(self._attr(value_handle).value if data is None else data)[:link.mtu - 3]
+        link.send(self, self._client_notify, link, _IRQ_GATTC_NOTIFY, value_handle, value)
+
+    def gatts_indicate(self, conn_handle, value_handle, data=None):
+        link = self._link(conn_handle)
+        if link.indicating:
+            raise OSError(_EALREADY)
+        value = bytes(self._attr(value_handle).value if data is None else data)[:link.mtu - 3]
+        link.send(self, self._client_notify, link, _IRQ_GATTC_INDICATE, value_handle, value)
+        # Only in flight once the stack has taken it, a full TX queue raises ENOMEM above
+        link.indicating = True
+
+    def _client_notify(self, link, event, value_handle, value):
+        client = link.central
+        scratch = []
+        air._deliver(client, event, (link.handles[client], value_handle, _mv(value, scratch)), scratch)
+        if event == _IRQ_GATTC_INDICATE:
+            link.send(client, self._indicate_done, link, value_handle, buffered=False)
+
+    def _indicate_done(self, link, value_handle):
+        link.indicating = False
+        air._deliver(self, _IRQ_GATTS_INDICATE_DONE, (link.handles[self], value_handle, 0))
+
+    def _server_write(self, link, value_handle, data):
+        attr = self._db.get(value_handle)
+        if attr is None or not attr.flags & (FLAG_WRITE | FLAG_WRITE_NO_RESPONSE):
+            return _ATT_ERROR_INVALID_HANDLE
+        data = bytes(data)[:link.mtu - 3]
+        if attr.append:
+            attr.value = (attr.value + data)[-attr.max_len:]
+        else:
+            attr.value = bytearray(data[:attr.max_len])
+        air._deliver(self, _IRQ_GATTS_WRITE, (link.handles[self], value_handle))
+        return 0
+
+    def _server_read(self, link, value_handle):
+        attr = self._db.get(value_handle)
+        if attr is None:
+            return _ATT_ERROR_INVALID_HANDLE, None
+        if not attr.flags & FLAG_READ:
+            return _ATT_ERROR_READ_NOT_PERMITTED, None
+        status = air._deliver(self, _IRQ_GATTS_READ_REQUEST, (link.handles[self], value_handle))
+        if status:
+            return status, None
+        return 0, bytes(attr.value)[:link.mtu - 1]
+
+    '''
+    GATT client
+    '''
+
+    def gattc_discover_services(self, conn_handle, uuid=None):
+        link = self._link(conn_handle)
+        link.send(self, self._discover_services_req, link, uuid, buffered=False)
+
+    def _discover_services_req(self, link, uuid):
+        server = link.peripheral
+        results = [s for s in server._services if uuid is None or s[2] == uuid]
+        link.send(server, self._discover_services_rsp, link, results, buffered=False)
+
+    def _discover_services_rsp(self, link, results):
+        for start, end, service_uuid, _ in results:
+            air._deliver(self, _IRQ_GATTC_SERVICE_RESULT, (link.handles[self], start, end, service_uuid))
+        air._deliver(self, _IRQ_GATTC_SERVICE_DONE, (link.handles[self], 0))
+
+    def gattc_discover_characteristics(self, conn_handle, start_handle, end_handle, uuid=None):
+        link = self._link(conn_handle)
+        link.send(self, self._discover_chars_req, link, start_handle, end_handle, uuid, buffered=False)
+
+    def _discover_chars_req(self, link, start_handle, end_handle, uuid):
+        server = link.peripheral
+        results = []
+        for _, service_end, _, chars in server._services:
+            for value_handle, char_uuid, flags in chars:
+                if start_handle <= value_handle <= end_handle and (uuid is None or uuid == char_uuid):
+                    results.append((value_handle, char_uuid, flags))
+        link.send(server, self._discover_chars_rsp, link, results, buffered=False)
+
+    def _discover_chars_rsp(self, link, results):
+        for value_handle, char_uuid, flags in results:
+            air._deliver(self, _IRQ_GATTC_CHARACTERISTIC_RESULT, (link.handles[self], value_handle - 1, value_handle, flags, char_uuid))
+        air._deliver(self, _IRQ_GATTC_CHARACTERISTIC_DONE, (link.handles[self], 0))
+
+    def gattc_read(self, conn_handle, value_handle):
+        link = self._link(conn_handle)
+        link.send(self, self._read_req, link, value_handle, buffered=False)
+
+    def _read_req(self, link, value_handle):
+        status, value = link.peripheral._server_read(link, value_handle)
+        link.send(link.peripheral, self._read_rsp, link, value_handle, status, value, buffered=False)
+
+    def _read_rsp(self, link, value_handle, status, value):
+        handle = link.handles[self]
+        if value is not None:
+            scratch = []
+            air._deliver(self, _IRQ_GATTC_READ_RESULT, (handle, value_handle, _mv(value, scratch)), scratch)
+        air._deliver(self, _IRQ_GATTC_READ_DONE, (handle, value_handle, status))
+
+    def gattc_write(self, conn_handle, value_handle, data, mode=0):
+        link = self._link(conn_handle)
+        data = bytes(data)
+        if mode:
+            if link.writing:
+                raise OSError(_EALREADY)
+            link.writing = True
+            link.send(self, self._write_req, link, value_handle, data, buffered=False)
+        else:
+            link.send(self, link.peripheral._server_write, link, value_handle, data)
+
+    def _write_req(self, link, value_handle, data):
+        status = link.peripheral._server_write(link, value_handle, data)
+        link.send(link.peripheral, self._write_rsp, link, value_handle, status, buffered=False)
+
+    def _write_rsp(self, link, value_handle, status):
+        link.writing = False
+        air._deliver(self, _IRQ_GATTC_WRITE_DONE, (link.handles[self], value_handle, status))
+
+    def gattc_exchange_mtu(self, conn_handle):
+        link = self._link(conn_handle)
+        link.send(self, self._mtu_req, link, self._mtu, buffered=False)
+
+    def _mtu_req(self, link, mtu):
+        peer = link.peer(self)
+        link.mtu = max(_DEFAULT_MTU, min(mtu, peer._mtu))
+        link.send(peer, self._mtu_rsp, link, buffered=False)
+
+    def _mtu_rsp(self, link):
+        for dev in (link.central, link.peripheral):
+            air._deliver(dev, _IRQ_MTU_EXCHANGED, (link.handles[dev], link.mtu))
+
+    '''
+    L2CAP
+    '''
+
+    def l2cap_listen(self, psm, mtu):
+        self._l2cap_listen = (psm, mtu)
+
+    def l2cap_connect(self, conn_handle, psm, mtu):
+        link = self._link(conn_handle)
+        link.send(self, self._l2cap_connect_req, link, psm, mtu, buffered=False)
+
+    def _l2cap_connect_req(self, link, psm, mtu):
+        peer = link.peer(self)
+        listen = peer._l2cap_listen
+        if listen is None or listen[0] != psm:
+            link.send(peer, self._l2cap_connect_rsp, link, None, psm, _L2CAP_PSM_NOT_SUPPORTED, buffered=False)
+            return
+        channel = _Channel(link, psm, self, mtu, peer, listen[1])
+        status = air._deliver(peer, _IRQ_L2CAP_ACCEPT, channel.data(peer))
+        if status:
+            channel.open = False
+            link.channels.pop((self, channel.cids[self]), None)
+            link.channels.pop((peer, channel.cids[peer]), None)
+            link.send(peer, self._l2cap_connect_rsp, link, None, psm, status, buffered=False)
+            return
+        air._deliver(peer, _IRQ_L2CAP_CONNECT, channel.data(peer))
+        link.send(peer, self._l2cap_connect_rsp, link, channel, psm, 0, buffered=False)
+
+    def _l2cap_connect_rsp(self, link, channel, psm, status):
+        if channel is None:
+            air._deliver(self, _IRQ_L2CAP_DISCONNECT, (link.handles[self], 0, psm, status))
+        elif channel.open:
+            air._deliver(self, _IRQ_L2CAP_CONNECT, channel.data(self))
+
+    def _channel(self, conn_handle, cid):
+        channel = self._link(conn_handle).channels.get((self, cid))
+        if channel is None or not channel.open:
+            raise OSError(_ENOTCONN)
+        return channel
+
+    def l2cap_disconnect(self, conn_handle, cid):
+        channel = self._channel(conn_handle, cid)
+        channel.link.send(self, channel.close, 0, buffered=False)
+
+    def l2cap_send(self, conn_handle, cid, buf):
+        return self._channel(conn_handle, cid).send(self, buf)
+
+    def l2cap_recvinto(self, conn_handle, cid, buf):
+        return self._channel(conn_handle, cid).read(self, buf)
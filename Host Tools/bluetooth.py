@@ -0,0 +1,2 @@
+# Host-side stand-in for MicroPython's bluetooth module, see blesim.py
+from blesim import BLE, UUID, FLAG_BROADCAST, FLAG_READ, FLAG_WRITE_NO_RESPONSE, FLAG_WRITE, FLAG_NOTIFY, FLAG_INDICATE
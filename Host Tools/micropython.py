@@ -0,0 +1,21 @@
+# Host-side stand-in for MicroPython's micropython module, see blesim.py
+from blesim import air
+
+
+def const(value):
+    return value
+
+
+def schedule(func, arg):
+    air.schedule(func, arg)
+
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+
+def native(func):
+    return func
+
+
+viper = native
@@ -0,0 +1,225 @@
+'''
+This code was written and modified by Kitronik Ltd.
+
+Reads the trace files written by TraceRecorder.dump in the KitronikPicoWBluetooth
+library, prints each event, and replays the events into a BLEPeripheral or
+BLECentral on a computer:
+
+    python3 "Host Tools/trace.py" trace.bin
+    python3 "Host Tools/trace.py" trace.bin --replay central
+
+Replaying calls the library's _irq handler with each recorded event in order,
+against a stand-in for the bluetooth module that notes the calls the library
+makes instead of sending anything. Each event is printed with those calls and
+any exception the handler raised, followed by the time the handler took for
+each kind of event on this computer. Events whose payload was cut short by the
+recorder's payload size are printed but not replayed, as their data is incomplete.
+For GATTS_WRITE the value written is written back to the attribute before the
+handler is called, as the handler reads it from there.
+'''
+
+import os
+import sys
+import time
+from struct import calcsize, unpack_from
+
+# The library lives in the folder above this one
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from blesim import air
+import bluetooth
+from KitronikPicoWBluetooth import BLEPeripheral, BLECentral, TRACE_FORMAT, TRACE_MAGIC, TRACE_FILE_FORMAT
+
+EVENT_NAMES = {
+    1: "CENTRAL_CONNECT", 2: "CENTRAL_DISCONNECT", 3: "GATTS_WRITE", 4: "GATTS_READ_REQUEST",
+    5: "SCAN_RESULT", 6: "SCAN_DONE", 7: "PERIPHERAL_CONNECT", 8: "PERIPHERAL_DISCONNECT",
+    9: "GATTC_SERVICE_RESULT", 10: "GATTC_SERVICE_DONE", 11: "GATTC_CHARACTERISTIC_RESULT",
+    12: "GATTC_CHARACTERISTIC_DONE", 13: "GATTC_DESCRIPTOR_RESULT", 14: "GATTC_DESCRIPTOR_DONE",
+    15: "GATTC_READ_RESULT", 16: "GATTC_READ_DONE", 17: "GATTC_WRITE_DONE", 18: "GATTC_NOTIFY",
+    19: "GATTC_INDICATE", 20: "GATTS_INDICATE_DONE", 21: "MTU_EXCHANGED", 22: "L2CAP_ACCEPT",
+    23: "L2CAP_CONNECT", 24: "L2CAP_DISCONNECT", 25: "L2CAP_RECV", 26: "L2CAP_SEND_READY",
+    27: "CONNECTION_UPDATE",
+}
+_GATTS_WRITE = 3
+
+# Layout of each event's data tuple, from the MicroPython bluetooth documentation:
+#   i  a number, taken in order from the record's numbers
+#   s  a signed 16 bit number (RSSI)
+#   a  a 6 byte address from the payload
+#   b  the rest of the payload as a memoryview
+#   u  the rest of the payload as a UUID
+_SHAPES = {
+    1: "iia", 2: "iia", 3: "ii", 4: "ii", 5: "iaisb", 6: "", 7: "iia", 8: "iia",
+    9: "iiiu", 10: "ii", 11: "iiiiu", 12: "ii", 13: "iiu", 14: "ii", 15: "iib", 16: "iii",
+    17: "iii", 18: "iib", 19: "iib", 20: "iii", 21: "ii", 22: "iiiii", 23: "iiiii",
+    24: "iiii", 25: "ii", 26: "iii", 27: "iiiii",
+}
+
+'''
+Reading
+'''
+
+# Records of a trace file as (ticks_us, event, numbers, length, payload), oldest first
+def read_trace(path):
+    with open(path, "rb") as f:
+        data = f.read()
+
+    magic, count, payload, total = unpack_from(TRACE_FILE_FORMAT, data)
+    if magic != TRACE_MAGIC:
+        raise ValueError("Not a trace file")
+
+    header = calcsize(TRACE_FORMAT)
+    size = header + payload
+    records = []
+    at = calcsize(TRACE_FILE_FORMAT)
+    for _ in range(count):
+        fields = unpack_from(TRACE_FORMAT, data, at)
+        records.append((fields[0], fields[1], fields[3:8], fields[8], bytes(data[at + header : at + header + fields[2]])))
+        at += size
+    return records
+
+# Rebuild the data tuple passed to _irq for a record
+def event_data(event, numbers, payload):
+    shape = _SHAPES.get(event)
+    if shape is None:
+        return tuple(numbers)
+
+    data = []
+    n = 0
+    p = 0
+    for kind in shape:
+        if kind == "i":
+            data.append(numbers[n])
+            n += 1
+        elif kind == "s":
+            value = numbers[n]
+            data.append(value - 0x10000 if value >= 0x8000 else value)
+            n += 1
+        elif kind == "a":
+            data.append(memoryview(payload[p : p + 6]))
+            p += 6
+        elif kind == "b":
+            data.append(memoryview(payload[p:]))
+            p = len(payload)
+        elif kind == "u":
+            uuid = payload[p:]
+            data.append(bluetooth.UUID(uuid if len(uuid) != 2 else int.from_bytes(uuid, "little")))
+            p = len(payload)
+    return tuple(data)
+
+# ticks_us on the Pico wraps at 2**30, so differences are worked out like time.ticks_diff
+_TICKS_PERIOD = 1 << 30
+
+def _ticks_diff(end, start):
+    return ((end - start + _TICKS_PERIOD // 2) & (_TICKS_PERIOD - 1)) - _TICKS_PERIOD // 2
+
+# Time of each record in us from the first, adding up the gaps between records so traces
+# longer than half the ticks period still count up
+def _times(records):
+    elapsed = 0
+    previous = records[0][0] if records else 0
+    for record in records:
+        elapsed += _ticks_diff(record[0], previous)
+        previous = record[0]
+        yield elapsed
+
+def _format(value):
+    if isinstance(value, memoryview):
+        return bytes(value).hex()
+    return str(value)
+
+# The event's data, then the value written for GATTS_WRITE, which the recorder keeps as the payload
+def _describe(event, data, payload):
+    text = " ".join(_format(value) for value in data)
+    if event == _GATTS_WRITE:
+        text += " " + payload.hex()
+    return text
+
+'''
+Replay
+'''
+
+# Calls that only touch the local GATT database are passed to the simulated BLE, everything
+# that would use the radio is noted and returns these results (None if not listed)
+_LOCAL = ("active", "config", "irq", "gatts_register_services", "gatts_read", "gatts_write", "gatts_set_buffer")
+_RESULTS = {"gap_disconnect": True, "l2cap_send": True, "l2cap_recvinto": 0}
+
+class ReplayBLE:
+    def __init__(self, ble):
+        self._ble = ble
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name in _LOCAL:
+            return getattr(self._ble, name)
+
+        def call(*args):
+            self.calls.append((name, args))
+            return _RESULTS.get(name)
+        return call
+
+# Feed records into a new BLEPeripheral or BLECentral, printing each event with the calls it made.
+# Returns {event name: list of handler times in us}
+def replay(records, role="central", out=print):
+    air.reset()
+    device = BLEPeripheral(bluetooth.BLE()) if role == "peripheral" else BLECentral(bluetooth.BLE())
+    ble = ReplayBLE(device._ble)
+    device._ble = ble
+    costs = {}
+
+    for i, ((ticks, event, numbers, length, payload), elapsed) in enumerate(zip(records, _times(records))):
+        name = EVENT_NAMES.get(event, str(event))
+        data = event_data(event, numbers, payload)
+        out("%4d %10d us  %-28s %s" % (i, elapsed, name, _describe(event, data, payload)))
+        if length > len(payload):
+            # Replaying a cut short value or advertising payload would pass the handler corrupt data
+            out("%44s(%d of %d payload bytes recorded, not replayed)" % ("", len(payload), length))
+            continue
+
+        del ble.calls[:]
+        error = None
+        if event == _GATTS_WRITE:
+            # The handler reads the value written from the attribute, so put the recorded value back in it
+            try:
+                ble.gatts_write(data[1], payload)
+            except Exception as e:
+                error = e
+        if error is None:
+            start = time.perf_counter_ns()
+            try:
+                device._irq(event, data)
+            except Exception as e:
+                error = e
+            costs.setdefault(name, []).append((time.perf_counter_ns() - start) / 1000)
+
+        for call, args in ble.calls:
+            out("%44s-> %s(%s)" % ("", call, ", ".join(_format(arg) for arg in args)))
+        if error is not None:
+            out("%44s!! %s: %s" % ("", type(error).__name__, error))
+    return costs
+
+'''
+Report
+'''
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        return
+
+    records = read_trace(sys.argv[1])
+    if "--replay" in sys.argv:
+        i = sys.argv.index("--replay")
+        role = sys.argv[i + 1] if i + 1 < len(sys.argv) else "central"
+        costs = replay(records, role)
+        print("Handler time on this computer")
+        for name, times in sorted(costs.items()):
+            print("  %-28s %5d events  mean %7.1f us  max %7.1f us" % (name, len(times), sum(times) / len(times), max(times)))
+        return
+
+    for i, ((ticks, event, numbers, length, payload), elapsed) in enumerate(zip(records, _times(records))):
+        data = event_data(event, numbers, payload)
+        print("%4d %10d us  %-28s %s" % (i, elapsed, EVENT_NAMES.get(event, str(event)), _describe(event, data, payload)))
+
+if __name__ == "__main__":
+    main()
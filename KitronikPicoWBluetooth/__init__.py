@@ -0,0 +1,94 @@
+'''
+This code was written and modified by Kitronik Ltd.
+
+Large sections of the code is modified code from the MicroPython project examples.
+
+Thank you to the MicroPython project as this library wouldn't have been
+possible without them.
+
+https://github.com/micropython/micropython/blob/master/LICENSE
+'''
+
+# Each name is imported from its module the first time it is used, so a device only loads the role it
+# runs, and the features it turns on. from KitronikPicoWBluetooth import BLECentral imports the central
+# and nothing for the peripheral, while the statistics, trace, clock sync and L2CAP modules are only
+# imported when collectStats, traceEvents, syncClock or openStream is called.
+_MODULES = {
+    "PROFILES": "common",
+    "connection_params": "common",
+    "MES_SERVICE_UUID": "common",
+    "MES_CHARACTERISTIC_UUID": "common",
+    "MES_CONTROLLER_SERVICE": "common",
+    "L2CAP_PSM": "common",
+    "L2CAP_MTU": "common",
+
+    "ADVERTISE_APPEARANCE_GAMEPAD": "adv",
+    "advertising_payload": "adv",
+    "iter_fields": "adv",
+    "has_service": "adv",
+    "has_name": "adv",
+    "decode_name": "adv",
+    "decode_field": "adv",
+    "decode_frames": "adv",
+    "decode_services": "adv",
+
+    "RingBuffer": "ringbuffer",
+
+    "BLEPeripheral": "peripheral",
+    "Characteristic": "peripheral",
+    "Service": "peripheral",
+    "SendQueue": "peripheral",
+    "QUEUE_LATEST": "peripheral",
+    "QUEUE_PACK": "peripheral",
+    "PeerTable": "peripheral",
+    "SUBSCRIBE_NOTIFY": "peripheral",
+    "SUBSCRIBE_INDICATE": "peripheral",
+
+    "BLECentral": "central",
+    "WritePipeline": "central",
+    "SCAN_FIRST": "central",
+    "SCAN_BEST": "central",
+    "SCAN_RANKED": "central",
+    "ScanTable": "scan",
+
+    "BLEMultiCentral": "multicentral",
+    "BLEConnection": "multicentral",
+
+    "BLEBroadcaster": "broadcast",
+    "BLEObserver": "broadcast",
+    "BROADCAST_COMPANY_ID": "broadcast",
+    "BROADCAST_SLOTS": "broadcast",
+
+    "L2CAPChannel": "l2cap",
+
+    "BLEStats": "stats",
+    "LATENCY_INDICATE": "stats",
+    "LATENCY_WRITE": "stats",
+    "LATENCY_READ": "stats",
+    "LATENCY_BUCKETS_MS": "stats",
+    "STATS_FORMAT": "stats",
+
+    "TraceRecorder": "trace",
+    "TRACE_FORMAT": "trace",
+    "TRACE_MAGIC": "trace",
+    "TRACE_FILE_FORMAT": "trace",
+
+    "ClockSync": "clock",
+    "SYNC_REQUEST": "clock",
+    "SYNC_REPLY": "clock",
+    "STAMP_SIZE": "clock",
+}
+
+# On a computer, from KitronikPicoWBluetooth import * uses __all__ to import every module.
+# MicroPython's import * ignores __all__ and __getattr__, copying only the names already imported here,
+# so on the Pico W each name has to be imported by name.
+__all__ = tuple(_MODULES)
+
+# Import a name from its module, and keep it here so the next lookup doesn't come back through __getattr__
+def __getattr__(name):
+    module = _MODULES.get(name)
+    if module is None:
+        raise AttributeError(name)
+    value = getattr(__import__(__name__ + "." + module, None, None, (name,)), name)
+    globals()[name] = value
+    return value
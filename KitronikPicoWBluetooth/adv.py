@@ -0,0 +1,166 @@
+'''
+This code was written and modified by Kitronik Ltd.
+
+Building and reading advertising payloads, used by every role.
+
+Large sections of the code is modified code from the MicroPython project examples.
+
+Thank you to the MicroPython project as this library wouldn't have been
+possible without them.
+
+https://github.com/micropython/micropython/blob/master/LICENSE
+'''
+
+import bluetooth
+from micropython import const
+from struct import pack, unpack_from
+
+ADVERTISE_APPEARANCE_GAMEPAD = const(0x03C4)
+
+# Advertising payloads are repeated packets of the following form:
+#   1 byte data length (N + 1)
+#   1 byte type (see constants below)
+#   N bytes type-specific data
+_ADV_TYPE_FLAGS = const(0x01)
+_ADV_TYPE_NAME = const(0x09)
+_ADV_TYPE_UUID16_COMPLETE = const(0x3)
+_ADV_TYPE_UUID32_COMPLETE = const(0x5)
+_ADV_TYPE_UUID128_COMPLETE = const(0x7)
+_ADV_TYPE_APPEARANCE = const(0x19)
+_ADV_TYPE_SERVICE_DATA16 = const(0x16)
+_ADV_TYPE_MANUFACTURER = const(0xFF)
+
+# Generate a payload to be passed to gap_advertise(adv_data=...).
+# manufacturer is (company_id, data) and service_data is (16 bit UUID, data), for sending data without connecting.
+def advertising_payload(limited_disc=False, br_edr=False, name=None, services=None, appearance=0, manufacturer=None, service_data=None):
+    payload = bytearray()
+
+    def _append(adv_type, value):
+        nonlocal payload
+        payload += pack("BB", len(value) + 1, adv_type) + value
+
+    _append(
+        _ADV_TYPE_FLAGS,
+        pack("B", (0x01 if limited_disc else 0x02) + (0x18 if br_edr else 0x04)),
+    )
+
+    if name:
+        _append(_ADV_TYPE_NAME, name.encode() if isinstance(name, str) else name)
+
+    if services:
+        for uuid in services:
+            b = bytes(uuid)
+            if len(b) == 2:
+                _append(_ADV_TYPE_UUID16_COMPLETE, b)
+            elif len(b) == 4:
+                _append(_ADV_TYPE_UUID32_COMPLETE, b)
+            elif len(b) == 16:
+                _append(_ADV_TYPE_UUID128_COMPLETE, b)
+
+    # See org.bluetooth.characteristic.gap.appearance.xml
+    if appearance:
+        _append(_ADV_TYPE_APPEARANCE, pack("<h", appearance))
+
+    if manufacturer:
+        _append(_ADV_TYPE_MANUFACTURER, pack("<H", manufacturer[0]) + bytes(manufacturer[1]))
+
+    if service_data:
+        _append(_ADV_TYPE_SERVICE_DATA16, bytes(service_data[0]) + bytes(service_data[1]))
+
+    return payload
+
+# Walk the fields of an Advertise Payload in a single pass without copying anything,
+# yielding (adv_type, offset, length) for each field where offset and length give the field's data
+def iter_fields(payload):
+    i = 0
+    end = len(payload)
+    while i + 1 < end:
+        n = payload[i]
+        if n == 0 or i + 1 + n > end:
+            # Zero length padding or a field cut short ends the payload
+            return
+        yield payload[i + 1], i + 2, n - 1
+        i += 1 + n
+
+# Returns true if the Advertise Payload lists the service with the raw UUID bytes given (2, 4 or 16 bytes).
+# Compares bytes in place so it allocates nothing, and is cheap enough to run on every scan result.
+def has_service(payload, uuid_bytes):
+    size = len(uuid_bytes)
+    # Complete UUID list types are 0x03, 0x05 and 0x07, the incomplete lists are one lower
+    complete = _ADV_TYPE_UUID16_COMPLETE if size == 2 else (_ADV_TYPE_UUID32_COMPLETE if size == 4 else _ADV_TYPE_UUID128_COMPLETE)
+    i = 0
+    end = len(payload)
+    while i + 1 < end:
+        n = payload[i]
+        if n == 0 or i + 1 + n > end:
+            return False
+        
+        adv_type = payload[i + 1]
+        if adv_type == complete or adv_type == complete - 1:
+            # Each field can list several UUIDs of the same size
+            j = i + 2
+            field_end = i + 1 + n
+            while j + size <= field_end:
+                k = 0
+                while k < size and payload[j + k] == uuid_bytes[k]:
+                    k += 1
+                if k == size:
+                    return True
+                j += size
+        i += 1 + n
+    return False
+
+# Returns true if the Advertise Payload has a name starting with the bytes given, compared in place
+def has_name(payload, name_bytes):
+    size = len(name_bytes)
+    i = 0
+    end = len(payload)
+    while i + 1 < end:
+        n = payload[i]
+        if n == 0 or i + 1 + n > end:
+            return False
+        
+        if payload[i + 1] == _ADV_TYPE_NAME and n - 1 >= size:
+            k = 0
+            while k < size and payload[i + 2 + k] == name_bytes[k]:
+                k += 1
+            return k == size
+        i += 1 + n
+    return False
+
+# Decode Peripheral Name from Advertise Payload
+def decode_name(payload):
+    for adv_type, offset, length in iter_fields(payload):
+        if adv_type == _ADV_TYPE_NAME:
+            return str(payload[offset : offset + length], "utf-8")
+    return ""
+
+# Decode Peripheral Service Characteristics from Advertise Payload
+def decode_field(payload, adv_type):
+    return [payload[offset : offset + length] for field_type, offset, length in iter_fields(payload) if field_type == adv_type]
+
+# Decode Packed Values from a Peripheral using QUEUE_PACK, yielding a memoryview of each value
+def decode_frames(payload):
+    payload = memoryview(payload)
+    i = 0
+    while i < len(payload):
+        n = payload[i]
+        yield payload[i + 1 : i + 1 + n]
+        i += 1 + n
+
+# Decode Peripheral Service from Advertise Payload
+def decode_services(payload):
+    services = []
+    for adv_type, offset, length in iter_fields(payload):
+        # Complete and incomplete lists of 16, 32 and 128 bit UUIDs
+        if adv_type == _ADV_TYPE_UUID16_COMPLETE or adv_type == _ADV_TYPE_UUID16_COMPLETE - 1:
+            for i in range(offset, offset + length - 1, 2):
+                services.append(bluetooth.UUID(unpack_from("<H", payload, i)[0]))
+        elif adv_type == _ADV_TYPE_UUID32_COMPLETE or adv_type == _ADV_TYPE_UUID32_COMPLETE - 1:
+            for i in range(offset, offset + length - 3, 4):
+                # bluetooth.UUID only takes 16 bit numbers, so 32 bit UUIDs are made from their bytes
+                services.append(bluetooth.UUID(bytes(payload[i : i + 4])))
+        elif adv_type == _ADV_TYPE_UUID128_COMPLETE or adv_type == _ADV_TYPE_UUID128_COMPLETE - 1:
+            for i in range(offset, offset + length - 15, 16):
+                services.append(bluetooth.UUID(bytes(payload[i : i + 16])))
+    return services
@@ -0,0 +1,220 @@
+'''
+This code was written and modified by Kitronik Ltd.
+
+Sending data to many devices in advertisements, without connecting.
+'''
+
+from micropython import const
+from array import array
+from time import ticks_ms, ticks_diff
+from .adv import advertising_payload
+
+'''
+Bluetooth Low Energy - Connectionless Broadcast
+'''
+
+# BLE Central Interrupt Event Numbers
+_IRQ_SCAN_RESULT = const(5)
+
+# Advertising payload field types used for the frames
+_ADV_TYPE_SERVICE_DATA16 = const(0x16)
+_ADV_TYPE_MANUFACTURER = const(0xFF)
+
+# Company ID put in manufacturer data by default, 0xFFFF is set aside for testing by the Bluetooth SIG
+BROADCAST_COMPANY_ID = const(0xFFFF)
+# Frames a BLEBroadcaster rotates between
+BROADCAST_SLOTS = const(4)
+
+# Each broadcast frame is one manufacturer data field (or service data field with a 16 bit UUID):
+#   2 byte company ID (or UUID), little endian
+#   1 byte sequence: slot in the top 2 bits and a count in the bottom 6 bits, which changes with the data
+#   the application data
+_ADV_MAX = const(31)
+_BROADCAST_HEADER = const(5)
+_ADV_SCAN_RSP = const(0x04)
+
+# Sends application data to any number of BLEObservers in advertisements, without connecting.
+# Up to BROADCAST_SLOTS frames of data are advertised in turn, each for rotate_ms, every interval_ms.
+# service is a 16 bit UUID to send the data as service data instead of manufacturer data with company_id.
+class BLEBroadcaster:
+    def __init__(self, ble, company_id=BROADCAST_COMPANY_ID, service=None, interval_ms=100, rotate_ms=500, name=None):
+        self._ble = ble
+        self._ble.active(True)
+        self._interval_us = interval_ms * 1000
+        self.rotate_ms = rotate_ms
+        
+        # Fields before the data never change, so they are written once
+        prefix = advertising_payload(name=name)
+        self._payload = bytearray(_ADV_MAX)
+        self._view = memoryview(self._payload)
+        self._payload[: len(prefix)] = prefix
+        self._start = len(prefix)
+        if service is None:
+            self._payload[self._start + 1] = _ADV_TYPE_MANUFACTURER
+            self._payload[self._start + 2] = company_id & 0xFF
+            self._payload[self._start + 3] = company_id >> 8
+        else:
+            self._payload[self._start + 1] = _ADV_TYPE_SERVICE_DATA16
+            self._payload[self._start + 2 : self._start + 4] = bytes(service)
+        # Most bytes of application data in one frame
+        self.maxSize = _ADV_MAX - self._start - _BROADCAST_HEADER
+        if self.maxSize <= 0:
+            raise ValueError("Name too long")
+        
+        self._frames = [bytearray(self.maxSize) for _ in range(BROADCAST_SLOTS)]
+        self._lengths = bytearray(BROADCAST_SLOTS)
+        self._counts = bytearray(BROADCAST_SLOTS)
+        # Bit for each slot holding data
+        self._used = 0
+        self._slot = -1
+        self._rotated = ticks_ms()
+        self.frames = 0
+    
+    # Put data in a slot, it is advertised straight away if it is the only frame or its slot is showing
+    def set(self, data, slot=0):
+        n = len(data)
+        if n > self.maxSize:
+            raise ValueError("Data too long")
+        self._frames[slot][:n] = data
+        self._lengths[slot] = n
+        self._counts[slot] = (self._counts[slot] + 1) & 0x3F
+        self._used |= 1 << slot
+        if slot == self._slot or self._slot < 0 or self._used == 1 << slot:
+            self._show(slot)
+    
+    # Stop advertising a slot's data
+    def clear(self, slot=0):
+        self._used &= ~(1 << slot)
+        if not self._used:
+            self.stop()
+        elif slot == self._slot:
+            self._rotate()
+    
+    # Stop advertising
+    def stop(self):
+        self._slot = -1
+        self._ble.gap_advertise(None)
+    
+    # Advertise one slot's frame
+    def _show(self, slot):
+        payload = self._payload
+        n = self._lengths[slot]
+        at = self._start + 4
+        payload[self._start] = 4 + n
+        payload[at] = (slot << 6) | self._counts[slot]
+        payload[at + 1 : at + 1 + n] = self._frames[slot][:n]
+        self._ble.gap_advertise(self._interval_us, adv_data=self._view[: at + 1 + n], connectable=False)
+        self._slot = slot
+        self._rotated = ticks_ms()
+        self.frames += 1
+    
+    # Advertise the next slot holding data
+    def _rotate(self):
+        for i in range(1, BROADCAST_SLOTS + 1):
+            slot = (self._slot + i) % BROADCAST_SLOTS
+            if self._used & (1 << slot):
+                self._show(slot)
+                return
+    
+    # Call regularly from the main loop to move on to the next frame every rotate_ms
+    def poll(self):
+        if self._used & (self._used - 1) and ticks_diff(ticks_ms(), self._rotated) >= self.rotate_ms:
+            self._rotate()
+
+# Listens for BLEBroadcaster frames with a continuous passive scan, and never connects.
+# callback(addr, slot, data, rssi) is called from the interrupt handler once for each new frame,
+# with addr and data as memoryviews only valid during the callback. Repeats of a frame are
+# recognised from its sequence byte, for up to capacity broadcasters at once.
+class BLEObserver:
+    def __init__(self, ble, callback=None, company_id=BROADCAST_COMPANY_ID, service=None, capacity=8):
+        self._ble = ble
+        self._ble.active(True)
+        self._ble.irq(self._irq)
+        self.callback = callback
+        
+        if service is None:
+            self._type = _ADV_TYPE_MANUFACTURER
+            self._id = bytes((company_id & 0xFF, company_id >> 8))
+        else:
+            self._type = _ADV_TYPE_SERVICE_DATA16
+            self._id = bytes(service)
+        
+        # Preallocated table of broadcasters, with the last sequence byte heard in each slot
+        self.capacity = capacity
+        self._addrs = bytearray(6 * capacity)
+        self._heard = array("I", [0] * capacity)
+        self._seqs = bytearray(capacity * BROADCAST_SLOTS)
+        self._seen = bytearray(capacity)
+        self.count = 0
+        self.received = 0
+        self.duplicates = 0
+    
+    # Row of a broadcaster, adding it (or replacing the least recently heard) if it is new
+    def _row(self, addr):
+        addrs = self._addrs
+        for i in range(self.count):
+            j = i * 6
+            k = 0
+            while k < 6 and addrs[j + k] == addr[k]:
+                k += 1
+            if k == 6:
+                return i
+        
+        if self.count < self.capacity:
+            i = self.count
+            self.count += 1
+        else:
+            i = 0
+            now = ticks_ms()
+            for r in range(1, self.capacity):
+                if ticks_diff(now, self._heard[r]) > ticks_diff(now, self._heard[i]):
+                    i = r
+        addrs[i * 6 : i * 6 + 6] = addr
+        self._seen[i] = 0
+        return i
+    
+    # BLE event interrupt handler
+    def _irq(self, event, data):
+        if event != _IRQ_SCAN_RESULT:
+            return
+        
+        addr_type, addr, adv_type, rssi, adv_data = data
+        if adv_type == _ADV_SCAN_RSP:
+            return
+        
+        # Find our field in place, without iter_fields so nothing is allocated
+        i = 0
+        end = len(adv_data)
+        ident = self._id
+        while i + 1 < end:
+            n = adv_data[i]
+            if n == 0 or i + 1 + n > end:
+                return
+            if adv_data[i + 1] == self._type and n >= _BROADCAST_HEADER - 1 and adv_data[i + 2] == ident[0] and adv_data[i + 3] == ident[1]:
+                break
+            i += 1 + n
+        else:
+            return
+        
+        seq = adv_data[i + 4]
+        slot = seq >> 6
+        row = self._row(addr)
+        self._heard[row] = ticks_ms()
+        k = row * BROADCAST_SLOTS + slot
+        if self._seen[row] & (1 << slot) and self._seqs[k] == seq:
+            self.duplicates += 1
+            return
+        
+        self._seen[row] |= 1 << slot
+        self._seqs[k] = seq
+        self.received += 1
+        if self.callback is not None:
+            self.callback(addr, slot, adv_data[i + 5 : i + 1 + n], rssi)
+    
+    # Start listening, scanning for window_us in every interval_us until stop() is called
+    def start(self, interval_us=30000, window_us=30000):
+        self._ble.gap_scan(0, interval_us, window_us, False)
+    
+    # Stop listening
+    def stop(self):
+        self._ble.gap_scan(None)
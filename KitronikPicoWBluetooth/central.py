@@ -0,0 +1,1126 @@
+'''
+This code was written and modified by Kitronik Ltd.
+
+The central role: scans for a peripheral advertising our service, connects
+to it and reads, writes and receives its characteristic.
+
+Large sections of the code is modified code from the MicroPython project examples.
+
+Thank you to the MicroPython project as this library wouldn't have been
+possible without them.
+
+https://github.com/micropython/micropython/blob/master/LICENSE
+'''
+
+import bluetooth
+from micropython import const, schedule
+from struct import pack, unpack_from, calcsize
+from array import array
+from time import ticks_ms, ticks_us, ticks_diff, ticks_add
+from errno import ENOTCONN, EOPNOTSUPP
+from random import getrandbits
+from .common import PROFILES, connection_params, MES_SERVICE_UUID, MES_CHARACTERISTIC_UUID, L2CAP_PSM, L2CAP_MTU
+from .adv import has_service, has_name, decode_name
+from .ringbuffer import RingBuffer
+
+'''
+Bluetooth Low Energy - Central Device
+'''
+
+# BLE Central Interrupt Event Numbers
+_IRQ_SCAN_RESULT = const(5)
+_IRQ_SCAN_DONE = const(6)
+_IRQ_PERIPHERAL_CONNECT = const(7)
+_IRQ_PERIPHERAL_DISCONNECT = const(8)
+_IRQ_GATTC_SERVICE_RESULT = const(9)
+_IRQ_GATTC_SERVICE_DONE = const(10)
+_IRQ_GATTC_CHARACTERISTIC_RESULT = const(11)
+_IRQ_GATTC_CHARACTERISTIC_DONE = const(12)
+_IRQ_GATTC_READ_RESULT = const(15)
+_IRQ_GATTC_READ_DONE = const(16)
+_IRQ_GATTC_WRITE_DONE = const(17)
+_IRQ_GATTC_NOTIFY = const(18)
+_IRQ_GATTC_INDICATE = const(19)
+_IRQ_MTU_EXCHANGED = const(21)
+_IRQ_L2CAP_ACCEPT = const(22)
+_IRQ_L2CAP_SEND_READY = const(26)
+_IRQ_CONNECTION_UPDATE = const(27)
+# Size of the dispatch tables, one entry for each event number the bluetooth module can send
+_IRQ_EVENTS = const(32)
+
+# Handle given to _IRQ_PERIPHERAL_DISCONNECT when a gap_connect() fails
+_CONN_HANDLE_NONE = const(0xFFFF)
+
+# Advertise Types
+_ADV_IND = const(0x00)
+_ADV_DIRECT_IND = const(0x01)
+
+# Every connection starts at the default ATT MTU until an exchange raises it,
+# and each notify, indicate or write value fits in the MTU less a 3 byte ATT header
+_DEFAULT_MTU = const(23)
+_ATT_HEADER = const(3)
+
+# LATENCY_WRITE and LATENCY_READ from .stats, without importing it until collectStats is called
+_LATENCY_WRITE = const(1)
+_LATENCY_READ = const(2)
+
+# Raw bytes of our service UUID, for checking advertise payloads without creating UUID objects
+_MES_SERVICE_BYTES = bytes(MES_SERVICE_UUID)
+
+# Scan modes
+SCAN_FIRST = const(0)   # Stop at the first matching device
+SCAN_BEST = const(1)    # Scan for the whole duration and pick the strongest device
+SCAN_RANKED = const(2)  # Scan for the whole duration and list every device, strongest first
+
+'''
+Central Write Pipeline
+'''
+
+# Holds writes from BLECentral.write until the stack has room for them, see pipelineWrites.
+# Values are copied into a ring buffer and sent in order, with at most window writes with response
+# waiting for their _IRQ_GATTC_WRITE_DONE. The ATT protocol completes writes in the order they
+# were sent, so each completion belongs to the oldest write in flight.
+class WritePipeline:
+    def __init__(self, send, report, window=4, slots=8, size=20, retry_ms=10):
+        # send(data, response) raises OSError when the stack has no room
+        # report(write_id, status, latency_ms) is called as each write completes
+        self._send = send
+        self._report = report
+        self.window = window
+        self.retry_ms = retry_ms
+        
+        self._queue = RingBuffer(slots, size)
+        # Write id, time queued and response flag of each ring buffer slot
+        self._ids = array("H", [0] * slots)
+        self._queued_ms = array("I", [0] * slots)
+        self._responses = bytearray(slots)
+        self._next_id = 0
+        
+        # Writes with response sent and waiting for completion, oldest at _flight_head
+        self._flight_ids = array("H", [0] * window)
+        self._flight_ms = array("I", [0] * window)
+        self._flight_head = 0
+        self.inflight = 0
+        
+        # Set while waiting retry_ms after the stack was full
+        self._retry_due = False
+        self._retry_ms = 0
+        
+        # pump runs from the main loop and from the interrupt handler as writes complete. While the main loop
+        # is pumping, completions and a lost connection from the interrupt handler are held here and dealt
+        # with by that pump once the write it is sending has been recorded, so only one caller at a time
+        # moves the ring buffer's tail and the window. The interrupt handler moves _done_head, pump _done_tail.
+        self._pumping = False
+        self._pump_again = False
+        self._done_statuses = array("H", [0] * window)
+        self._done_head = 0
+        self._done_tail = 0
+        self._fail_status = -1
+        
+        # Writes handed to the stack, acknowledged, failed, not queued because it was full, and send retries
+        self.sent = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.retries = 0
+        # Time from write to acknowledgement of the last write with response
+        self.last_latency_ms = 0
+
+    # Number of writes waiting to be sent
+    def __len__(self):
+        return len(self._queue)
+
+    # Queue a write, returns its id (1 to 65535) or 0 if the queue is full
+    def add(self, data, response=False):
+        i = self._queue.put(0, 0, data)
+        if i < 0:
+            self.dropped += 1
+            return 0
+        
+        self._next_id = self._next_id % 0xFFFF + 1
+        self._ids[i] = self._next_id
+        self._queued_ms[i] = ticks_ms()
+        self._responses[i] = 1 if response else 0
+        return self._next_id
+
+    # Send queued writes until the queue is empty, the window is full or the stack is full
+    def pump(self):
+        if self._pumping:
+            # Called from the interrupt handler part way through the main loop's pump, which goes round again
+            self._pump_again = True
+            return
+        
+        self._pumping = True
+        try:
+            again = True
+            while again:
+                self._pump_again = False
+                self._send_queued()
+                
+                # Completions that arrived while sending, then a lost connection
+                while self._done_tail != self._done_head:
+                    status = self._done_statuses[self._done_tail % self.window]
+                    self._done_tail = (self._done_tail + 1) % (2 * self.window)
+                    self._complete(status)
+                if self._fail_status >= 0:
+                    status = self._fail_status
+                    self._fail_status = -1
+                    self._fail(status)
+                again = self._pump_again
+        finally:
+            self._pumping = False
+    
+    def _send_queued(self):
+        if self._retry_due:
+            if ticks_diff(ticks_ms(), self._retry_ms) < 0:
+                return
+            self._retry_due = False
+        
+        queue = self._queue
+        i = queue.peek()
+        while i >= 0 and self._fail_status < 0:
+            response = self._responses[i]
+            if response and self.inflight == self.window:
+                # Wait for a completion to free a place in the window
+                return
+            
+            try:
+                self._send(queue.value(i), response)
+            except OSError:
+                # The stack has no room, try again once retry_ms has passed
+                self.retries += 1
+                self._retry_due = True
+                self._retry_ms = ticks_add(ticks_ms(), self.retry_ms)
+                return
+            
+            self.sent += 1
+            if response:
+                j = (self._flight_head + self.inflight) % self.window
+                self._flight_ids[j] = self._ids[i]
+                self._flight_ms[j] = self._queued_ms[i]
+                self.inflight += 1
+            else:
+                # Nothing will acknowledge it, so it is complete once the stack has it
+                self._report(self._ids[i], 0, ticks_diff(ticks_ms(), self._queued_ms[i]))
+            
+            queue.pop()
+            i = queue.peek()
+
+    # Match a _IRQ_GATTC_WRITE_DONE to the oldest write in flight
+    def done(self, status):
+        if self._pumping:
+            # Held until pump has recorded the write it is sending, there are never more than window
+            self._done_statuses[self._done_head % self.window] = status
+            self._done_head = (self._done_head + 1) % (2 * self.window)
+            self._pump_again = True
+            return
+        self._complete(status)
+    
+    def _complete(self, status):
+        if not self.inflight:
+            return
+        
+        h = self._flight_head
+        self._flight_head = (h + 1) % self.window
+        self.inflight -= 1
+        latency = ticks_diff(ticks_ms(), self._flight_ms[h])
+        
+        if status == 0:
+            self.completed += 1
+            self.last_latency_ms = latency
+        else:
+            self.failed += 1
+        
+        self._report(self._flight_ids[h], status, latency)
+
+    # Fail every write in flight and every queued write with status, after the connection is lost
+    def fail(self, status):
+        if self._pumping:
+            # Done by pump once the write it is sending has been recorded
+            self._fail_status = status
+            self._pump_again = True
+            return
+        self._fail(status)
+    
+    def _fail(self, status):
+        now = ticks_ms()
+        
+        while self.inflight:
+            h = self._flight_head
+            self._flight_head = (h + 1) % self.window
+            self.inflight -= 1
+            self.failed += 1
+            self._report(self._flight_ids[h], status, ticks_diff(now, self._flight_ms[h]))
+        
+        queue = self._queue
+        i = queue.peek()
+        while i >= 0:
+            self.failed += 1
+            self._report(self._ids[i], status, ticks_diff(now, self._queued_ms[i]))
+            queue.pop()
+            i = queue.peek()
+        
+        self._retry_due = False
+
+# Discovery cache file record: address type, address, service start and end handles, value handle,
+# and the number of characteristic records that follow
+_CACHE_RECORD = "<B6sHHHB"
+_CACHE_RECORD_SIZE = calcsize(_CACHE_RECORD)
+# Characteristic record: UUID length, UUID bytes padded to 16, value handle
+_CACHE_CHARACTERISTIC = "<B16sH"
+_CACHE_CHARACTERISTIC_SIZE = calcsize(_CACHE_CHARACTERISTIC)
+
+class BLECentral:
+    # Initialise BLE, asking peripherals for an ATT MTU of up to mtu bytes once connected.
+    # read, write and the data callbacks use the characteristic with the UUID given in the service given,
+    # and every other characteristic the peripheral has can be used by its UUID.
+    def __init__(self, ble, mtu=247, service=MES_SERVICE_UUID, characteristic=MES_CHARACTERISTIC_UUID[0]):
+        self._ble = ble
+        self._ble.active(True)
+        self._ble.config(mtu=mtu)
+        
+        # Handler for each event number, bound once here so _irq doesn't create a bound method for each event
+        self._events = [None] * _IRQ_EVENTS
+        self._events[_IRQ_SCAN_RESULT] = self._on_scan_result
+        self._events[_IRQ_SCAN_DONE] = self._on_scan_done
+        self._events[_IRQ_PERIPHERAL_CONNECT] = self._on_connect
+        self._events[_IRQ_PERIPHERAL_DISCONNECT] = self._on_disconnect
+        self._events[_IRQ_GATTC_SERVICE_RESULT] = self._on_service_result
+        self._events[_IRQ_GATTC_SERVICE_DONE] = self._on_service_done
+        self._events[_IRQ_GATTC_CHARACTERISTIC_RESULT] = self._on_characteristic_result
+        self._events[_IRQ_GATTC_CHARACTERISTIC_DONE] = self._on_characteristic_done
+        self._events[_IRQ_GATTC_READ_RESULT] = self._on_read_result
+        self._events[_IRQ_GATTC_READ_DONE] = self._on_read_done
+        self._events[_IRQ_GATTC_WRITE_DONE] = self._on_write_done
+        self._events[_IRQ_GATTC_NOTIFY] = self._on_notify
+        self._events[_IRQ_GATTC_INDICATE] = self._on_indicate
+        self._events[_IRQ_MTU_EXCHANGED] = self._on_mtu_exchanged
+        self._events[_IRQ_CONNECTION_UPDATE] = self._on_connection_update
+        # Callbacks added for each event number with addEventCallback, a tuple or None
+        self._event_callbacks = [None] * _IRQ_EVENTS
+        # _irq, or _irq_callbacks once there are callbacks, see _set_irq
+        self._dispatch = self._irq
+        self._ble.irq(self._irq)
+        
+        self._preferred_mtu = mtu
+        self._service_uuid = service if isinstance(service, bluetooth.UUID) else bluetooth.UUID(service)
+        self._characteristic_uuid = characteristic if isinstance(characteristic, bluetooth.UUID) else bluetooth.UUID(characteristic)
+        # Profile given to connect, also used when reconnecting
+        self._profile = None
+        
+        # Discovered handles of known peripherals keyed by address, see cacheDiscovery
+        self._cache = None
+        self._cache_path = None
+        # True once discovery has finished and its handles still need adding to the cache, which is done
+        # outside the interrupt handler as it allocates and writes to flash
+        self._cache_dirty = False
+        # Bound method created once, passed to micropython.schedule to save the cache
+        self._save_cache_ref = self._save_cache
+        
+        # Scan settings, see scan
+        self._scan_table = None
+        self._scan_mode = SCAN_FIRST
+        self._scan_min_rssi = -127
+        self._scan_name = None
+        self._scan_service = _MES_SERVICE_BYTES
+        
+        # Optional pipeline for writes, see pipelineWrites
+        self.writePipeline = None
+        # Optional counts and timings, see collectStats
+        self.stats = None
+        # Optional record of recent events, see traceEvents
+        self.tracer = None
+        # Optional clock shared with the peripheral, see syncClock
+        self.clock = None
+        self._sync_interval_ms = 0
+        self._resync_ms = 0
+        self._sync_ms = 0
+        
+        # Optional reconnection after the connection is lost, see autoReconnect
+        self._auto_reconnect = False
+        self._reconnecting = False
+        self._reconnect_due = False
+        self._reconnect_ms = 0
+        self._reconnect_failures = 0
+        self._reconnect_attempts = 0
+        self._disconnected_ms = 0
+        # Bound method created once, passed to scan when falling back to scanning
+        self._rescan_ref = self._rescan_done
+        # Reconnections made, and the time the last one took from losing the connection to being ready
+        self.reconnects = 0
+        self.lastReconnectMs = 0
+        # Passed (elapsed_ms, attempts) after each automatic reconnection
+        self.reconnectCallback = None
+        
+        # Optional L2CAP channel, see openStream
+        self.stream = None
+        
+        # Called when the connection is lost or a connect fails, kept when the connection is reset
+        self.disconnectCallback = None
+        self._reset()
+
+    # Reset BLE connection, handlers and callbacks
+    def _reset(self):
+        # Cached name and address from a successful scan
+        self._name = None
+        self._addr_type = None
+        self._addr = None
+        
+        self._reset_connection()
+
+        # Callbacks for completion of various operations
+        self._scan_callback = None
+        self._conn_callback = None
+        self.readCallback = None
+        self.notifyCallback = None
+        self.indicateCallback = None
+        # Passed the status of each completed read, and of each write with response
+        self.readDoneCallback = None
+        self.writeDoneCallback = None
+        # Passed (write_id, status, latency_ms) as each pipelined write completes, see pipelineWrites
+        self.writeResultCallback = None
+        # Callbacks for other characteristics keyed by UUID bytes, and by value handle once discovered
+        self._uuid_callbacks = {}
+        self._handle_callbacks = {}
+
+    # Reset the connection only, keeping the address and callbacks for reconnecting
+    def _reset_connection(self):
+        # Connected device handles
+        self._conn_handle = None
+        self._start_handle = None
+        self._end_handle = None
+        self._value_handle = None
+        # Value handle of every characteristic keyed by UUID bytes, and the handle range of every service
+        self._characteristics = {}
+        self._first_handle = None
+        self._last_handle = None
+        # True while using cached handles that the peripheral hasn't confirmed yet
+        self._cache_unconfirmed = False
+        # Negotiated MTU of the connection
+        self._mtu = _DEFAULT_MTU
+        # Connection parameters reported by the stack, see connectionParams
+        self._params = None
+
+    # BLE event interrupt handler. Each event goes to its handler in the dispatch table, apart from
+    # notifications while connected and scan results while scanning, the most frequent events, which are
+    # tested for first and go straight to their handler.
+    def _irq(self, event, data):
+        if event == _IRQ_GATTC_NOTIFY:
+            return self._on_notify(event, data)
+        if event == _IRQ_SCAN_RESULT:
+            return self._on_scan_result(event, data)
+        if event < _IRQ_EVENTS:
+            handler = self._events[event]
+            if handler is not None:
+                return handler(event, data)
+
+    # Interrupt handler used while there are callbacks added with addEventCallback, so _irq doesn't look
+    # for callbacks on every event when there are none
+    def _irq_callbacks(self, event, data):
+        result = self._irq(event, data)
+        if event < _IRQ_EVENTS:
+            callbacks = self._event_callbacks[event]
+            if callbacks is not None:
+                for callback in callbacks:
+                    callback(event, data)
+        return result
+
+    # A single scan result
+    def _on_scan_result(self, event, data):
+        addr_type, addr, adv_type, rssi, adv_data = data
+        
+        if adv_type in (_ADV_IND, _ADV_DIRECT_IND) and rssi >= self._scan_min_rssi and has_service(adv_data, self._scan_service) and (self._scan_name is None or has_name(adv_data, self._scan_name)):
+            if self._scan_mode != SCAN_FIRST:
+                # Keep scanning, the best device is picked when the scan is over
+                self._scan_table.update(addr_type, addr, rssi, adv_data)
+            else:
+                # Found a potential device, remember it and stop scanning.
+                self._addr_type = addr_type
+                self._addr = bytes(addr)
+                self._name = decode_name(adv_data) or "?"
+                self._ble.gap_scan(None)
+
+    # Scan duration finished or manually stopped
+    def _on_scan_done(self, event, data):
+        if self._scan_callback and self._scan_mode == SCAN_RANKED:
+            callback = self._scan_callback
+            self._scan_callback = None
+            callback(self._scan_table.ranked(self._scan_min_rssi))
+        
+        elif self._scan_callback:
+            if self._scan_mode == SCAN_BEST:
+                table = self._scan_table
+                i = table.best(self._scan_min_rssi)
+                if i >= 0:
+                    # Connect will use the strongest device found
+                    self._addr_type = table.addr_types[i]
+                    self._addr = table.addr(i)
+                    self._name = table.names[i]
+            
+            if self._addr:
+                # Found a device during the scan (and the scan was explicitly stopped).
+                self._scan_callback(self._addr_type, self._addr, self._name)
+                self._scan_callback = None
+            else:
+                # Scan timed out.
+                self._scan_callback(None, None, None)
+
+    # A successful gap_connect()
+    def _on_connect(self, event, data):
+        conn_handle, addr_type, addr = data
+        
+        if addr_type == self._addr_type and addr == self._addr:
+            self._conn_handle = conn_handle
+            if self.stats is not None:
+                self.stats.connected()
+            handles = self._cache.get(self._addr) if self._cache is not None else None
+            
+            if handles is not None:
+                # Known device, reuse its handles and skip service and characteristic discovery
+                self._start_handle, self._end_handle, self._value_handle = handles[1:4]
+                self._characteristics = dict(handles[4])
+                self._bind_callbacks()
+                self._cache_unconfirmed = True
+                self._exchange_mtu()
+                self._ready()
+            else:
+                self._ble.gattc_discover_services(self._conn_handle)
+
+    # Connected peripheral has disconnected
+    def _on_disconnect(self, event, data):
+        conn_handle, addr_type, addr = data
+        
+        if conn_handle == self._conn_handle:
+            # If it was initiated by us, it'll already be reset.
+            if self.writePipeline is not None:
+                self.writePipeline.fail(ENOTCONN)
+            if self.stats is not None:
+                self.stats.disconnected()
+            if self.stream is not None:
+                self.stream._lost(conn_handle)
+            
+            if self._auto_reconnect:
+                # Keep the address and callbacks, and try to connect again from poll
+                self._reset_connection()
+                self._reconnecting = True
+                self._reconnect_failures = 0
+                self._reconnect_attempts = 0
+                self._disconnected_ms = ticks_ms()
+                self._schedule_reconnect(0)
+            else:
+                self._reset()
+            
+            if self.disconnectCallback:
+                self.disconnectCallback()
+        
+        elif conn_handle == _CONN_HANDLE_NONE and self._conn_handle is None and addr == self._addr:
+            # gap_connect() couldn't reach the device
+            if self._reconnecting:
+                self._reconnect_failures += 1
+                self._schedule_reconnect(self._backoff())
+            elif self.disconnectCallback:
+                self.disconnectCallback()
+
+    # Called for each service found by gattc_discover_services()
+    def _on_service_result(self, event, data):
+        conn_handle, start_handle, end_handle, uuid = data
+        
+        if conn_handle == self._conn_handle:
+            if uuid == self._service_uuid:
+                self._start_handle, self._end_handle = start_handle, end_handle
+            
+            # Characteristics of every service are discovered, so any of them can be used by UUID
+            if self._first_handle is None or start_handle < self._first_handle:
+                self._first_handle = start_handle
+            if self._last_handle is None or end_handle > self._last_handle:
+                self._last_handle = end_handle
+
+    # Called once service discovery is complete
+    def _on_service_done(self, event, data):
+        if self._start_handle and self._end_handle:
+            self._ble.gattc_discover_characteristics(self._conn_handle, self._first_handle, self._last_handle)
+        else:
+            raise Exception("Failed to find Peripheral Device.")
+
+    # Called for each characteristic found by gattc_discover_services()
+    def _on_characteristic_result(self, event, data):
+        conn_handle, end_handle, value_handle, properties, uuid = data
+        
+        if conn_handle == self._conn_handle:
+            self._characteristics[bytes(uuid)] = value_handle
+            
+            if uuid == self._characteristic_uuid and self._start_handle <= value_handle <= self._end_handle:
+                self._value_handle = value_handle
+
+    # Called once service characteristic discovery is complete
+    def _on_characteristic_done(self, event, data):
+        if self._value_handle:
+            self._bind_callbacks()
+            if self._cache is not None:
+                # Saved from a micropython.schedule callback, or from poll() if the schedule queue is full
+                self._cache_dirty = True
+                try:
+                    schedule(self._save_cache_ref, None)
+                except RuntimeError:
+                    pass
+            
+            if self._cache_unconfirmed:
+                # Discovery after cached handles failed, the connect callback has already fired
+                self._cache_unconfirmed = False
+            else:
+                self._exchange_mtu()
+                # We've finished connecting and discovering device, fire the connect callback.
+                self._ready()
+        else:
+            raise Exception("Failed to find Peripheral Characteristic.")
+
+    # A gattc_read() has completed
+    def _on_read_result(self, event, data):
+        conn_handle, value_handle, char_data = data
+        
+        if conn_handle == self._conn_handle:
+            if value_handle == self._value_handle:
+                if self.readCallback:
+                    # Process the value read inside readCallback
+                    self._callback(self.readCallback, char_data)
+            else:
+                self._characteristic_value(value_handle, char_data)
+
+    # A gattc_read() has completed
+    def _on_read_done(self, event, data):
+        conn_handle, value_handle, status = data
+        
+        if self._cache_unconfirmed and conn_handle == self._conn_handle:
+            self._check_cached_handle(status)
+        
+        if conn_handle == self._conn_handle:
+            if self.stats is not None:
+                self.stats.finish(_LATENCY_READ)
+            
+            if self.readDoneCallback:
+                self._callback(self.readDoneCallback, status)
+
+    # A gattc_write() has completed
+    def _on_write_done(self, event, data):
+        conn_handle, value_handle, status = data
+        
+        if self._cache_unconfirmed and conn_handle == self._conn_handle:
+            self._check_cached_handle(status)
+        
+        if conn_handle == self._conn_handle:
+            if self.stats is not None:
+                self.stats.finish(_LATENCY_WRITE)
+            
+            if self.writePipeline is not None and value_handle == self._value_handle:
+                self.writePipeline.done(status)
+            
+            if self.writeDoneCallback:
+                self._callback(self.writeDoneCallback, status)
+            
+            if self.writePipeline is not None:
+                # A place in the window is free
+                self.writePipeline.pump()
+
+    # A server has sent a notify request. Called straight from _irq, and only reads the fields it needs
+    def _on_notify(self, event, data):
+        if data[0] != self._conn_handle:
+            return
+        
+        if data[1] == self._value_handle:
+            # A notification from the cached handle shows the handle is still right
+            self._cache_unconfirmed = False
+            
+            if self.clock is not None and self.clock._sample(data[2]):
+                # A reply to a clock sync request, not a value for notifyCallback
+                pass
+            
+            elif self.notifyCallback:
+                # Process the value read inside notifyCallback
+                self._callback(self.notifyCallback, data[2])
+        
+        else:
+            self._characteristic_value(data[1], data[2])
+
+    # A server has sent an indicate request
+    def _on_indicate(self, event, data):
+        conn_handle, value_handle, notify_data = data
+        
+        if conn_handle == self._conn_handle and value_handle == self._value_handle:
+            if self.indicateCallback:
+                # Process the value read inside indicateCallback
+                self._callback(self.indicateCallback, notify_data)
+        
+        elif conn_handle == self._conn_handle:
+            self._characteristic_value(value_handle, notify_data)
+
+    # The MTU exchange has completed
+    def _on_mtu_exchanged(self, event, data):
+        conn_handle, mtu = data
+        
+        if conn_handle == self._conn_handle:
+            self._mtu = mtu
+
+    # The connection parameters have changed
+    def _on_connection_update(self, event, data):
+        conn_handle, conn_interval, conn_latency, supervision_timeout, status = data
+        
+        if status == 0 and conn_handle == self._conn_handle:
+            self._params = connection_params(conn_interval, conn_latency, supervision_timeout)
+
+    # Give the stack the interrupt handler for the features turned on
+    def _set_irq(self):
+        self._dispatch = self._irq_callbacks if any(self._event_callbacks) else self._irq
+        if self.tracer is not None:
+            self._ble.irq(self._irq_traced)
+        elif self.stats is not None:
+            self._ble.irq(self._irq_timed)
+        else:
+            self._ble.irq(self._dispatch)
+
+    # Interrupt handler used once collectStats is called, counts and times each event
+    def _irq_timed(self, event, data):
+        start = ticks_us()
+        result = self._dispatch(event, data)
+        self.stats.irq(event, ticks_diff(ticks_us(), start))
+        return result
+    
+    # Interrupt handler used once traceEvents is called, records each event before handling it
+    def _irq_traced(self, event, data):
+        self.tracer.record(event, data)
+        if self.stats is not None:
+            return self._irq_timed(event, data)
+        return self._dispatch(event, data)
+    
+    # Run a user callback with the value given, timing it when collecting stats
+    def _callback(self, callback, value):
+        if self.stats is None:
+            return callback(value)
+        start = ticks_us()
+        result = callback(value)
+        self.stats.callback(ticks_diff(ticks_us(), start))
+        return result
+    
+    # A value read, notified or indicated from a characteristic other than ours
+    def _characteristic_value(self, value_handle, data):
+        callback = self._handle_callbacks.get(value_handle)
+        if callback is not None:
+            self._callback(callback, data)
+    
+    # Match the characteristic callbacks to the discovered value handles
+    def _bind_callbacks(self):
+        self._handle_callbacks = {}
+        for uuid, callback in self._uuid_callbacks.items():
+            handle = self._characteristics.get(uuid)
+            if handle is not None:
+                self._handle_callbacks[handle] = callback
+
+    # Connected and discovered, report the reconnection if there was one and fire the connect callback
+    def _ready(self):
+        if self._reconnecting:
+            self._reconnecting = False
+            self._reconnect_due = False
+            self.reconnects += 1
+            self.lastReconnectMs = ticks_diff(ticks_ms(), self._disconnected_ms)
+            if self.reconnectCallback:
+                self.reconnectCallback(self.lastReconnectMs, self._reconnect_attempts)
+        
+        if self.clock is not None:
+            # This may be another peripheral, or the same one restarted, so sync from scratch
+            self.clock.reset()
+            self._sync_ms = ticks_ms()
+        
+        if self._conn_callback:
+            self._conn_callback()
+    
+    # Exponential backoff from the minimum to the maximum delay with the failures so far,
+    # randomised over its upper half so centrals that lost the same peripheral don't retry together
+    def _backoff(self):
+        delay = self._reconnect_min_ms << min(self._reconnect_failures, 16)
+        if delay > self._reconnect_max_ms:
+            delay = self._reconnect_max_ms
+        half = delay // 2
+        return half + getrandbits(16) % (half + 1)
+    
+    # Make the next reconnection attempt once delay_ms has passed
+    def _schedule_reconnect(self, delay_ms):
+        self._reconnect_ms = ticks_add(ticks_ms(), delay_ms)
+        self._reconnect_due = True
+    
+    # Try gap_connect to the lost peripheral, or scan for it after max_failures attempts in a row
+    def _reconnect(self):
+        self._reconnect_due = False
+        self._reconnect_attempts += 1
+        
+        if self._reconnect_failures >= self._reconnect_max_failures:
+            # The peripheral may have a new address, find it again
+            self.scan(self._rescan_ref, self._reconnect_scan_ms, SCAN_FIRST, self._scan_min_rssi, self._scan_name, self._scan_service)
+            return
+        
+        try:
+            if self._profile is None:
+                self._ble.gap_connect(self._addr_type, self._addr, self._reconnect_timeout_ms)
+            else:
+                profile = PROFILES[self._profile]
+                self._ble.gap_connect(self._addr_type, self._addr, self._reconnect_timeout_ms, profile[2], profile[3])
+        except OSError:
+            # The stack is busy, count it as a failure
+            self._reconnect_failures += 1
+            self._schedule_reconnect(self._backoff())
+    
+    # End of a fallback scan while reconnecting
+    def _rescan_done(self, addr_type, addr, name):
+        if not self._reconnecting:
+            return
+        
+        if addr_type is None:
+            # Not found, scan again after the longest delay
+            self._schedule_reconnect(self._backoff())
+            return
+        
+        # Found it, connect straight away
+        self._addr_type = addr_type
+        self._addr = addr
+        self._name = name
+        self._reconnect_failures = 0
+        self._schedule_reconnect(0)
+
+    # Ask the peripheral for a larger MTU, the result arrives as _IRQ_MTU_EXCHANGED
+    def _exchange_mtu(self):
+        if self._preferred_mtu > _DEFAULT_MTU:
+            try:
+                self._ble.gattc_exchange_mtu(self._conn_handle)
+            except OSError:
+                # Keep the default MTU
+                pass
+
+    # The first read or write using cached handles has completed
+    def _check_cached_handle(self, status):
+        if status == 0:
+            self._cache_unconfirmed = False
+            return
+        
+        # The peripheral's handles have changed, forget them and run a full discovery
+        self._cache.pop(self._addr, None)
+        self._start_handle = None
+        self._end_handle = None
+        self._value_handle = None
+        self._characteristics = {}
+        self._first_handle = None
+        self._last_handle = None
+        self._ble.gattc_discover_services(self._conn_handle)
+    
+    # Store the handles of the connected device, and save the cache to flash if it has a path
+    def _cache_handles(self):
+        self._cache[self._addr] = (self._addr_type, self._start_handle, self._end_handle, self._value_handle, tuple(self._characteristics.items()))
+        
+        if self._cache_path:
+            try:
+                with open(self._cache_path, "wb") as f:
+                    for addr, handles in self._cache.items():
+                        f.write(pack(_CACHE_RECORD, handles[0], addr, handles[1], handles[2], handles[3], len(handles[4])))
+                        for uuid, value_handle in handles[4]:
+                            f.write(pack(_CACHE_CHARACTERISTIC, len(uuid), uuid, value_handle))
+            except OSError:
+                # The cache still works from RAM
+                pass
+    
+    # micropython.schedule target and poll() fallback for adding the discovered handles to the cache
+    def _save_cache(self, _):
+        if not self._cache_dirty:
+            return
+        self._cache_dirty = False
+        if self._conn_handle is not None and self._value_handle is not None:
+            # Only while still connected, otherwise the handles have already been reset
+            self._cache_handles()
+    
+    # Remember the discovered handles of each peripheral, so reconnecting to a known device skips
+    # service and characteristic discovery. If the first read or write with the cached handles fails,
+    # a full discovery is run. With a path the cache is also saved to, and loaded from, a file in flash.
+    def cacheDiscovery(self, path=None):
+        self._cache = {}
+        self._cache_path = path
+        
+        if path:
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except OSError:
+                # No saved cache yet
+                return
+            
+            i = 0
+            while i + _CACHE_RECORD_SIZE <= len(data):
+                record = unpack_from(_CACHE_RECORD, data, i)
+                i += _CACHE_RECORD_SIZE
+                if i + record[5] * _CACHE_CHARACTERISTIC_SIZE > len(data):
+                    # Cut short, keep the records read so far
+                    break
+                
+                characteristics = []
+                for _ in range(record[5]):
+                    size, uuid, value_handle = unpack_from(_CACHE_CHARACTERISTIC, data, i)
+                    characteristics.append((uuid[:size], value_handle))
+                    i += _CACHE_CHARACTERISTIC_SIZE
+                self._cache[record[1]] = (record[0], record[2], record[3], record[4], tuple(characteristics))
+    
+    # Find a device advertising our service (or the service given), ignoring devices weaker than min_rssi
+    # or whose name doesn't start with name.
+    #   SCAN_FIRST  stops at the first device found, callback(addr_type, addr, name)
+    #   SCAN_BEST   picks the device with the strongest smoothed RSSI, callback(addr_type, addr, name)
+    #   SCAN_RANKED callback(list) with (addr_type, addr, name, rssi) for each device, strongest first
+    # Scan results are kept in a table of capacity devices, the least recently heard is replaced when full.
+    def scan(self, callback, duration_ms=2000, mode=SCAN_FIRST, min_rssi=-127, name=None, service=MES_SERVICE_UUID, capacity=8):
+        self._addr_type = None
+        self._addr = None
+        self._scan_callback = callback
+        self._scan_mode = mode
+        self._scan_min_rssi = min_rssi
+        self._scan_name = name.encode() if isinstance(name, str) else name
+        self._scan_service = bytes(service)
+        
+        if mode != SCAN_FIRST:
+            if self._scan_table is None or self._scan_table.capacity != capacity:
+                from .scan import ScanTable
+                self._scan_table = ScanTable(capacity)
+            self._scan_table.clear()
+        
+        self._ble.gap_scan(duration_ms, 30000, 30000)
+    
+    # Stop a scan early without calling its callback
+    def stopScan(self):
+        self._scan_callback = None
+        self._ble.gap_scan(None)
+    
+    # Connect to the specified device (otherwise use cached address from a scan)
+    # profile names one of PROFILES to set how long to look for the device and the connection interval to ask for
+    def connect(self, addr_type=None, addr=None, callback=None, profile=None):
+        # Public addresses have an addr_type of 0, so check against None
+        self._addr_type = addr_type if addr_type is not None else self._addr_type
+        self._addr = bytes(addr) if addr is not None else self._addr
+        self._conn_callback = callback
+        
+        if self._addr_type is None or self._addr is None:
+            return False
+        
+        if profile is None:
+            self._ble.gap_connect(self._addr_type, self._addr)
+        else:
+            _, scan_ms, min_interval_us, max_interval_us = PROFILES[profile]
+            self._ble.gap_connect(self._addr_type, self._addr, scan_ms, min_interval_us, max_interval_us)
+        self._profile = profile
+        return True
+    
+    # Disconnect from current device, or stop trying to connect to it
+    def disconnect(self):
+        # Don't reconnect after a disconnect we asked for
+        self._reconnecting = False
+        self._reconnect_due = False
+        
+        if self._conn_handle is None:
+            if self._addr is not None:
+                try:
+                    # Cancel a gap_connect() still in progress
+                    self._ble.gap_connect(None)
+                except OSError:
+                    pass
+            return
+        
+        self._ble.gap_disconnect(self._conn_handle)
+        if self.writePipeline is not None:
+            self.writePipeline.fail(ENOTCONN)
+        if self.stats is not None:
+            self.stats.disconnected()
+        if self.stream is not None:
+            self.stream._lost(self._conn_handle)
+        self._reset()
+        if self.disconnectCallback:
+            self.disconnectCallback()
+    
+    # Returns true if we've successfully connected and discovered characteristics
+    def isConnected(self):
+        return self._conn_handle is not None and self._value_handle is not None
+    
+    # Largest value that can be written in one packet, or that the peripheral can notify or indicate in one
+    def payloadSize(self):
+        return self._mtu - _ATT_HEADER
+    
+    # Negotiated (interval us, peripheral latency, supervision timeout ms) of the connection. None until
+    # the stack has reported the parameters, which some stacks only do when they change after connecting
+    def connectionParams(self):
+        return self._params
+    
+    # Open an L2CAP channel to the connected peripheral on psm, receiving SDUs of up to mtu bytes, for
+    # streaming bulk data alongside the characteristic. Returns the L2CAPChannel, which calls its
+    # connectCallback once open, or its disconnectCallback with the status if the peripheral refuses it.
+    # Raises OSError(EOPNOTSUPP) if this MicroPython build has no L2CAP channels
+    def openStream(self, psm=L2CAP_PSM, mtu=L2CAP_MTU):
+        if not hasattr(self._ble, "l2cap_connect"):
+            raise OSError(EOPNOTSUPP)
+        if not self.isConnected():
+            raise OSError(ENOTCONN)
+        from .l2cap import L2CAPChannel
+        self.stream = L2CAPChannel(self._ble, psm, mtu)
+        for event in range(_IRQ_L2CAP_ACCEPT, _IRQ_L2CAP_SEND_READY + 1):
+            self._events[event] = self.stream._irq
+        self._ble.l2cap_connect(self._conn_handle, psm, mtu)
+        return self.stream
+
+    # Value handle of the peripheral's characteristic with the UUID given, or None if it doesn't have one
+    def characteristicHandle(self, uuid):
+        return self._characteristics.get(bytes(uuid))
+    
+    # Set the callback passed each value read, notified or indicated from the characteristic with the UUID given
+    def characteristicCallback(self, uuid, callback):
+        self._uuid_callbacks[bytes(uuid)] = callback
+        self._bind_callbacks()
+
+    # Issues an (asynchronous) read of our characteristic or the one with the UUID given, will invoke callback with data
+    def read(self, uuid=None):
+        if not self.isConnected():
+            return
+        
+        value_handle = self._value_handle if uuid is None else self.characteristicHandle(uuid)
+        if value_handle is None:
+            return
+        
+        self._ble.gattc_read(self._conn_handle, value_handle)
+        if self.stats is not None:
+            self.stats.start(_LATENCY_READ)
+    
+    # Issues an (asynchronous) write to our characteristic or the one with the UUID given, optionally receive
+    # acknowledgement from peripheral. Returns True once handed to the stack, or None if not connected.
+    # With a write pipeline, writes to our characteristic are queued and the write id is returned, or 0 if the queue is full
+    def write(self, data, response=False, uuid=None):
+        if not self.isConnected():
+            return
+        
+        value_handle = self._value_handle if uuid is None else self.characteristicHandle(uuid)
+        if value_handle is None:
+            return
+        
+        pipeline = self.writePipeline
+        if pipeline is not None and value_handle == self._value_handle:
+            write_id = pipeline.add(data, response)
+            pipeline.pump()
+            return write_id
+        
+        self._ble.gattc_write(self._conn_handle, value_handle, data, 1 if response else 0)
+        if response and self.stats is not None:
+            self.stats.start(_LATENCY_WRITE)
+        return True
+
+    # Call callback(event, data) for each IRQ event with the number given, after the library has handled it.
+    # Event numbers are the ones the MicroPython bluetooth module uses, and any number of callbacks can be
+    # added for an event. Callbacks run inside the interrupt handler, so copy any data they need to keep.
+    def addEventCallback(self, event, callback):
+        callbacks = self._event_callbacks[event]
+        self._event_callbacks[event] = (callback,) if callbacks is None else callbacks + (callback,)
+        self._set_irq()
+
+    # Stop calling a callback added with addEventCallback for the event number given
+    def removeEventCallback(self, event, callback):
+        callbacks = tuple(c for c in self._event_callbacks[event] or () if c != callback)
+        self._event_callbacks[event] = callbacks or None
+        self._set_irq()
+
+    # Count each IRQ event and the time spent handling it and in callbacks, time reads and writes
+    # with response until they complete, and track connection uptime, see BLEStats. Returns the BLEStats.
+    def collectStats(self):
+        from .stats import BLEStats
+        self.stats = BLEStats()
+        if self._conn_handle is not None:
+            self.stats.connected()
+        self._set_irq()
+        return self.stats
+    
+    # Record the last records events in a ring of preallocated records, each with up to payload bytes
+    # of the event's data, see TraceRecorder. Returns the TraceRecorder.
+    def traceEvents(self, records=64, payload=37):
+        from .trace import TraceRecorder
+        self.tracer = TraceRecorder(records, payload)
+        self._set_irq()
+        return self.tracer
+    
+    # Share the peripheral's clock, which must call syncClock too, see ClockSync. Once connected, poll() writes
+    # a clock sync request every interval_ms until samples replies have arrived, then one every resync_ms to
+    # follow the drift between the clocks. Returns the ClockSync, which is synced after the first reply.
+    def syncClock(self, samples=8, interval_ms=50, resync_ms=5000):
+        from .clock import ClockSync
+        self.clock = ClockSync(samples)
+        self._sync_interval_ms = interval_ms
+        self._resync_ms = resync_ms
+        self._sync_ms = ticks_ms()
+        return self.clock
+    
+    # Write the next clock sync request
+    def _request_sync(self):
+        self.clock._request()
+        self._ble.gattc_write(self._conn_handle, self._value_handle, self.clock._buffer, 0)
+        delay = self._sync_interval_ms if self.clock.count < self.clock.capacity else self._resync_ms
+        self._sync_ms = ticks_add(ticks_ms(), delay)
+    
+    # Queue writes instead of handing them straight to the stack. Up to slots values of up to size bytes
+    # (payloadSize() of our MTU by default) are kept until the stack has room, and at most window
+    # writes with response are waiting for the peripheral at once. A write the stack refuses is tried
+    # again after retry_ms, so call poll() regularly from the main loop. writeResultCallback is passed
+    # (write_id, status, latency_ms) for each write, with the latency from write() to acknowledgement.
+    def pipelineWrites(self, window=4, slots=8, size=None, retry_ms=10):
+        if size is None:
+            size = self._preferred_mtu - _ATT_HEADER
+        self.writePipeline = WritePipeline(self._send_write, self._write_result, window, slots, size, retry_ms)
+    
+    # Keep the peripheral's address and every callback when the connection is lost, and connect to it
+    # again straight away with gap_connect, waiting up to timeout_ms for each attempt. Failed attempts
+    # are retried after an exponential backoff from min_delay_ms to max_delay_ms with random jitter.
+    # After max_failures attempts in a row the central scans for scan_ms to find the peripheral again.
+    # Attempts are made from poll(), and reconnectCallback is passed (elapsed_ms, attempts) once connected.
+    def autoReconnect(self, enabled=True, max_failures=5, min_delay_ms=100, max_delay_ms=5000, timeout_ms=1000, scan_ms=2000):
+        self._auto_reconnect = enabled
+        self._reconnect_max_failures = max_failures
+        self._reconnect_min_ms = min_delay_ms
+        self._reconnect_max_ms = max_delay_ms
+        self._reconnect_timeout_ms = timeout_ms
+        self._reconnect_scan_ms = scan_ms
+        if not enabled:
+            self._reconnecting = False
+            self._reconnect_due = False
+    
+    # Returns true while trying to reconnect to a lost peripheral
+    def isReconnecting(self):
+        return self._reconnecting
+    
+    # Call regularly from the main loop to send pipelined writes the stack had no room for,
+    # to make reconnection attempts, and to send clock sync requests
+    def poll(self):
+        if self._cache_dirty:
+            self._save_cache(None)
+        
+        if self.clock is not None:
+            self.clock._estimate()
+        
+        if self.writePipeline is not None and self.isConnected():
+            self.writePipeline.pump()
+        
+        if self._reconnect_due and ticks_diff(ticks_ms(), self._reconnect_ms) >= 0:
+            self._reconnect()
+        
+        if self.clock is not None and self.isConnected() and ticks_diff(ticks_ms(), self._sync_ms) >= 0:
+            try:
+                self._request_sync()
+            except OSError:
+                # The stack is full, try again on the next poll
+                pass
+    
+    # WritePipeline send function
+    def _send_write(self, data, response):
+        if not self.isConnected():
+            # Rediscovering handles, keep the write queued
+            raise OSError(ENOTCONN)
+        self._ble.gattc_write(self._conn_handle, self._value_handle, data, response)
+        if response and self.stats is not None:
+            self.stats.start(_LATENCY_WRITE)
+    
+    # WritePipeline report function
+    def _write_result(self, write_id, status, latency_ms):
+        if self.writeResultCallback:
+            self.writeResultCallback(write_id, status, latency_ms)
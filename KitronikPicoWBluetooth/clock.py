@@ -0,0 +1,241 @@
+'''
+This code was written and modified by Kitronik Ltd.
+
+Clock sync between the central and the peripheral, imported by syncClock.
+'''
+
+from micropython import const, schedule
+from struct import pack_into, unpack_from
+from array import array
+from time import ticks_us, ticks_diff, ticks_add
+
+'''
+Clock Sync
+'''
+
+# First byte of the clock sync messages sent over the first characteristic. While syncClock is in use,
+# a value of the same length starting with one of these is taken as a clock sync message
+SYNC_REQUEST = const(0xF5)
+SYNC_REPLY = const(0xF6)
+# Request from the central: SYNC_REQUEST, sequence number, central's send time
+# Reply from the peripheral: SYNC_REPLY, sequence number, central's send time, peripheral's receive
+# and send times. All times are ticks_us, little endian
+_SYNC_REQUEST_FORMAT = "<BBI"
+_SYNC_REPLY_FORMAT = "<BBIII"
+_SYNC_REQUEST_SIZE = const(6)
+_SYNC_REPLY_SIZE = const(14)
+# Size of a timestamp written by ClockSync.stamp
+STAMP_SIZE = const(4)
+# Drift is only estimated from samples at least this far apart, and is kept to +/- _MAX_DRIFT_PPM
+_MIN_DRIFT_SPAN_US = const(1000000)
+_MAX_DRIFT_PPM = const(1000)
+
+# A clock shared by a central and a peripheral. The peripheral's ticks_us is the reference, and the central
+# estimates the offset of its own ticks_us from it NTP style: each request carries the central's send time t1,
+# the reply adds the peripheral's receive and send times t2 and t3, and the reply arrives at t4, giving
+#   offset = ((t2 - t1) + (t3 - t4)) / 2    round trip = (t4 - t1) - (t3 - t2)
+# The offset is only exact when both directions take as long, so it is worked out from the samples with the
+# shortest round trip, where the error can be no more than half the round trip. With samples at least a second
+# apart, the drift between the two clocks is estimated with a least squares line through them.
+# now() is then the same on both sides, so a frame stamped by one side gives its one-way latency on the other.
+class ClockSync:
+    def __init__(self, samples=8, reference=False):
+        self.reference = reference
+        self.capacity = samples
+        # Ring of samples: the central's time halfway through the exchange, the offset and the round trip
+        self._times = array("i", [0] * samples)
+        self._offsets = array("i", [0] * samples)
+        self._delays = array("i", [0] * samples)
+        self._next = 0
+        self._seq = 0
+        self._sent_us = 0
+        # The central's next request, or the peripheral's next reply
+        self._buffer = bytearray(_SYNC_REPLY_SIZE if reference else _SYNC_REQUEST_SIZE)
+        
+        # Latency of frames passed to latency(): count, last, lowest, highest and the smoothed
+        # jitter as in RFC 3550, all in us
+        self.latencies = 0
+        self.lastLatency = 0
+        self.minLatency = 0
+        self.maxLatency = 0
+        self.jitter = 0
+        self._latency_sum = 0
+        self._jitter16 = 0
+        # Bound method created once, so scheduling it from the interrupt handler doesn't allocate
+        self._estimate_ref = self._estimate
+        self.reset()
+    
+    # Forget every sample, such as when connecting to another peripheral
+    def reset(self):
+        self.count = 0
+        self._next = 0
+        # Estimate of the peripheral's clock as the offset at _ref_us plus _rate / 2**20 us per us since
+        self._ref_us = 0
+        self._ref_offset = 0
+        self._rate = 0
+        # Offset of the peripheral's clock from ours in us, the drift between them in ppm,
+        # the most the offset can be out by, and the shortest round trip seen
+        self.offset = 0
+        self.drift = 0
+        self.error = 0
+        self.roundTrip = 0
+        self.synced = self.reference
+        # A sample has arrived since the offset and drift were last worked out
+        self._stale = False
+    
+    # Synced time in us, comparable with ticks_diff to now() on the other side
+    def now(self):
+        return self.convert(ticks_us())
+    
+    # Synced time of a ticks_us value taken on this side
+    def convert(self, ticks):
+        if self.reference:
+            return ticks
+        elapsed = ticks_diff(ticks, self._ref_us)
+        return ticks_add(ticks, self._ref_offset + ((elapsed >> 10) * self._rate >> 10))
+    
+    # Write now() into buffer at offset, to send as part of a frame
+    def stamp(self, buffer, offset=0):
+        pack_into("<I", buffer, offset, self.now())
+    
+    # One-way latency in us of a frame stamped by the other side, read from data at offset, added to
+    # the latency counts. received is the ticks_us when the frame arrived, if it is handled later on
+    def latency(self, data, offset=0, received=None):
+        stamp = data[offset] | (data[offset + 1] << 8) | (data[offset + 2] << 16) | (data[offset + 3] << 24)
+        latency = ticks_diff(self.now() if received is None else self.convert(received), stamp)
+        
+        if self.latencies:
+            # RFC 3550 jitter, smoothed over 16 frames and kept times 16 to stay a whole number
+            change = latency - self.lastLatency
+            self._jitter16 += (change if change >= 0 else -change) - ((self._jitter16 + 8) >> 4)
+            self.jitter = self._jitter16 >> 4
+            if latency < self.minLatency:
+                self.minLatency = latency
+            if latency > self.maxLatency:
+                self.maxLatency = latency
+        else:
+            self.minLatency = latency
+            self.maxLatency = latency
+        self.latencies += 1
+        self.lastLatency = latency
+        self._latency_sum += latency
+        return latency
+    
+    # Average one-way latency in us
+    def meanLatency(self):
+        return self._latency_sum // self.latencies if self.latencies else 0
+    
+    # Clear the latency counts
+    def resetLatency(self):
+        self.latencies = 0
+        self.lastLatency = 0
+        self.minLatency = 0
+        self.maxLatency = 0
+        self.jitter = 0
+        self._latency_sum = 0
+        self._jitter16 = 0
+    
+    # Pack the next request into _buffer, just before it is written
+    def _request(self):
+        self._seq = (self._seq + 1) & 0xFF
+        self._sent_us = ticks_us()
+        pack_into(_SYNC_REQUEST_FORMAT, self._buffer, 0, SYNC_REQUEST, self._seq, self._sent_us)
+    
+    # Pack the reply to a request written by a central into _buffer. Returns false if data isn't a request
+    def _reply(self, data):
+        received = ticks_us()
+        if len(data) != _SYNC_REQUEST_SIZE or data[0] != SYNC_REQUEST:
+            return False
+        buffer = self._buffer
+        buffer[0] = SYNC_REPLY
+        # Sequence number and the central's send time, as they were
+        for i in range(1, _SYNC_REQUEST_SIZE):
+            buffer[i] = data[i]
+        pack_into("<II", buffer, 6, received, ticks_us())
+        return True
+    
+    # Add the sample from a reply notified by the peripheral, called from the interrupt handler.
+    # Returns false if data isn't a reply, and ignores replies to anything but the last request
+    def _sample(self, data):
+        received = ticks_us()
+        if len(data) != _SYNC_REPLY_SIZE or data[0] != SYNC_REPLY:
+            return False
+        kind, seq, sent, peer_received, peer_sent = unpack_from(_SYNC_REPLY_FORMAT, data)
+        if seq != self._seq or sent != self._sent_us:
+            return True
+        
+        round_trip = ticks_diff(received, sent)
+        held = ticks_diff(peer_sent, peer_received)
+        # ((t2 - t1) + (t3 - t4)) / 2, arranged so only times from the same clock are subtracted
+        # apart from t2 - t1, which ticks_diff keeps within half the ticks period
+        offset = ticks_diff(peer_received, sent) + (held - round_trip) // 2
+        
+        i = self._next
+        self._times[i] = ticks_add(sent, round_trip // 2)
+        self._offsets[i] = offset
+        self._delays[i] = round_trip - held
+        self._next = (i + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+        
+        # The least squares fit uses floats, which allocate, so it runs outside the interrupt handler
+        self._stale = True
+        try:
+            schedule(self._estimate_ref, None)
+        except RuntimeError:
+            # Schedule queue is full, the central's poll() works it out instead
+            pass
+        return True
+    
+    # Work out the offset and drift from the samples held, if a sample has arrived since the last time
+    def _estimate(self, _=None):
+        if not self._stale:
+            return
+        self._stale = False
+        
+        times = self._times
+        offsets = self._offsets
+        delays = self._delays
+        best = 0
+        for i in range(1, self.count):
+            if delays[i] < delays[best]:
+                best = i
+        
+        # Only use samples with a round trip close to the shortest, the rest are likely to be lopsided
+        limit = 2 * delays[best] + 1000
+        n = 0
+        sum_x = 0
+        sum_y = 0
+        for i in range(self.count):
+            if delays[i] <= limit:
+                n += 1
+                sum_x += ticks_diff(times[i], times[best])
+                sum_y += ticks_diff(offsets[i], offsets[best])
+        mean_x = sum_x / n
+        mean_y = sum_y / n
+        
+        slope = 0
+        low = 0
+        high = 0
+        sxx = 0
+        sxy = 0
+        for i in range(self.count):
+            if delays[i] <= limit:
+                x = ticks_diff(times[i], times[best])
+                low = min(low, x)
+                high = max(high, x)
+                sxx += (x - mean_x) * (x - mean_x)
+                sxy += (x - mean_x) * (ticks_diff(offsets[i], offsets[best]) - mean_y)
+        if high - low >= _MIN_DRIFT_SPAN_US and sxx > 0:
+            slope = max(-_MAX_DRIFT_PPM, min(_MAX_DRIFT_PPM, sxy / sxx * 1000000)) / 1000000
+        
+        # The line through the samples, at the time of the best sample
+        self._ref_us = times[best]
+        self._ref_offset = offsets[best] + int(mean_y - slope * mean_x)
+        self._rate = int(slope * (1 << 20))
+        self.drift = slope * 1000000
+        now = ticks_us()
+        self.offset = ticks_diff(self.convert(now), now)
+        self.roundTrip = delays[best]
+        self.error = (delays[best] + 1) // 2
+        self.synced = True
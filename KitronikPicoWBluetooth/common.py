@@ -0,0 +1,32 @@
+'''
+This code was written and modified by Kitronik Ltd.
+
+Settings shared by the peripheral and the central: our GATT service, the
+connection profiles and the default L2CAP channel settings.
+'''
+
+import bluetooth
+from micropython import const
+
+# Connection profiles trading input latency against power, selected by name on BLEPeripheral and BLECentral.connect
+#   (advertising interval us, connect scan duration ms, min connection interval us, max connection interval us)
+# The peripheral uses the advertising interval, the central picks the connection interval when it connects
+PROFILES = {
+    "gaming": (20000, 2000, 7500, 15000),
+    "balanced": (100000, 2000, 30000, 50000),
+    "low-power": (1000000, 5000, 100000, 200000),
+}
+
+# Connection parameters from _IRQ_CONNECTION_UPDATE as (interval us, peripheral latency, supervision timeout ms),
+# the interval is given in units of 1.25 ms and the timeout in units of 10 ms
+def connection_params(conn_interval, conn_latency, supervision_timeout):
+    return (conn_interval * 1250, conn_latency, supervision_timeout * 10)
+
+# Our BLE GATT Service
+MES_SERVICE_UUID = bluetooth.UUID(0x93AF)
+MES_CHARACTERISTIC_UUID = (bluetooth.UUID(0x5404), bluetooth.FLAG_WRITE | bluetooth.FLAG_WRITE_NO_RESPONSE | bluetooth.FLAG_READ | bluetooth.FLAG_NOTIFY | bluetooth.FLAG_INDICATE,)
+MES_CONTROLLER_SERVICE = (MES_SERVICE_UUID, (MES_CHARACTERISTIC_UUID,),)
+
+# Default L2CAP channel settings, LE PSMs from 0x0080 to 0x00FF are free for applications
+L2CAP_PSM = const(0x0080)
+L2CAP_MTU = const(512)
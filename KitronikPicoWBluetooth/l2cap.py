@@ -0,0 +1,185 @@
+'''
+This code was written and modified by Kitronik Ltd.
+
+L2CAP channel streaming for the peripheral and the central, imported by
+openStream.
+'''
+
+from micropython import const
+from errno import ENOTCONN
+from .common import L2CAP_PSM, L2CAP_MTU
+
+# L2CAP Interrupt Event Numbers
+_IRQ_L2CAP_ACCEPT = const(22)
+_IRQ_L2CAP_CONNECT = const(23)
+_IRQ_L2CAP_DISCONNECT = const(24)
+_IRQ_L2CAP_RECV = const(25)
+_IRQ_L2CAP_SEND_READY = const(26)
+
+'''
+L2CAP Stream
+'''
+
+# L2CAP result refusing a second channel
+_L2CAP_NO_RESOURCES = const(0x0004)
+
+# A connection-oriented L2CAP channel to one peer, for streaming bulk data without the ATT header on
+# every packet or the characteristic's buffer size. write sends SDUs of up to the peer's MTU, copying
+# each into one preallocated buffer, and stops once the stack is out of credits until it reports
+# _IRQ_L2CAP_SEND_READY. Received data stays in the stack until readinto copies it into the caller's
+# buffer, which gives the peer more credits, so a slow reader holds the sender back.
+class L2CAPChannel:
+    def __init__(self, ble, psm=L2CAP_PSM, mtu=L2CAP_MTU):
+        self._ble = ble
+        self.psm = psm
+        self.mtu = mtu
+        self.conn_handle = None
+        self.cid = None
+        self.peer_mtu = 0
+        # Status of the last failed connect, or of the last disconnect
+        self.status = 0
+        
+        # Last SDU sent, kept to send again if the stack's transmit buffer overflowed
+        self._tx = bytearray(mtu)
+        self._tx_view = memoryview(self._tx)
+        self._tx_len = 0
+        self._chunk = 0
+        self._stalled = False
+        self._resend = False
+        
+        # connectCallback() when the channel opens, disconnectCallback(status) when it closes,
+        # and recvCallback() from the interrupt handler when there is data to read
+        self.connectCallback = None
+        self.disconnectCallback = None
+        self.recvCallback = None
+        
+        # Bytes sent and read, and times the stack ran out of credits
+        self.sent = 0
+        self.received = 0
+        self.stalls = 0
+    
+    # Returns true while the channel is open
+    def isOpen(self):
+        return self.cid is not None
+    
+    # Returns true if write can send now
+    def writable(self):
+        return self.cid is not None and not self._stalled
+    
+    # L2CAP events, passed on by the BLEPeripheral or BLECentral interrupt handler
+    def _irq(self, event, data):
+        if event == _IRQ_L2CAP_ACCEPT:
+            # A central wants to open a channel, only one at a time is accepted
+            conn_handle, cid, psm, our_mtu, peer_mtu = data
+            if self.cid is not None or psm != self.psm:
+                return _L2CAP_NO_RESOURCES
+            return 0
+        
+        elif event == _IRQ_L2CAP_CONNECT:
+            conn_handle, cid, psm, our_mtu, peer_mtu = data
+            self.conn_handle = conn_handle
+            self.cid = cid
+            self.peer_mtu = peer_mtu
+            self._chunk = min(peer_mtu, len(self._tx))
+            self.status = 0
+            self._stalled = False
+            self._resend = False
+            if self.connectCallback is not None:
+                self.connectCallback()
+        
+        elif event == _IRQ_L2CAP_DISCONNECT:
+            # The channel has closed, or opening it failed (cid is 0 with a non-zero status)
+            conn_handle, cid, psm, status = data
+            if cid == self.cid or (self.cid is None and psm == self.psm):
+                self._closed(status)
+        
+        elif event == _IRQ_L2CAP_RECV:
+            conn_handle, cid = data
+            if cid == self.cid and self.recvCallback is not None:
+                self.recvCallback()
+        
+        elif event == _IRQ_L2CAP_SEND_READY:
+            conn_handle, cid, status = data
+            if cid == self.cid:
+                self._stalled = False
+                # A non-zero status means the last SDU was lost and has to be sent again
+                self._resend = status != 0
+    
+    def _closed(self, status):
+        self.conn_handle = None
+        self.cid = None
+        self.peer_mtu = 0
+        self.status = status
+        self._stalled = False
+        if self.disconnectCallback is not None:
+            self.disconnectCallback(status)
+    
+    # The connection under the channel has gone
+    def _lost(self, conn_handle):
+        if self.cid is not None and conn_handle == self.conn_handle:
+            self._closed(0)
+    
+    # Send the SDU held in the transmit buffer
+    def _send_tx(self):
+        self._resend = False
+        if not self._ble.l2cap_send(self.conn_handle, self.cid, self._tx_view[: self._tx_len]):
+            # Sent, but nothing more until _IRQ_L2CAP_SEND_READY
+            self._stalled = True
+            self.stalls += 1
+        self.sent += self._tx_len
+    
+    # Send as much of data as the stack takes now, returns the number of bytes sent
+    def write(self, data):
+        if self.cid is None:
+            raise OSError(ENOTCONN)
+        
+        if self._resend and not self._stalled:
+            self.sent -= self._tx_len
+            self._send_tx()
+        
+        view = memoryview(data)
+        n = len(view)
+        offset = 0
+        while offset < n and not self._stalled:
+            size = min(n - offset, self._chunk)
+            self._tx[:size] = view[offset : offset + size]
+            self._tx_len = size
+            self._send_tx()
+            offset += size
+        return offset
+    
+    # Send all of data, calling wait() (such as a short sleep) whenever the stack is out of credits
+    def send(self, data, wait=None):
+        view = memoryview(data)
+        offset = 0
+        while offset < len(view):
+            offset += self.write(view[offset:])
+            if self._stalled and wait is not None:
+                wait()
+    
+    # Number of received bytes waiting to be read
+    def any(self):
+        if self.cid is None:
+            return 0
+        return self._ble.l2cap_recvinto(self.conn_handle, self.cid, None)
+    
+    # Copy received data into buf, returns the number of bytes copied, 0 if there is nothing to read
+    def readinto(self, buf):
+        if self.cid is None:
+            return 0
+        n = self._ble.l2cap_recvinto(self.conn_handle, self.cid, buf)
+        self.received += n
+        return n
+    
+    # Read up to size bytes, or everything waiting, as new bytes
+    def read(self, size=-1):
+        n = self.any()
+        if size >= 0:
+            n = min(n, size)
+        buf = bytearray(n)
+        return bytes(buf[: self.readinto(buf)])
+    
+    # Close the channel, disconnectCallback is called once it has closed
+    def close(self):
+        if self.cid is not None:
+            self._ble.l2cap_disconnect(self.conn_handle, self.cid)
@@ -0,0 +1,409 @@
+'''
+This code was written and modified by Kitronik Ltd.
+
+The central role with several peripherals connected at once.
+
+Large sections of the code is modified code from the MicroPython project examples.
+
+Thank you to the MicroPython project as this library wouldn't have been
+possible without them.
+
+https://github.com/micropython/micropython/blob/master/LICENSE
+'''
+
+from micropython import const
+from time import ticks_ms
+from .common import MES_SERVICE_UUID, MES_CHARACTERISTIC_UUID
+from .adv import has_service
+from .scan import ScanTable
+
+'''
+Bluetooth Low Energy - Central Device with Multiple Peripherals
+'''
+
+# BLE Central Interrupt Event Numbers
+_IRQ_SCAN_RESULT = const(5)
+_IRQ_SCAN_DONE = const(6)
+_IRQ_PERIPHERAL_CONNECT = const(7)
+_IRQ_PERIPHERAL_DISCONNECT = const(8)
+_IRQ_GATTC_SERVICE_RESULT = const(9)
+_IRQ_GATTC_SERVICE_DONE = const(10)
+_IRQ_GATTC_CHARACTERISTIC_RESULT = const(11)
+_IRQ_GATTC_CHARACTERISTIC_DONE = const(12)
+_IRQ_GATTC_READ_RESULT = const(15)
+_IRQ_GATTC_NOTIFY = const(18)
+_IRQ_GATTC_INDICATE = const(19)
+_IRQ_MTU_EXCHANGED = const(21)
+# Size of the dispatch tables, one entry for each event number the bluetooth module can send
+_IRQ_EVENTS = const(32)
+
+# Handle given to _IRQ_PERIPHERAL_DISCONNECT when a gap_connect() fails
+_CONN_HANDLE_NONE = const(0xFFFF)
+
+# Advertise Types
+_ADV_IND = const(0x00)
+_ADV_DIRECT_IND = const(0x01)
+
+# Every connection starts at the default ATT MTU until an exchange raises it,
+# and each notify, indicate or write value fits in the MTU less a 3 byte ATT header
+_DEFAULT_MTU = const(23)
+_ATT_HEADER = const(3)
+
+# Raw bytes of our service UUID, for checking advertise payloads without creating UUID objects
+_MES_SERVICE_BYTES = bytes(MES_SERVICE_UUID)
+
+# A peripheral connected to a BLEMultiCentral
+class BLEConnection:
+    def __init__(self, conn_handle, addr_type, addr, name):
+        self.conn_handle = conn_handle
+        self.addr_type = addr_type
+        self.addr = addr
+        self.name = name
+        
+        # Discovered handles, the connection is ready once value_handle is set
+        self.start_handle = None
+        self.end_handle = None
+        self.value_handle = None
+        # Negotiated MTU, the largest value in one packet is mtu - 3 bytes
+        self.mtu = _DEFAULT_MTU
+        
+        # Callbacks for this connection only, these take priority over the BLEMultiCentral callbacks
+        self.readCallback = None
+        self.notifyCallback = None
+        self.indicateCallback = None
+        
+        # Connection statistics
+        self.connected_ms = ticks_ms()
+        self.reads = 0
+        self.writes = 0
+        self.notifications = 0
+        self.indications = 0
+
+    # Returns true once the characteristic has been discovered
+    def isReady(self):
+        return self.value_handle is not None
+    
+    # Largest value that can be written, notified or indicated in one packet
+    def payloadSize(self):
+        return self.mtu - _ATT_HEADER
+
+class BLEMultiCentral:
+    # Initialise BLE, connecting to at most max_connections peripherals with at most
+    # max_pending gap_connect calls in progress at once, and asking each for an ATT MTU of up to mtu bytes
+    def __init__(self, ble, max_connections=4, max_pending=1, mtu=247):
+        self._ble = ble
+        self._ble.active(True)
+        self._ble.config(mtu=mtu)
+        
+        # Handler for each event number, bound once here so _irq doesn't create a bound method for each event
+        self._events = [None] * _IRQ_EVENTS
+        self._events[_IRQ_SCAN_RESULT] = self._on_scan_result
+        self._events[_IRQ_SCAN_DONE] = self._on_scan_done
+        self._events[_IRQ_PERIPHERAL_CONNECT] = self._on_connect
+        self._events[_IRQ_PERIPHERAL_DISCONNECT] = self._on_disconnect
+        self._events[_IRQ_GATTC_SERVICE_RESULT] = self._on_service_result
+        self._events[_IRQ_GATTC_SERVICE_DONE] = self._on_service_done
+        self._events[_IRQ_GATTC_CHARACTERISTIC_RESULT] = self._on_characteristic_result
+        self._events[_IRQ_GATTC_CHARACTERISTIC_DONE] = self._on_characteristic_done
+        self._events[_IRQ_GATTC_READ_RESULT] = self._on_read_result
+        self._events[_IRQ_GATTC_NOTIFY] = self._on_notify
+        self._events[_IRQ_GATTC_INDICATE] = self._on_indicate
+        self._events[_IRQ_MTU_EXCHANGED] = self._on_mtu_exchanged
+        # Callbacks added for each event number with addEventCallback, a tuple or None
+        self._event_callbacks = [None] * _IRQ_EVENTS
+        self._ble.irq(self._irq)
+        
+        self._preferred_mtu = mtu
+        self.max_connections = max_connections
+        self.max_pending = max_pending
+        self.min_rssi = -127
+        
+        # Connection table, keyed by conn_handle
+        self._connections = {}
+        # Devices heard during a scan, devices waiting to be connected, and devices with a connect in progress
+        self._scan_table = ScanTable(2 * max_connections)
+        self._candidates = []
+        self._pending = []
+        self.failedConnects = 0
+        
+        # Callbacks for completion of various operations
+        # Data callbacks are passed the BLEConnection as well as the value
+        self._scan_callback = None
+        self.connectCallback = None
+        self.disconnectCallback = None
+        self.readCallback = None
+        self.notifyCallback = None
+        self.indicateCallback = None
+
+    # BLE event interrupt handler. Each event goes to its handler in the dispatch table, apart from
+    # notifications and scan results, the most frequent events, which are tested for first and go
+    # straight to their handler.
+    def _irq(self, event, data):
+        if event == _IRQ_GATTC_NOTIFY:
+            return self._on_notify(event, data)
+        if event == _IRQ_SCAN_RESULT:
+            return self._on_scan_result(event, data)
+        if event < _IRQ_EVENTS:
+            handler = self._events[event]
+            if handler is not None:
+                return handler(event, data)
+
+    # Interrupt handler used while there are callbacks added with addEventCallback, so _irq doesn't look
+    # for callbacks on every event when there are none
+    def _irq_callbacks(self, event, data):
+        result = self._irq(event, data)
+        if event < _IRQ_EVENTS:
+            callbacks = self._event_callbacks[event]
+            if callbacks is not None:
+                for callback in callbacks:
+                    callback(event, data)
+        return result
+
+    # A single scan result
+    def _on_scan_result(self, event, data):
+        addr_type, addr, adv_type, rssi, adv_data = data
+        
+        if adv_type in (_ADV_IND, _ADV_DIRECT_IND) and rssi >= self.min_rssi and has_service(adv_data, _MES_SERVICE_BYTES) and not self._known(addr):
+            # Found a device, remember it until the scan is over
+            self._scan_table.update(addr_type, addr, rssi, adv_data)
+
+    # Scan duration finished or manually stopped, the strongest devices are connected first
+    def _on_scan_done(self, event, data):
+        for device in self._scan_table.ranked(self.min_rssi):
+            self._candidates.append(device[:3])
+        self._scan_table.clear()
+        
+        if self._scan_callback:
+            callback = self._scan_callback
+            self._scan_callback = None
+            callback(self._candidates)
+
+    # A successful gap_connect()
+    def _on_connect(self, event, data):
+        conn_handle, addr_type, addr = data
+        
+        pending = self._take_pending(addr)
+        if pending is not None:
+            conn = BLEConnection(conn_handle, addr_type, pending[1], pending[2])
+            self._connections[conn_handle] = conn
+            self._ble.gattc_discover_services(conn_handle)
+        
+        self._connect_next()
+
+    # Connected peripheral has disconnected, or a gap_connect() failed
+    def _on_disconnect(self, event, data):
+        conn_handle, addr_type, addr = data
+        conn = self._connections.pop(conn_handle, None)
+        
+        if conn is not None:
+            if conn.isReady() and self.disconnectCallback:
+                self.disconnectCallback(conn)
+        elif conn_handle == _CONN_HANDLE_NONE and self._take_pending(addr) is not None:
+            self.failedConnects += 1
+        
+        self._connect_next()
+
+    # Called for each service found by gattc_discover_services()
+    def _on_service_result(self, event, data):
+        conn_handle, start_handle, end_handle, uuid = data
+        conn = self._connections.get(conn_handle)
+        
+        if conn is not None and uuid == MES_SERVICE_UUID:
+            conn.start_handle, conn.end_handle = start_handle, end_handle
+
+    # Called once service discovery is complete
+    def _on_service_done(self, event, data):
+        conn_handle, status = data
+        conn = self._connections.get(conn_handle)
+        
+        if conn is not None:
+            if conn.start_handle and conn.end_handle:
+                self._ble.gattc_discover_characteristics(conn_handle, conn.start_handle, conn.end_handle)
+            else:
+                # Not the device we were looking for, let another one have the slot
+                self._ble.gap_disconnect(conn_handle)
+
+    # Called for each characteristic found by gattc_discover_services()
+    def _on_characteristic_result(self, event, data):
+        conn_handle, end_handle, value_handle, properties, uuid = data
+        conn = self._connections.get(conn_handle)
+        
+        if conn is not None and uuid == MES_CHARACTERISTIC_UUID[0]:
+            conn.value_handle = value_handle
+
+    # Called once service characteristic discovery is complete
+    def _on_characteristic_done(self, event, data):
+        conn_handle, status = data
+        conn = self._connections.get(conn_handle)
+        
+        if conn is not None:
+            if conn.value_handle:
+                if self._preferred_mtu > _DEFAULT_MTU:
+                    try:
+                        self._ble.gattc_exchange_mtu(conn_handle)
+                    except OSError:
+                        # Keep the default MTU
+                        pass
+                # This connection is ready, fire the connect callback
+                if self.connectCallback:
+                    self.connectCallback(conn)
+            else:
+                self._ble.gap_disconnect(conn_handle)
+
+    # A gattc_read() has completed
+    def _on_read_result(self, event, data):
+        conn_handle, value_handle, char_data = data
+        conn = self._connections.get(conn_handle)
+        
+        if conn is not None and value_handle == conn.value_handle:
+            conn.reads += 1
+            if conn.readCallback:
+                conn.readCallback(char_data)
+            elif self.readCallback:
+                self.readCallback(conn, char_data)
+
+    # A server has sent a notify request
+    def _on_notify(self, event, data):
+        conn_handle, value_handle, notify_data = data
+        conn = self._connections.get(conn_handle)
+        
+        if conn is not None and value_handle == conn.value_handle:
+            conn.notifications += 1
+            if conn.notifyCallback:
+                conn.notifyCallback(notify_data)
+            elif self.notifyCallback:
+                self.notifyCallback(conn, notify_data)
+
+    # A server has sent an indicate request
+    def _on_indicate(self, event, data):
+        conn_handle, value_handle, notify_data = data
+        conn = self._connections.get(conn_handle)
+        
+        if conn is not None and value_handle == conn.value_handle:
+            conn.indications += 1
+            if conn.indicateCallback:
+                conn.indicateCallback(notify_data)
+            elif self.indicateCallback:
+                self.indicateCallback(conn, notify_data)
+
+    # An MTU exchange has completed
+    def _on_mtu_exchanged(self, event, data):
+        conn_handle, mtu = data
+        conn = self._connections.get(conn_handle)
+        
+        if conn is not None:
+            conn.mtu = mtu
+
+    # Returns true if addr is already connected, connecting or waiting to be connected
+    # Devices heard again during a scan are handled by the scan table
+    def _known(self, addr):
+        for device in self._candidates:
+            if device[1] == addr:
+                return True
+        for device in self._pending:
+            if device[1] == addr:
+                return True
+        for conn in self._connections.values():
+            if conn.addr == addr:
+                return True
+        return False
+
+    # Remove and return the device with a connect in progress to addr
+    def _take_pending(self, addr):
+        for i in range(len(self._pending)):
+            if self._pending[i][1] == addr:
+                return self._pending.pop(i)
+        return None
+
+    # Start connecting to waiting devices while there is room for more connections
+    def _connect_next(self):
+        while self._candidates and len(self._pending) < self.max_pending and len(self._pending) + len(self._connections) < self.max_connections:
+            device = self._candidates.pop(0)
+            try:
+                self._ble.gap_connect(device[0], device[1])
+            except OSError:
+                # The stack is busy, try again when the next connect finishes
+                self._candidates.insert(0, device)
+                return
+            self._pending.append(device)
+
+    # Find every device advertising our service, ignoring devices weaker than min_rssi.
+    # callback is passed the list of devices found as (addr_type, addr, name) tuples, strongest first.
+    def scan(self, callback=None, duration_ms=2000, min_rssi=-127):
+        self._candidates = []
+        self._scan_table.clear()
+        self._scan_callback = callback
+        self.min_rssi = min_rssi
+        self._ble.gap_scan(duration_ms, 30000, 30000)
+    
+    # Connect to every device found by the last scan, plus the device given
+    def connectAll(self, addr_type=None, addr=None):
+        if addr_type is not None and addr is not None and not self._known(addr):
+            self._candidates.append((addr_type, bytes(addr), "?"))
+        self._connect_next()
+    
+    # Disconnect from one device, or from every device
+    def disconnect(self, conn_handle=None):
+        if conn_handle is None:
+            for conn_handle in list(self._connections):
+                self._ble.gap_disconnect(conn_handle)
+            self._candidates = []
+        else:
+            self._ble.gap_disconnect(conn_handle)
+    
+    # Returns the ready connection for conn_handle, or None
+    def connection(self, conn_handle):
+        conn = self._connections.get(conn_handle)
+        return conn if conn is not None and conn.isReady() else None
+    
+    # Returns a list of every ready connection
+    def connections(self):
+        return [conn for conn in self._connections.values() if conn.isReady()]
+    
+    # Returns true if conn_handle is ready, or if any connection is ready
+    def isConnected(self, conn_handle=None):
+        if conn_handle is not None:
+            return self.connection(conn_handle) is not None
+        for conn in self._connections.values():
+            if conn.isReady():
+                return True
+        return False
+    
+    # Issues an (asynchronous) read from one device, will invoke callback with data
+    def read(self, conn_handle):
+        conn = self.connection(conn_handle)
+        if conn is None:
+            return
+        
+        self._ble.gattc_read(conn_handle, conn.value_handle)
+    
+    # Issues an (asynchronous) write to one device, optionally receive acknowledgement from peripheral.
+    # Returns True once handed to the stack, or None if the device isn't connected
+    def write(self, conn_handle, data, response=False):
+        conn = self.connection(conn_handle)
+        if conn is None:
+            return
+        
+        conn.writes += 1
+        self._ble.gattc_write(conn_handle, conn.value_handle, data, 1 if response else 0)
+        return True
+    
+    # Write the same value to every connected device
+    def writeAll(self, data, response=False):
+        for conn in self.connections():
+            conn.writes += 1
+            self._ble.gattc_write(conn.conn_handle, conn.value_handle, data, 1 if response else 0)
+    
+    # Call callback(event, data) for each IRQ event with the number given, after the library has handled it.
+    # Event numbers are the ones the MicroPython bluetooth module uses, and any number of callbacks can be
+    # added for an event. Callbacks run inside the interrupt handler, so copy any data they need to keep.
+    def addEventCallback(self, event, callback):
+        callbacks = self._event_callbacks[event]
+        self._event_callbacks[event] = (callback,) if callbacks is None else callbacks + (callback,)
+        self._ble.irq(self._irq_callbacks)
+    
+    # Stop calling a callback added with addEventCallback for the event number given
+    def removeEventCallback(self, event, callback):
+        callbacks = tuple(c for c in self._event_callbacks[event] or () if c != callback)
+        self._event_callbacks[event] = callbacks or None
+        self._ble.irq(self._irq_callbacks if any(self._event_callbacks) else self._irq)
@@ -0,0 +1,857 @@
+'''
+This code was written and modified by Kitronik Ltd.
+
+The peripheral role: a GATT server that advertises our service and notifies
+or indicates the centrals connected to it.
+
+Large sections of the code is modified code from the MicroPython project examples.
+
+Thank you to the MicroPython project as this library wouldn't have been
+possible without them.
+
+https://github.com/micropython/micropython/blob/master/LICENSE
+'''
+
+import bluetooth
+from micropython import const, schedule
+from array import array
+from time import ticks_ms, ticks_us, ticks_diff
+from errno import EOPNOTSUPP
+from .common import PROFILES, connection_params, MES_SERVICE_UUID, MES_CHARACTERISTIC_UUID, L2CAP_PSM, L2CAP_MTU
+from .adv import advertising_payload, ADVERTISE_APPEARANCE_GAMEPAD
+
+'''
+Bluetooth Low Energy - Peripheral Device
+'''
+
+# BLE Peripheral Interrupt Event Numbers
+_IRQ_CENTRAL_CONNECT = const(1)
+_IRQ_CENTRAL_DISCONNECT = const(2)
+_IRQ_GATTS_WRITE = const(3)
+_IRQ_GATTS_READ_REQUEST = const(4)
+_IRQ_GATTS_INDICATE_DONE = const(20)
+_IRQ_MTU_EXCHANGED = const(21)
+_IRQ_L2CAP_ACCEPT = const(22)
+_IRQ_L2CAP_CONNECT = const(23)
+_IRQ_L2CAP_DISCONNECT = const(24)
+_IRQ_L2CAP_RECV = const(25)
+_IRQ_L2CAP_SEND_READY = const(26)
+_IRQ_CONNECTION_UPDATE = const(27)
+# Size of the dispatch tables, one entry for each event number the bluetooth module can send
+_IRQ_EVENTS = const(32)
+
+# Every connection starts at the default ATT MTU until an exchange raises it,
+# and each notify, indicate or write value fits in the MTU less a 3 byte ATT header
+_DEFAULT_MTU = const(23)
+_ATT_HEADER = const(3)
+
+# Advertising interval when no profile is given
+_DEFAULT_ADV_INTERVAL_US = const(500000)
+
+# LATENCY_INDICATE from .stats, without importing it until collectStats is called
+_LATENCY_INDICATE = const(0)
+
+'''
+Notify and Indicate Send Queue
+'''
+
+# Send queue modes
+QUEUE_LATEST = const(0)  # A newer value replaces the one waiting to be sent
+QUEUE_PACK = const(1)    # Values are packed into one payload, each after a 1 byte length
+
+# Holds the values waiting to be notified and indicated until the next flush.
+# Each kind has one preallocated payload buffer of size bytes. Payloads are kept to limit bytes,
+# which follows the smallest negotiated MTU so a payload always fits in a single packet.
+class SendQueue:
+    def __init__(self, mode=QUEUE_LATEST, size=20, interval_ms=30):
+        self.mode = mode
+        self.size = size
+        self.limit = size
+        self.interval_ms = interval_ms
+        # Index 0 holds notifications and index 1 holds indications
+        self._buffers = (bytearray(size), bytearray(size))
+        self._views = (memoryview(self._buffers[0]), memoryview(self._buffers[1]))
+        self._lengths = array("H", [0, 0])
+        self._frames = array("H", [0, 0])
+        # Frames handed to the stack, replaced by a newer frame, or lost
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    # Add a value to be sent on the next flush
+    def add(self, value, indicate=False):
+        kind = 1 if indicate else 0
+        n = len(value)
+        
+        if self.mode == QUEUE_PACK:
+            used = self._lengths[kind]
+            if used + n + 1 > self.limit:
+                # No room left in this payload
+                self.dropped += 1
+                return False
+            
+            self._buffers[kind][used] = n
+            self._buffers[kind][used + 1 : used + 1 + n] = value
+            self._lengths[kind] = used + 1 + n
+            self._frames[kind] += 1
+            return True
+        
+        if n > self.limit:
+            self.dropped += 1
+            return False
+        
+        if self._frames[kind]:
+            # Latest wins, the waiting value is never sent
+            self.coalesced += 1
+        
+        self._buffers[kind][:n] = value
+        self._lengths[kind] = n
+        self._frames[kind] = 1
+        return True
+
+    # Returns true if there is a value waiting to be sent
+    def pending(self, indicate=False):
+        return self._frames[1 if indicate else 0] > 0
+
+    # Memoryview of the waiting payload, only valid until the next add
+    def payload(self, indicate=False):
+        kind = 1 if indicate else 0
+        return self._views[kind][:self._lengths[kind]]
+
+    # Empty the waiting payload once it has been sent or failed to send
+    def clear(self, indicate=False, sent=True):
+        kind = 1 if indicate else 0
+        if sent:
+            self.sent += self._frames[kind]
+        else:
+            self.dropped += self._frames[kind]
+        self._lengths[kind] = 0
+        self._frames[kind] = 0
+
+'''
+Broadcast Peer Table
+'''
+
+# Subscription bits written by a central to a characteristic's CCCD, which is the handle after its value
+SUBSCRIBE_NOTIFY = const(0x01)
+SUBSCRIBE_INDICATE = const(0x02)
+_NO_PEER = const(0xFFFF)
+
+# Connected centrals held in preallocated slots, so the interrupt handler only ever changes one slot
+# and a broadcast from the main loop can walk every slot while centrals connect and disconnect.
+# Each slot has the central's conn_handle, its subscriptions, whether it is waiting to acknowledge
+# an indication, and which sends it has missed because the stack had no room for it.
+class PeerTable:
+    def __init__(self, capacity=4, subscribed=SUBSCRIBE_NOTIFY | SUBSCRIBE_INDICATE):
+        self.capacity = capacity
+        # Subscriptions of a central that hasn't written the CCCD
+        self.subscribed = subscribed
+        self.handles = array("H", [_NO_PEER] * capacity)
+        self.subscriptions = bytearray(capacity)
+        self.indicating = bytearray(capacity)
+        # SUBSCRIBE_NOTIFY and SUBSCRIBE_INDICATE bits of sends still owed to each central
+        self.behind = bytearray(capacity)
+        # Values sent to each central, and sends put off because the stack was full or an indication was unacknowledged
+        self.sent = array("I", [0] * capacity)
+        self.deferred = array("I", [0] * capacity)
+        self.count = 0
+        # Centrals that connected while every slot was in use, they aren't broadcast to
+        self.overflow = 0
+
+    # Slot of a central, or -1 if it hasn't got one
+    def find(self, conn_handle):
+        for i in range(self.capacity):
+            if self.handles[i] == conn_handle:
+                return i
+        return -1
+
+    # Give a newly connected central a slot, returns the slot or -1 if the table is full
+    def add(self, conn_handle):
+        i = self.find(_NO_PEER)
+        if i < 0:
+            self.overflow += 1
+            return -1
+        self.subscriptions[i] = self.subscribed
+        self.indicating[i] = 0
+        self.behind[i] = 0
+        self.sent[i] = 0
+        self.deferred[i] = 0
+        self.handles[i] = conn_handle
+        self.count += 1
+        return i
+
+    # Free a disconnected central's slot
+    def remove(self, conn_handle):
+        i = self.find(conn_handle)
+        if i >= 0:
+            self.handles[i] = _NO_PEER
+            self.count -= 1
+
+    # Record a CCCD value written by a central
+    def subscribe(self, conn_handle, value):
+        i = self.find(conn_handle)
+        if i >= 0:
+            self.subscriptions[i] = value & (SUBSCRIBE_NOTIFY | SUBSCRIBE_INDICATE)
+            # Nothing is owed for a subscription that has been turned off
+            self.behind[i] &= self.subscriptions[i]
+
+'''
+GATT Table
+'''
+
+_FLAGS_WRITABLE = const(0x000C)  # bluetooth.FLAG_WRITE | bluetooth.FLAG_WRITE_NO_RESPONSE
+
+# A characteristic in a BLEPeripheral's GATT table. size is the most bytes a central can write to it,
+# which grows to fit the negotiated MTU. readCallback() returns the value for each read request and
+# writeCallback(value) is passed each value written; without them the BLEPeripheral callbacks are used.
+# handle is set once the table has been registered.
+class Characteristic:
+    def __init__(self, uuid, flags=MES_CHARACTERISTIC_UUID[1], size=20, readCallback=None, writeCallback=None):
+        self.uuid = uuid if isinstance(uuid, bluetooth.UUID) else bluetooth.UUID(uuid)
+        self.flags = flags
+        self.size = size
+        self.readCallback = readCallback
+        self.writeCallback = writeCallback
+        self.handle = None
+
+# A service in a BLEPeripheral's GATT table, holding a list of Characteristics
+class Service:
+    def __init__(self, uuid, characteristics):
+        self.uuid = uuid if isinstance(uuid, bluetooth.UUID) else bluetooth.UUID(uuid)
+        self.characteristics = characteristics
+
+    # Definition passed to gatts_register_services
+    def _definition(self):
+        return (self.uuid, tuple((c.uuid, c.flags) for c in self.characteristics))
+
+class BLEPeripheral:
+    # Initialise BLE and advertise our service, offering centrals an ATT MTU of up to mtu bytes.
+    # services is a list of Services to register instead of our single service and characteristic.
+    # The first characteristic of the first service is used by notify, indicate and the send queue,
+    # and the first service is advertised.
+    # profile names one of PROFILES to set how often we advertise, otherwise every 500 ms.
+    def __init__(self, ble, name="mpy-peripheral", mtu=247, services=None, profile=None):
+        self._ble = ble
+        self._ble.active(True)
+        self._ble.config(mtu=mtu)
+        
+        # Handler for each event number, bound once here so _irq doesn't create a bound method for each event
+        self._events = [None] * _IRQ_EVENTS
+        self._events[_IRQ_CENTRAL_CONNECT] = self._on_connect
+        self._events[_IRQ_CENTRAL_DISCONNECT] = self._on_disconnect
+        self._events[_IRQ_GATTS_WRITE] = self._on_write
+        self._events[_IRQ_GATTS_READ_REQUEST] = self._on_read_request
+        self._events[_IRQ_GATTS_INDICATE_DONE] = self._on_indicate_done
+        self._events[_IRQ_MTU_EXCHANGED] = self._on_mtu_exchanged
+        self._events[_IRQ_CONNECTION_UPDATE] = self._on_connection_update
+        # Callbacks added for each event number with addEventCallback, a tuple or None
+        self._event_callbacks = [None] * _IRQ_EVENTS
+        # _irq, or _irq_callbacks once there are callbacks, see _set_irq
+        self._dispatch = self._irq
+        self._ble.irq(self._irq)
+        
+        if services is None:
+            services = [Service(MES_SERVICE_UUID, [Characteristic(MES_CHARACTERISTIC_UUID[0], MES_CHARACTERISTIC_UUID[1], 64)])]
+        self.services = services
+        # Characteristic of each value handle, for dispatching reads and writes
+        self._handlers = {}
+        self._register()
+        self._handle = services[0].characteristics[0].handle
+        
+        self._connections = set()
+        # Negotiated MTU of each connection, keyed by conn_handle
+        self._mtus = {}
+        self._preferred_mtu = mtu
+        self._buffer_payload = 0
+        # Connection parameters reported for each connection, keyed by conn_handle
+        self._params = {}
+        self._adv_interval_us = PROFILES[profile][0] if profile is not None else _DEFAULT_ADV_INTERVAL_US
+        self._payload = advertising_payload(name=name, services=[services[0].uuid], appearance=ADVERTISE_APPEARANCE_GAMEPAD)
+        self._advertise()
+        
+        # Connected device callbacks
+        self.readCallback = None
+        self.writeCallback = None
+        self.connectCallback = None
+        self.disconnectCallback = None
+        
+        # Optional ring buffer for writes from centrals, see bufferWrites
+        self.writeBuffer = None
+        self._schedule_writes = False
+        self._drain_pending = False
+        # Bound method created once, so scheduling it from the interrupt handler doesn't allocate
+        self._drain_ref = self._drain
+        
+        # Optional queue for notify and indicate, see queueSends
+        self.sendQueue = None
+        self._last_flush = ticks_ms()
+        # Centrals that haven't acknowledged our last indication yet
+        self._indicating = set()
+        
+        # Optional per-central broadcast of the first characteristic, see broadcast
+        self.peers = None
+        self._cccd = None
+        
+        # Optional L2CAP channel, see openStream
+        self.stream = None
+        
+        # Optional counts and timings, see collectStats
+        self.stats = None
+        # Optional record of recent events, see traceEvents
+        self.tracer = None
+        # Optional clock shared with centrals, see syncClock
+        self.clock = None
+        
+        # Time each value was last written by setValue or a readCallback, keyed by value handle, see cacheReads
+        self._cache_reads = False
+        self._max_age_ms = None
+        self._written_ms = {}
+    
+    # Register the GATT table, sizing each characteristic's buffer and filling in its handle
+    def _register(self):
+        handles = self._ble.gatts_register_services(tuple(service._definition() for service in self.services))
+        
+        for service, service_handles in zip(self.services, handles):
+            for characteristic, handle in zip(service.characteristics, service_handles):
+                characteristic.handle = handle
+                self._handlers[handle] = characteristic
+                if characteristic.flags & _FLAGS_WRITABLE:
+                    self._ble.gatts_set_buffer(handle, characteristic.size)
+    
+    # Advertise our service so the central device can scan for it
+    def _advertise(self):
+        self._ble.gap_advertise(self._adv_interval_us, adv_data=self._payload)
+    
+    # BLE event interrupt handler. Each event goes to its handler in the dispatch table, apart from
+    # writes, the most frequent event, which are tested for first and go straight to their handler.
+    def _irq(self, event, data):
+        if event == _IRQ_GATTS_WRITE:
+            return self._on_write(event, data)
+        if event < _IRQ_EVENTS:
+            handler = self._events[event]
+            if handler is not None:
+                return handler(event, data)
+
+    # Interrupt handler used while there are callbacks added with addEventCallback, so _irq doesn't look
+    # for callbacks on every event when there are none
+    def _irq_callbacks(self, event, data):
+        result = self._irq(event, data)
+        if event < _IRQ_EVENTS:
+            callbacks = self._event_callbacks[event]
+            if callbacks is not None:
+                for callback in callbacks:
+                    callback(event, data)
+        return result
+    
+    # A central has connected to this peripheral
+    def _on_connect(self, event, data):
+        conn_handle, addr_type, addr = data
+        self._connections.add(conn_handle)
+        self._mtus[conn_handle] = _DEFAULT_MTU
+        if self.peers is not None:
+            self.peers.add(conn_handle)
+            if self.peers.count < self.peers.capacity:
+                # Keep advertising so more centrals can connect
+                self._advertise()
+        if self.stats is not None and len(self._connections) == 1:
+            self.stats.connected()
+        self._update_limit()
+        
+        if self.connectCallback is not None:
+            self.connectCallback(conn_handle)
+    
+    # A central has disconnected from this peripheral
+    def _on_disconnect(self, event, data):
+        conn_handle, addr_type, addr = data
+        self._connections.remove(conn_handle)
+        self._mtus.pop(conn_handle, None)
+        self._params.pop(conn_handle, None)
+        self._indicating.discard(conn_handle)
+        if self.peers is not None:
+            self.peers.remove(conn_handle)
+        if self.stream is not None:
+            self.stream._lost(conn_handle)
+        self._update_limit()
+        if self.stats is not None and not self._connections:
+            self.stats.disconnected()
+        
+        # Start advertising again to allow a new connection
+        self._advertise()
+        
+        if self.disconnectCallback is not None:
+            self.disconnectCallback(conn_handle)
+    
+    # A client has written to this characteristic or descriptor. Called straight from _irq, and only reads the
+    # connection handle when it is needed
+    def _on_write(self, event, data):
+        attr_handle = data[1]
+        
+        if attr_handle == self._cccd:
+            # A central has subscribed or unsubscribed, this isn't a value for writeCallback
+            self.peers.subscribe(data[0], self._ble.gatts_read(attr_handle)[0])
+        
+        elif self.clock is not None and attr_handle == self._handle and self.clock._reply(self._ble.gatts_read(attr_handle)):
+            # A clock sync request, answered straight away to keep the times accurate
+            try:
+                self._ble.gatts_notify(data[0], attr_handle, self.clock._buffer)
+            except OSError:
+                # The stack is full, the central will send another request
+                pass
+        
+        elif self.writeBuffer is not None:
+            # Copy the value into a free slot, writeCallback runs later outside the interrupt handler
+            self.writeBuffer.put(data[0], attr_handle, self._ble.gatts_read(attr_handle))
+            
+            if self._schedule_writes and not self._drain_pending:
+                try:
+                    schedule(self._drain_ref, None)
+                    self._drain_pending = True
+                except RuntimeError:
+                    # Schedule queue is full, the next write will try again
+                    pass
+        
+        else:
+            callback = self._write_callback(attr_handle)
+            if callback is not None:
+                # Process the value written inside writeCallback
+                self._callback(callback, self._ble.gatts_read(attr_handle))
+    
+    # A client has issued a read
+    def _on_read_request(self, event, data):
+        conn_handle, attr_handle = data
+        
+        callback = self._read_callback(attr_handle)
+        if callback is not None and not self._fresh(attr_handle):
+            # Write the value returned by readCallback, ready for a central to read
+            if self.stats is None:
+                self._ble.gatts_write(attr_handle, callback())
+            else:
+                start = ticks_us()
+                value = callback()
+                self.stats.callback(ticks_diff(ticks_us(), start))
+                self._ble.gatts_write(attr_handle, value)
+            
+            if self._cache_reads:
+                self._written_ms[attr_handle] = ticks_ms()
+    
+    # A client has acknowledged the indication
+    def _on_indicate_done(self, event, data):
+        conn_handle, value_handle, status = data
+        # Allow the next queued indication to be sent
+        self._indicating.discard(conn_handle)
+        if self.peers is not None:
+            i = self.peers.find(conn_handle)
+            if i >= 0:
+                self.peers.indicating[i] = 0
+        if self.stats is not None:
+            self.stats.finish(_LATENCY_INDICATE)
+    
+    # A central has negotiated a new MTU
+    def _on_mtu_exchanged(self, event, data):
+        conn_handle, mtu = data
+        
+        if conn_handle in self._mtus:
+            self._mtus[conn_handle] = mtu
+            self._resize_buffers()
+            self._update_limit()
+    
+    # The central has changed the connection parameters
+    def _on_connection_update(self, event, data):
+        conn_handle, conn_interval, conn_latency, supervision_timeout, status = data
+        
+        if status == 0 and conn_handle in self._connections:
+            self._params[conn_handle] = connection_params(conn_interval, conn_latency, supervision_timeout)
+    
+    # Give the stack the interrupt handler for the features turned on
+    def _set_irq(self):
+        self._dispatch = self._irq_callbacks if any(self._event_callbacks) else self._irq
+        if self.tracer is not None:
+            self._ble.irq(self._irq_traced)
+        elif self.stats is not None:
+            self._ble.irq(self._irq_timed)
+        else:
+            self._ble.irq(self._dispatch)
+
+    # Interrupt handler used once collectStats is called, counts and times each event
+    def _irq_timed(self, event, data):
+        start = ticks_us()
+        result = self._dispatch(event, data)
+        self.stats.irq(event, ticks_diff(ticks_us(), start))
+        return result
+    
+    # Interrupt handler used once traceEvents is called, records each event before handling it
+    def _irq_traced(self, event, data):
+        if event == _IRQ_GATTS_WRITE:
+            # The value written isn't in the event's data, so record it from the attribute
+            self.tracer.record(event, data, self._ble.gatts_read(data[1]))
+        else:
+            self.tracer.record(event, data)
+        if self.stats is not None:
+            return self._irq_timed(event, data)
+        return self._dispatch(event, data)
+    
+    # Run a user callback with the value given, timing it when collecting stats
+    def _callback(self, callback, value):
+        if self.stats is None:
+            return callback(value)
+        start = ticks_us()
+        result = callback(value)
+        self.stats.callback(ticks_diff(ticks_us(), start))
+        return result
+    
+    # Returns true if the value in the attribute can be read without calling readCallback
+    def _fresh(self, attr_handle):
+        if not self._cache_reads:
+            return False
+        written = self._written_ms.get(attr_handle)
+        if written is None:
+            # Never written, or invalidated
+            return False
+        return self._max_age_ms is None or ticks_diff(ticks_ms(), written) < self._max_age_ms
+    
+    # The callbacks for reads and writes of a characteristic, its own or else the peripheral's
+    def _read_callback(self, attr_handle):
+        characteristic = self._handlers.get(attr_handle)
+        if characteristic is not None and characteristic.readCallback is not None:
+            return characteristic.readCallback
+        return self.readCallback
+    
+    def _write_callback(self, attr_handle):
+        characteristic = self._handlers.get(attr_handle)
+        if characteristic is not None and characteristic.writeCallback is not None:
+            return characteristic.writeCallback
+        return self.writeCallback
+    
+    # Grow the writable characteristics' buffers to hold the largest value any central can now write
+    def _resize_buffers(self):
+        payload = max(self._mtus.values()) - _ATT_HEADER
+        if payload <= self._buffer_payload:
+            return
+        
+        self._buffer_payload = payload
+        for handle, characteristic in self._handlers.items():
+            if characteristic.flags & _FLAGS_WRITABLE and payload > characteristic.size:
+                self._ble.gatts_set_buffer(handle, payload)
+    
+    # Keep queued payloads small enough for every connected central
+    def _update_limit(self):
+        if self.sendQueue is not None:
+            self.sendQueue.limit = min(self.sendQueue.size, self.payloadSize())
+    
+    # Returns true if we've successfully connected a device
+    def isConnected(self):
+        return len(self._connections) > 0
+    
+    # Largest value that can be notified or indicated in one packet, for one central or for every connected central
+    def payloadSize(self, conn_handle=None):
+        if conn_handle is not None:
+            return self._mtus.get(conn_handle, _DEFAULT_MTU) - _ATT_HEADER
+        if not self._mtus:
+            return _DEFAULT_MTU - _ATT_HEADER
+        return min(self._mtus.values()) - _ATT_HEADER
+    
+    # Negotiated (interval us, peripheral latency, supervision timeout ms) of one central's connection,
+    # or of the first connected central. None until the stack has reported the parameters, which some
+    # stacks only do when the parameters change after connecting
+    def connectionParams(self, conn_handle=None):
+        if conn_handle is not None:
+            return self._params.get(conn_handle)
+        for params in self._params.values():
+            return params
+        return None
+    
+    # Copy writes from centrals into a preallocated ring buffer instead of calling writeCallback
+    # inside the interrupt handler. writeCallback is then called with a memoryview of each value,
+    # either from a micropython.schedule callback (scheduled=True) or from poll() in the main loop.
+    # The memoryview of each slot and length is kept for the next value of that length, so draining doesn't allocate.
+    def bufferWrites(self, slots=8, size=64, scheduled=True):
+        from .ringbuffer import RingBuffer
+        self.writeBuffer = RingBuffer(slots, size, sized=True)
+        self._schedule_writes = scheduled
+    
+    # Serve read requests from the value already in the characteristic instead of calling readCallback
+    # each time. readCallback is only called when the value is missing, has been invalidated, or is
+    # older than max_age_ms (None never goes stale). Publish new values with setValue from the main loop.
+    def cacheReads(self, max_age_ms=None):
+        self._cache_reads = True
+        self._max_age_ms = max_age_ms
+    
+    # Write the value of the first characteristic, or the one given, ready for centrals to read
+    # without notifying them. With cacheReads, the value is served to reads until it goes stale.
+    def setValue(self, value, characteristic=None):
+        handle = self._handle if characteristic is None else characteristic.handle
+        self._ble.gatts_write(handle, value)
+        self._written_ms[handle] = ticks_ms()
+    
+    # Mark the value of the first characteristic, or the one given, as stale so the next read calls readCallback
+    def invalidate(self, characteristic=None):
+        self._written_ms.pop(self._handle if characteristic is None else characteristic.handle, None)
+    
+    # Call callback(event, data) for each IRQ event with the number given, after the library has handled it.
+    # Event numbers are the ones the MicroPython bluetooth module uses, and any number of callbacks can be
+    # added for an event. Callbacks run inside the interrupt handler, so copy any data they need to keep.
+    def addEventCallback(self, event, callback):
+        callbacks = self._event_callbacks[event]
+        self._event_callbacks[event] = (callback,) if callbacks is None else callbacks + (callback,)
+        self._set_irq()
+    
+    # Stop calling a callback added with addEventCallback for the event number given
+    def removeEventCallback(self, event, callback):
+        callbacks = tuple(c for c in self._event_callbacks[event] or () if c != callback)
+        self._event_callbacks[event] = callbacks or None
+        self._set_irq()
+    
+    # Count each IRQ event and the time spent handling it and in callbacks, time indications until
+    # they are acknowledged, and track connection uptime, see BLEStats. Returns the BLEStats.
+    def collectStats(self):
+        from .stats import BLEStats
+        self.stats = BLEStats()
+        if self._connections:
+            self.stats.connected()
+        self._set_irq()
+        return self.stats
+    
+    # Record the last records events in a ring of preallocated records, each with up to payload bytes
+    # of the event's data, see TraceRecorder. Returns the TraceRecorder.
+    def traceEvents(self, records=64, payload=37):
+        from .trace import TraceRecorder
+        self.tracer = TraceRecorder(records, payload)
+        self._set_irq()
+        return self.tracer
+    
+    # Answer clock sync requests written by centrals that call syncClock, so they share our clock and each side
+    # can measure the one-way latency of the other's frames, see ClockSync. Returns the ClockSync.
+    def syncClock(self):
+        from .clock import ClockSync
+        self.clock = ClockSync(reference=True)
+        return self.clock
+    
+    # Send notify and indicate of the first characteristic to each central on its own, from a table of up to
+    # max_peers centrals. Only centrals subscribed through the characteristic's CCCD are sent to, and a
+    # central that hasn't written the CCCD counts as subscribed unless require_subscribe is true.
+    # If the stack is full for one central, or it hasn't acknowledged the last indication, the others are
+    # still sent to and it is sent the characteristic's latest value from poll(). Returns the PeerTable.
+    def broadcast(self, max_peers=4, require_subscribe=False):
+        self.peers = PeerTable(max_peers, 0 if require_subscribe else SUBSCRIBE_NOTIFY | SUBSCRIBE_INDICATE)
+        for conn_handle in tuple(self._connections):
+            self.peers.add(conn_handle)
+        self._cccd = self._handle + 1
+        return self.peers
+    
+    # Accept an L2CAP channel from a central on psm, receiving SDUs of up to mtu bytes, for streaming
+    # bulk data alongside the characteristic. Returns the L2CAPChannel, which opens when a central connects
+    # to it. Raises OSError(EOPNOTSUPP) if this MicroPython build has no L2CAP channels
+    def openStream(self, psm=L2CAP_PSM, mtu=L2CAP_MTU):
+        if not hasattr(self._ble, "l2cap_listen"):
+            raise OSError(EOPNOTSUPP)
+        from .l2cap import L2CAPChannel
+        self.stream = L2CAPChannel(self._ble, psm, mtu)
+        for event in range(_IRQ_L2CAP_ACCEPT, _IRQ_L2CAP_SEND_READY + 1):
+            self._events[event] = self.stream._irq
+        self._ble.l2cap_listen(psm, mtu)
+        return self.stream
+    
+    # Queue notify and indicate values and send them together on flush, at most once per interval_ms.
+    # Set interval_ms to the connection interval so one payload goes out per connection event.
+    # QUEUE_LATEST only sends the newest value, QUEUE_PACK packs values into a payload of up to size bytes.
+    # By default size is the largest payload our MTU allows, and payloads are kept to payloadSize().
+    def queueSends(self, mode=QUEUE_LATEST, size=None, interval_ms=30):
+        self.sendQueue = SendQueue(mode, size if size is not None else self._preferred_mtu - _ATT_HEADER, interval_ms)
+        self._update_limit()
+    
+    # Call regularly from the main loop to run buffered writeCallbacks and send queued values
+    def poll(self):
+        self._drain_writes()
+        
+        queue = self.sendQueue
+        if queue is not None and ticks_diff(ticks_ms(), self._last_flush) >= queue.interval_ms:
+            self.flush()
+        
+        if self.peers is not None:
+            self._catch_up()
+    
+    # Send the queued notify and indicate values now
+    def flush(self):
+        queue = self.sendQueue
+        if queue is None:
+            return
+        
+        self._last_flush = ticks_ms()
+        
+        if queue.pending():
+            queue.clear(sent=self._send(queue.payload(), False))
+        
+        # An indication waits until every central has acknowledged the previous one,
+        # unless each central is sent to on its own
+        if queue.pending(True) and (self.peers is not None or not self._indicating):
+            queue.clear(True, self._send(queue.payload(True), True))
+    
+    # Write the value and notify or indicate every connected central
+    # Returns true if at least one central was sent the value
+    def _send(self, value, indicate):
+        self._ble.gatts_write(self._handle, value)
+        if self.peers is not None:
+            return self._broadcast(SUBSCRIBE_INDICATE if indicate else SUBSCRIBE_NOTIFY)
+        sent = False
+        
+        # A copy, as the interrupt handler can add or remove connections while sending
+        for conn_handle in tuple(self._connections):
+            try:
+                if indicate:
+                    self._ble.gatts_indicate(conn_handle, self._handle)
+                    self._indicating.add(conn_handle)
+                    if self.stats is not None:
+                        self.stats.start(_LATENCY_INDICATE)
+                else:
+                    self._ble.gatts_notify(conn_handle, self._handle)
+                sent = True
+            except OSError:
+                # The stack has no room for this packet
+                pass
+        
+        return sent
+    
+    # Notify or indicate the first characteristic's value to every subscribed central in the peer table.
+    # A central the stack has no room for is owed the send, the rest are still sent to.
+    # Returns true if at least one central was sent the value
+    def _broadcast(self, kind):
+        peers = self.peers
+        sent = False
+        
+        for i in range(peers.capacity):
+            conn_handle = peers.handles[i]
+            if conn_handle == _NO_PEER or not peers.subscriptions[i] & kind:
+                continue
+            if self._send_peer(i, conn_handle, kind):
+                sent = True
+            else:
+                peers.behind[i] |= kind
+                peers.deferred[i] += 1
+        
+        return sent
+    
+    # Notify or indicate one central, returns false if it has to wait
+    def _send_peer(self, i, conn_handle, kind):
+        peers = self.peers
+        if kind == SUBSCRIBE_INDICATE and peers.indicating[i]:
+            # Waiting for the last indication to be acknowledged
+            return False
+        
+        try:
+            if kind == SUBSCRIBE_INDICATE:
+                self._ble.gatts_indicate(conn_handle, self._handle)
+                peers.indicating[i] = 1
+                if self.stats is not None:
+                    self.stats.start(_LATENCY_INDICATE)
+            else:
+                self._ble.gatts_notify(conn_handle, self._handle)
+        except OSError:
+            # The stack has no room for this central's packet
+            return False
+        
+        peers.behind[i] &= ~kind
+        peers.sent[i] += 1
+        return True
+    
+    # Send centrals that fell behind the characteristic's latest value
+    def _catch_up(self):
+        peers = self.peers
+        for i in range(peers.capacity):
+            behind = peers.behind[i]
+            if not behind:
+                continue
+            conn_handle = peers.handles[i]
+            if conn_handle == _NO_PEER:
+                continue
+            if behind & SUBSCRIBE_NOTIFY:
+                self._send_peer(i, conn_handle, SUBSCRIBE_NOTIFY)
+            if behind & SUBSCRIBE_INDICATE:
+                self._send_peer(i, conn_handle, SUBSCRIBE_INDICATE)
+    
+    # Pass every buffered write to writeCallback, oldest first
+    # Without a writeCallback the values stay in writeBuffer to be read directly
+    def _drain_writes(self):
+        self._drain_pending = False
+        buffer = self.writeBuffer
+        
+        if buffer is None:
+            return
+        
+        i = buffer.peek()
+        while i >= 0:
+            callback = self._write_callback(buffer.handles[i])
+            if callback is None:
+                return
+            # The memoryview is only valid until the slot is released
+            self._callback(callback, buffer.value(i))
+            buffer.pop()
+            i = buffer.peek()
+    
+    # micropython.schedule target for draining the write buffer
+    def _drain(self, _):
+        self._drain_writes()
+    
+    # Notify centrals of new characteristic value, of the first characteristic or the one given.
+    # Returns the number of centrals notified, 0 if the stack had no room for any of them, None if no central
+    # is connected, or False when the value was left to the send queue or the peer table, which can replace it with a newer one
+    def notify(self, value, characteristic=None):
+        handle = self._handle if characteristic is None else characteristic.handle
+        
+        if self.sendQueue is not None and handle == self._handle:
+            # Sent on the next flush
+            self.sendQueue.add(value)
+            return False
+        
+        # Write the value, ready for a central to read
+        self._ble.gatts_write(handle, value)
+        
+        if self.peers is not None and handle == self._handle:
+            self._broadcast(SUBSCRIBE_NOTIFY)
+            return False
+        
+        return self._send_all(handle, False)
+    
+    # Indicate to centrals of new characteristic value, of the first characteristic or the one given.
+    # Returns the same as notify
+    def indicate(self, value, characteristic=None):
+        handle = self._handle if characteristic is None else characteristic.handle
+        
+        if self.sendQueue is not None and handle == self._handle:
+            # Sent on the next flush once the previous indication is acknowledged
+            self.sendQueue.add(value, True)
+            return False
+        
+        # Write the value, ready for a central to read
+        self._ble.gatts_write(handle, value)
+        
+        if self.peers is not None and handle == self._handle:
+            self._broadcast(SUBSCRIBE_INDICATE)
+            return False
+        
+        return self._send_all(handle, True)
+    
+    # Notify or indicate handle to every connected central, going on to the rest when the stack
+    # has no room for one. Returns the number sent to, or None if no central is connected
+    def _send_all(self, handle, indicate):
+        # A copy, as the interrupt handler can add or remove connections while sending
+        connections = tuple(self._connections)
+        if not connections:
+            return None
+        sent = 0
+        
+        for conn_handle in connections:
+            try:
+                if indicate:
+                    # Receive acknowledgement from central
+                    self._ble.gatts_indicate(conn_handle, handle)
+                    if self.stats is not None:
+                        self.stats.start(_LATENCY_INDICATE)
+                else:
+                    # No acknowledgement from central
+                    self._ble.gatts_notify(conn_handle, handle)
+                sent += 1
+            except OSError:
+                # The stack has no room for this central's packet
+                pass
+        
+        return sent
@@ -0,0 +1,80 @@
+'''
+This code was written and modified by Kitronik Ltd.
+
+Preallocated ring buffer, used for buffered writes on the peripheral and
+pipelined writes on the central.
+'''
+
+from array import array
+
+'''
+Preallocated Ring Buffer
+'''
+
+# Fixed number of fixed-size bytearray slots that are filled inside the BLE interrupt handler
+# without allocating, and emptied later from the main loop or a scheduled callback.
+# Only the interrupt handler moves the head and only the reader moves the tail, so no locking is needed.
+class RingBuffer:
+    # With sized=True, value() keeps the memoryview it makes for each slot and length and hands back the
+    # same one the next time, so reading values doesn't allocate once each length has been seen.
+    def __init__(self, slots=8, size=64, sized=False):
+        self.size = size
+        self._slots = [bytearray(size) for _ in range(slots)]
+        self._views = [memoryview(slot) for slot in self._slots]
+        self._sized = [[None] * (size + 1) for _ in range(slots)] if sized else None
+        self._count = slots
+        # Head and tail run over twice the slot count so a full buffer can be told apart from an empty one
+        self._wrap = 2 * slots
+        self._head = 0
+        self._tail = 0
+        self.lengths = array("H", [0] * slots)
+        self.conns = array("H", [0] * slots)
+        self.handles = array("H", [0] * slots)
+        # Values dropped because every slot was full, and values cut down to the slot size
+        self.overflows = 0
+        self.truncated = 0
+
+    def __len__(self):
+        return (self._head - self._tail) % self._wrap
+
+    # Copy data into the next free slot, returns the slot index or -1 when the buffer is full
+    def put(self, conn_handle, attr_handle, data):
+        if len(self) == self._count:
+            self.overflows += 1
+            return -1
+        
+        i = self._head % self._count
+        n = len(data)
+        if n > self.size:
+            n = self.size
+            self.truncated += 1
+            data = memoryview(data)[:n]
+        
+        self._slots[i][:n] = data
+        self.lengths[i] = n
+        self.conns[i] = conn_handle
+        self.handles[i] = attr_handle
+        self._head = (self._head + 1) % self._wrap
+        return i
+
+    # Index of the oldest filled slot, or -1 when the buffer is empty
+    def peek(self):
+        if self._head == self._tail:
+            return -1
+        return self._tail % self._count
+
+    # Memoryview of the data held in slot i, only valid until that slot is popped
+    def value(self, i):
+        n = self.lengths[i]
+        if self._sized is None:
+            return self._views[i][:n]
+        view = self._sized[i][n]
+        if view is None:
+            view = self._views[i][:n]
+            self._sized[i][n] = view
+        return view
+
+    # Release the oldest slot so it can be filled again
+    def pop(self):
+        if self._head != self._tail:
+            self._tail = (self._tail + 1) % self._wrap
@@ -0,0 +1,93 @@
+'''
+This code was written and modified by Kitronik Ltd.
+
+Table of the devices heard during a scan, used by the central's SCAN_BEST
+and SCAN_RANKED modes and by the central with multiple peripherals.
+'''
+
+from array import array
+from time import ticks_ms, ticks_diff
+from .adv import decode_name
+
+# Bounded table of devices found by a scan, with one preallocated row per device.
+# Repeat advertisements from a device only update its row, so they don't allocate.
+# When the table is full the least recently heard device is replaced.
+class ScanTable:
+    def __init__(self, capacity=8):
+        self.capacity = capacity
+        self.count = 0
+        self.evictions = 0
+        self._addrs = bytearray(6 * capacity)
+        self.addr_types = bytearray(capacity)
+        # Smoothed RSSI, number of advertisements heard and when the last one was heard
+        self.rssi = array("h", [0] * capacity)
+        self.seen = array("H", [0] * capacity)
+        self.last_ms = array("L", [0] * capacity)
+        self.names = [None] * capacity
+
+    # Forget every device
+    def clear(self):
+        self.count = 0
+        self.evictions = 0
+
+    # Row holding addr, or -1 if the device isn't in the table
+    def find(self, addr):
+        addrs = self._addrs
+        for i in range(self.count):
+            j = 6 * i
+            k = 0
+            while k < 6 and addrs[j + k] == addr[k]:
+                k += 1
+            if k == 6:
+                return i
+        return -1
+
+    # Record an advertisement, returns the device's row
+    def update(self, addr_type, addr, rssi, adv_data):
+        now = ticks_ms()
+        i = self.find(addr)
+        
+        if i >= 0:
+            # Moving average over about four advertisements to smooth out fading, rounded to nearest
+            self.rssi[i] += (rssi - self.rssi[i] + 2) // 4
+            if self.seen[i] < 0xFFFF:
+                self.seen[i] += 1
+            self.last_ms[i] = now
+            return i
+        
+        if self.count < self.capacity:
+            i = self.count
+            self.count += 1
+        else:
+            # Replace the device heard from least recently
+            i = 0
+            for j in range(1, self.count):
+                if ticks_diff(self.last_ms[i], self.last_ms[j]) > 0:
+                    i = j
+            self.evictions += 1
+        
+        self._addrs[6 * i : 6 * i + 6] = addr
+        self.addr_types[i] = addr_type
+        self.rssi[i] = rssi
+        self.seen[i] = 1
+        self.last_ms[i] = now
+        self.names[i] = decode_name(adv_data) or "?"
+        return i
+
+    # Address of the device in row i
+    def addr(self, i):
+        return bytes(self._addrs[6 * i : 6 * i + 6])
+
+    # Row of the strongest device at or above min_rssi, or -1
+    def best(self, min_rssi=-127):
+        best = -1
+        for i in range(self.count):
+            if self.rssi[i] >= min_rssi and (best < 0 or self.rssi[i] > self.rssi[best]):
+                best = i
+        return best
+
+    # List of (addr_type, addr, name, rssi) for each device at or above min_rssi, strongest first
+    def ranked(self, min_rssi=-127):
+        devices = [(self.addr_types[i], self.addr(i), self.names[i], self.rssi[i]) for i in range(self.count) if self.rssi[i] >= min_rssi]
+        devices.sort(key=lambda device: device[3], reverse=True)
+        return devices
@@ -0,0 +1,159 @@
+'''
+This code was written and modified by Kitronik Ltd.
+
+Connection statistics for the peripheral and the central, imported by
+collectStats.
+'''
+
+from micropython import const
+from struct import pack
+from array import array
+from time import ticks_ms, ticks_diff
+
+'''
+Connection Statistics
+'''
+
+# Latencies timed by BLEStats
+LATENCY_INDICATE = const(0)  # Peripheral indicate until the central acknowledges it
+LATENCY_WRITE = const(1)     # Central write with response until _IRQ_GATTC_WRITE_DONE
+LATENCY_READ = const(2)      # Central read until _IRQ_GATTC_READ_RESULT
+
+# Upper bound in ms of each latency histogram bucket, the last bucket holds anything slower
+LATENCY_BUCKETS_MS = (2, 5, 10, 20, 50, 100, 200, 500, 1000)
+_LATENCY_KINDS = const(3)
+_IRQ_EVENTS = const(32)
+# Operations timed at once for each kind of latency, completions are matched oldest first
+_LATENCY_PENDING = const(8)
+# irq_us and callback_us wrap at 2**30 like ticks_us, so adding to them never needs a big int
+_US_WRAP = const(0x3FFFFFFF)
+
+# Header of BLEStats.pack: irq_us, callback_us, uptime_ms, connects, reconnects, disconnects.
+# It is followed by the 32 event counts as uint32, then the histograms as uint16, both little endian.
+STATS_FORMAT = "<IIIHHH"
+
+# Counts and timings kept by BLEPeripheral and BLECentral once collectStats is called.
+# Every counter and histogram is preallocated, so recording an event never allocates.
+class BLEStats:
+    def __init__(self):
+        # Count of each IRQ event, indexed by event number
+        self.events = array("I", [0] * _IRQ_EVENTS)
+        # Time spent in the interrupt handler (including the callbacks it runs), and in user callbacks.
+        # Both wrap to 0 after 2**30 us, take the time between two readings with ticks_diff
+        self.irq_us = 0
+        self.callback_us = 0
+        
+        # One row of len(LATENCY_BUCKETS_MS) + 1 buckets for each kind of latency
+        self._buckets = len(LATENCY_BUCKETS_MS) + 1
+        self.histograms = array("H", [0] * (_LATENCY_KINDS * self._buckets))
+        # Start times of the operations waiting to complete, a small ring for each kind
+        self._starts = array("I", [0] * (_LATENCY_KINDS * _LATENCY_PENDING))
+        self._heads = bytearray(_LATENCY_KINDS)
+        self._counts = bytearray(_LATENCY_KINDS)
+        
+        # Connections, and reconnections after the connection was lost
+        self.connects = 0
+        self.reconnects = 0
+        self.disconnects = 0
+        self._connected_ms = 0
+        self._uptime_ms = 0
+        self._up = False
+
+    # Clear every count, keeping the connection state
+    def reset(self):
+        for i in range(len(self.events)):
+            self.events[i] = 0
+        for i in range(len(self.histograms)):
+            self.histograms[i] = 0
+        self.irq_us = 0
+        self.callback_us = 0
+        self.connects = 0
+        self.reconnects = 0
+        self.disconnects = 0
+        self._uptime_ms = 0
+        self._connected_ms = ticks_ms()
+
+    # Record one IRQ event and the time spent handling it
+    def irq(self, event, us):
+        if event < _IRQ_EVENTS:
+            self.events[event] += 1
+        self.irq_us = (self.irq_us + us) & _US_WRAP
+    
+    # Record the time spent in one user callback
+    def callback(self, us):
+        self.callback_us = (self.callback_us + us) & _US_WRAP
+
+    # The first connection is up, or the last one has gone
+    def connected(self):
+        if self.disconnects:
+            self.reconnects += 1
+        self.connects += 1
+        self._connected_ms = ticks_ms()
+        self._up = True
+
+    def disconnected(self):
+        self.disconnects += 1
+        self._uptime_ms += ticks_diff(ticks_ms(), self._connected_ms)
+        self._up = False
+        # Nothing in progress will complete now
+        for kind in range(_LATENCY_KINDS):
+            self._counts[kind] = 0
+
+    # Total time spent connected in ms
+    def uptime(self):
+        if self._up:
+            return self._uptime_ms + ticks_diff(ticks_ms(), self._connected_ms)
+        return self._uptime_ms
+
+    # An operation of the kind given has started
+    def start(self, kind):
+        count = self._counts[kind]
+        if count == _LATENCY_PENDING:
+            # Too many in progress, don't time this one
+            return
+        i = (self._heads[kind] + count) % _LATENCY_PENDING
+        self._starts[kind * _LATENCY_PENDING + i] = ticks_ms()
+        self._counts[kind] = count + 1
+
+    # The oldest operation of the kind given has completed, add its latency to the histogram
+    def finish(self, kind):
+        if not self._counts[kind]:
+            return
+        head = self._heads[kind]
+        latency = ticks_diff(ticks_ms(), self._starts[kind * _LATENCY_PENDING + head])
+        self._heads[kind] = (head + 1) % _LATENCY_PENDING
+        self._counts[kind] -= 1
+        
+        bucket = 0
+        for bound in LATENCY_BUCKETS_MS:
+            if latency <= bound:
+                break
+            bucket += 1
+        i = kind * self._buckets + bucket
+        if self.histograms[i] < 0xFFFF:
+            self.histograms[i] += 1
+
+    # Memoryview of the histogram for one kind of latency
+    def histogram(self, kind):
+        return memoryview(self.histograms)[kind * self._buckets : (kind + 1) * self._buckets]
+
+    # Dictionary of every count, for printing or logging
+    def snapshot(self):
+        return {
+            "events": {event: self.events[event] for event in range(_IRQ_EVENTS) if self.events[event]},
+            "irq_us": self.irq_us,
+            "callback_us": self.callback_us,
+            "indicate_ms": list(self.histogram(LATENCY_INDICATE)),
+            "write_ms": list(self.histogram(LATENCY_WRITE)),
+            "read_ms": list(self.histogram(LATENCY_READ)),
+            "uptime_ms": self.uptime(),
+            "connects": self.connects,
+            "reconnects": self.reconnects,
+            "disconnects": self.disconnects,
+        }
+
+    # Pack every count into bytes, laid out as STATS_FORMAT, to send or save compactly
+    def pack(self):
+        header = pack(STATS_FORMAT, self.irq_us, self.callback_us, self.uptime() & 0xFFFFFFFF,
+                      self.connects & 0xFFFF, self.reconnects & 0xFFFF, self.disconnects & 0xFFFF)
+        return header + bytes(self.events) + bytes(self.histograms)
@@ -0,0 +1,107 @@
+'''
+This code was written and modified by Kitronik Ltd.
+
+Event trace recording for the peripheral and the central, imported by
+traceEvents.
+'''
+
+import bluetooth
+from micropython import const
+from struct import pack, pack_into, unpack_from
+from array import array
+from time import ticks_us
+
+'''
+Event Trace
+'''
+
+# Each trace record is a header then the payload bytes kept, little endian:
+#   ticks_us (uint32), event (uint8), payload bytes kept (uint8),
+#   the first 5 whole number fields of the event's data (uint16 each, 0 when there are fewer),
+#   total length of the event's byte fields (uint16)
+# For connection events the first two numbers are the conn_handle and the attribute or value handle.
+# The payload is the event's byte fields (addresses, values, advertising data, UUIDs) one after another,
+# then any value passed to record, such as the value written for _IRQ_GATTS_WRITE.
+TRACE_FORMAT = "<IBBHHHHHH"
+_TRACE_HEADER = const(18)
+_TRACE_INTS = const(5)
+# A dumped trace file starts with TRACE_FILE_FORMAT: the magic bytes, the number of records,
+# the payload bytes of each record and the events recorded in total, then the records oldest first
+TRACE_MAGIC = b"KBTR"
+TRACE_FILE_FORMAT = "<4sHHI"
+
+# Ring of the most recent records events, held in one preallocated buffer, so recording an event
+# from the interrupt handler doesn't allocate (apart from copying a UUID during discovery).
+# The default payload of 37 bytes holds a whole scan result, a 6 byte address and 31 bytes of advertising data.
+class TraceRecorder:
+    def __init__(self, records=64, payload=37):
+        self.records = records
+        self.payload = payload
+        self._size = _TRACE_HEADER + payload
+        self._buffer = bytearray(records * self._size)
+        self._ints = array("H", [0] * _TRACE_INTS)
+        self._next = 0
+        # Events recorded in total, the oldest are overwritten once there are more than records
+        self.count = 0
+        self.enabled = True
+    
+    # Record one event, with value (bytes that aren't in the event's data) after its byte fields
+    def record(self, event, data, value=None):
+        if not self.enabled:
+            return
+        
+        buffer = self._buffer
+        at = self._next * self._size
+        ints = self._ints
+        for i in range(_TRACE_INTS):
+            ints[i] = 0
+        count = 0
+        length = 0
+        kept = 0
+        p = at + _TRACE_HEADER
+        
+        for field in data if value is None else data + (value,):
+            if isinstance(field, int):
+                if count < _TRACE_INTS:
+                    ints[count] = field & 0xFFFF
+                    count += 1
+            elif field is not None:
+                if isinstance(field, bluetooth.UUID):
+                    field = bytes(field)
+                n = len(field)
+                length += n
+                k = min(n, self.payload - kept)
+                for i in range(k):
+                    buffer[p + kept + i] = field[i]
+                kept += k
+        
+        pack_into(TRACE_FORMAT, buffer, at, ticks_us() & 0xFFFFFFFF, event, kept, ints[0], ints[1], ints[2], ints[3], ints[4], length & 0xFFFF)
+        self._next = (self._next + 1) % self.records
+        self.count += 1
+    
+    # Number of records held
+    def __len__(self):
+        return min(self.count, self.records)
+    
+    # Forget every record
+    def clear(self):
+        self._next = 0
+        self.count = 0
+    
+    # Memoryview of the i-th oldest record held
+    def entry(self, i):
+        start = (self._next - len(self) + i) % self.records * self._size
+        return memoryview(self._buffer)[start : start + self._size]
+    
+    # Decode the i-th oldest record held as (ticks_us, event, numbers, length, payload)
+    def decode(self, i):
+        entry = self.entry(i)
+        fields = unpack_from(TRACE_FORMAT, entry)
+        return (fields[0], fields[1], fields[3:8], fields[8], bytes(entry[_TRACE_HEADER : _TRACE_HEADER + fields[2]]))
+    
+    # Write the records held to a file, oldest first, to read with Host Tools/trace.py
+    def dump(self, path):
+        with open(path, "wb") as f:
+            f.write(pack(TRACE_FILE_FORMAT, TRACE_MAGIC, len(self), self.payload, self.count & 0xFFFFFFFF))
+            for i in range(len(self)):
+                f.write(self.entry(i))
@@ -0,0 +1,239 @@
+'''
+This code was written and modified by Kitronik Ltd.
+
+asyncio front end for the KitronikPicoWBluetooth library.
+
+The wrappers install their own callbacks on the BLECentral or BLEPeripheral,
+and each completion sets an asyncio.ThreadSafeFlag from the BLE interrupt
+handler, so tasks wait for events instead of polling isConnected().
+'''
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+from errno import ENOTCONN
+from KitronikPicoWBluetooth import RingBuffer
+
+# Wait for a ThreadSafeFlag, raising asyncio.TimeoutError after timeout_ms (None waits forever)
+async def _wait(flag, timeout_ms):
+    if timeout_ms is None:
+        await flag.wait()
+    else:
+        await asyncio.wait_for_ms(flag.wait(), timeout_ms)
+
+# Async iterator over the values copied into a RingBuffer by an interrupt handler
+# Iteration stops once the owner has disconnected and every value has been read
+class _ValueStream:
+    def __init__(self, owner, buffer, flag):
+        self._owner = owner
+        self._buffer = buffer
+        self._flag = flag
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        buffer = self._buffer
+        while True:
+            i = buffer.peek()
+            if i >= 0:
+                value = bytes(buffer.value(i))
+                buffer.pop()
+                return value
+            if not self._owner.isConnected():
+                raise StopAsyncIteration
+            await self._flag.wait()
+
+'''
+Bluetooth Low Energy - Async Central Device
+'''
+
+class AsyncBLECentral:
+    # Wrap a BLECentral, keeping up to slots notified or indicated values of up to size bytes
+    def __init__(self, central, slots=8, size=64):
+        self.central = central
+        # One operation at a time, each completion sets _done
+        self._lock = asyncio.Lock()
+        self._done = asyncio.ThreadSafeFlag()
+        self._result = None
+        self._status = 0
+
+        self._values = RingBuffer(slots, size)
+        self._value_flag = asyncio.ThreadSafeFlag()
+        central.disconnectCallback = self._on_disconnect
+
+    # Returns true if the central is connected and has discovered the characteristic
+    def isConnected(self):
+        return self.central.isConnected()
+
+    # Callbacks from the BLECentral interrupt handler
+    def _on_scan(self, *result):
+        # SCAN_RANKED passes one list, the other modes pass (addr_type, addr, name)
+        if len(result) == 1:
+            self._result = result[0]
+        else:
+            self._result = result if result[0] is not None else None
+        self._done.set()
+
+    def _on_connect(self):
+        # Install the data callbacks before anything can arrive
+        central = self.central
+        central.readCallback = self._on_read
+        central.readDoneCallback = self._on_status
+        central.writeDoneCallback = self._on_status
+        central.notifyCallback = self._on_value
+        central.indicateCallback = self._on_value
+        self._result = True
+        self._done.set()
+
+    def _on_disconnect(self):
+        self._status = ENOTCONN
+        self._done.set()
+        self._value_flag.set()
+
+    def _on_read(self, data):
+        self._result = bytes(data)
+
+    def _on_status(self, status):
+        self._status = status
+        self._done.set()
+
+    def _on_value(self, data):
+        self._values.put(0, 0, data)
+        self._value_flag.set()
+
+    # Start an operation, clearing anything left over from the last one
+    def _start(self):
+        self._done.clear()
+        self._result = None
+        self._status = 0
+
+    def _check_connected(self):
+        if not self.central.isConnected():
+            raise OSError(ENOTCONN)
+
+    # Scan for a peripheral, takes the same inputs as BLECentral.scan
+    # Returns (addr_type, addr, name), or None if nothing was found, or a list with SCAN_RANKED
+    async def scan(self, duration_ms=2000, **kwargs):
+        async with self._lock:
+            self._start()
+            self.central.scan(self._on_scan, duration_ms, **kwargs)
+            try:
+                await _wait(self._done, duration_ms + 1000)
+            except BaseException:
+                # Timed out or cancelled
+                self.central.stopScan()
+                raise
+            return self._result
+
+    # Connect to the device given, or the one found by the last scan, and discover its characteristic
+    # Raises OSError if the device couldn't be reached, or asyncio.TimeoutError after timeout_ms
+    async def connect(self, addr_type=None, addr=None, timeout_ms=5000):
+        async with self._lock:
+            self._start()
+            if not self.central.connect(addr_type, addr, self._on_connect):
+                raise ValueError("No device to connect to")
+            try:
+                await _wait(self._done, timeout_ms)
+            except BaseException:
+                self.central.disconnect()
+                raise
+            if self._status:
+                raise OSError(self._status)
+            return True
+
+    # Read the characteristic's value
+    async def read(self, timeout_ms=2000):
+        async with self._lock:
+            self._check_connected()
+            self._start()
+            self.central.read()
+            await _wait(self._done, timeout_ms)
+            if self._status:
+                raise OSError(self._status)
+            return self._result
+
+    # Write to the characteristic, with response=True this waits for the peripheral's acknowledgement
+    async def write(self, data, response=False, timeout_ms=2000):
+        async with self._lock:
+            self._check_connected()
+            if not response:
+                self.central.write(data)
+                return
+
+            self._start()
+            self.central.write(data, True)
+            await _wait(self._done, timeout_ms)
+            if self._status:
+                raise OSError(self._status)
+
+    # Disconnect from the peripheral
+    async def disconnect(self):
+        self.central.disconnect()
+
+    # Async iterator over notified and indicated values, ends when the peripheral disconnects
+    #   async for value in central.notifications():
+    def notifications(self):
+        return _ValueStream(self.central, self._values, self._value_flag)
+
+'''
+Bluetooth Low Energy - Async Peripheral Device
+'''
+
+class AsyncBLEPeripheral:
+    # Wrap a BLEPeripheral, keeping up to slots written values of up to size bytes
+    def __init__(self, peripheral, slots=8, size=64):
+        self.peripheral = peripheral
+        self._connect_flag = asyncio.ThreadSafeFlag()
+        self._values = RingBuffer(slots, size)
+        self._value_flag = asyncio.ThreadSafeFlag()
+        peripheral.connectCallback = self._on_connect
+        peripheral.disconnectCallback = self._on_disconnect
+        peripheral.writeCallback = self._on_write
+
+    # Returns true if a central is connected
+    def isConnected(self):
+        return self.peripheral.isConnected()
+
+    # Callbacks from the BLEPeripheral interrupt handler
+    def _on_connect(self, conn_handle):
+        self._connect_flag.set()
+
+    def _on_disconnect(self, conn_handle):
+        self._connect_flag.set()
+        self._value_flag.set()
+
+    def _on_write(self, value):
+        self._values.put(0, 0, value)
+        self._value_flag.set()
+
+    # Wait until a central connects, raises asyncio.TimeoutError after timeout_ms (None waits forever)
+    async def connected(self, timeout_ms=None):
+        while True:
+            # Clear before checking, so a connection in between still wakes us
+            self._connect_flag.clear()
+            if self.peripheral.isConnected():
+                return
+            await _wait(self._connect_flag, timeout_ms)
+
+    # Wait until every central has disconnected
+    async def disconnected(self, timeout_ms=None):
+        while True:
+            self._connect_flag.clear()
+            if not self.peripheral.isConnected():
+                return
+            await _wait(self._connect_flag, timeout_ms)
+
+    # Notify and indicate connected centrals, as BLEPeripheral.notify and indicate
+    def notify(self, value):
+        return self.peripheral.notify(value)
+
+    def indicate(self, value):
+        return self.peripheral.indicate(value)
+
+    # Async iterator over values written by centrals, ends when the last central disconnects
+    #   async for value in peripheral.writes():
+    def writes(self):
+        return _ValueStream(self.peripheral, self._values, self._value_flag)
@@ -0,0 +1,249 @@
+'''
+This code was written and modified by Kitronik Ltd.
+
+Compact binary messages for the KitronikPicoWBluetooth library.
+
+A Schema lists the fields of one type of message, such as a controller's
+position and buttons, and each field is a whole number of 1, 2 or 4 bytes.
+Every message starts with a 1 byte type, so one characteristic can carry
+several kinds of message:
+    full message:  type, then every field in order
+    delta message: type | DELTA, a bitmask of the fields included (1 bit per
+                   field, least significant bit first), then only those fields
+Values are kept in lists created once, and messages are packed into and read
+from buffers the caller owns, so sending and receiving doesn't allocate.
+'''
+
+from micropython import const
+from struct import pack_into, calcsize
+
+# Set in the type byte of a delta message
+DELTA = const(0x80)
+_TYPE_MASK = const(0x7F)
+# Masks are kept to small ints so comparing them doesn't allocate
+_MAX_FIELDS = const(30)
+
+# Field formats, as for the struct module, and whether each is signed
+_SIGNED = {"b": True, "B": False, "h": True, "H": False, "i": True, "I": False}
+
+# Type of a message, with the DELTA flag removed
+def message_type(data):
+    return data[0] & _TYPE_MASK
+
+# Read a little endian whole number of size bytes without creating a tuple as unpack_from does
+def _read(data, offset, size, signed):
+    value = data[offset]
+    if size > 1:
+        value |= data[offset + 1] << 8
+    if size > 2:
+        value |= (data[offset + 2] << 16) | (data[offset + 3] << 24)
+    if signed and value >= 1 << (size * 8 - 1):
+        value -= 1 << (size * 8)
+    return value
+
+'''
+Schema
+'''
+
+# The fields of one type of message, a list of (name, format) where format is one of
+# "b", "B", "h", "H", "i" or "I". msg_type is 0 to 127, and a schema with no fields
+# makes a 1 byte message, such as a start command.
+class Schema:
+    def __init__(self, msg_type, fields):
+        if not 0 <= msg_type <= _TYPE_MASK:
+            raise ValueError("Message type must be 0 to 127")
+        if len(fields) > _MAX_FIELDS:
+            raise ValueError("Too many fields")
+
+        self.type = msg_type
+        self.names = tuple(name for name, _ in fields)
+        # Precompiled struct format of a full message, and of each field on its own
+        self.format = "<B" + "".join(fmt for _, fmt in fields)
+        self._formats = tuple("<" + fmt for _, fmt in fields)
+        self._sizes = bytearray(len(fields))
+        self._signed = bytearray(len(fields))
+        for i, (name, fmt) in enumerate(fields):
+            if fmt not in _SIGNED:
+                raise ValueError("Unsupported field format " + fmt)
+            self._sizes[i] = calcsize(fmt)
+            self._signed[i] = _SIGNED[fmt]
+
+        self.size = calcsize(self.format)
+        self._mask_size = (len(fields) + 7) // 8
+        # A delta message with every field is the biggest message
+        self.maxSize = self.size + self._mask_size
+
+    # Position of a field in the values list
+    def index(self, name):
+        return self.names.index(name)
+
+    # New list of values for this schema, all 0
+    def values(self):
+        return [0] * len(self.names)
+
+    # Pack a full message of values into buffer at offset, returns its length
+    def pack(self, buffer, values, offset=0):
+        buffer[offset] = self.type
+        at = offset + 1
+        for i in range(len(self._sizes)):
+            pack_into(self._formats[i], buffer, at, values[i])
+            at += self._sizes[i]
+        return at - offset
+
+    # Pack a delta message of only the values that differ from previous, returns its length,
+    # or 0 if nothing has changed
+    def packDelta(self, buffer, values, previous, offset=0):
+        mask = 0
+        at = offset + 1 + self._mask_size
+        for i in range(len(self._sizes)):
+            if values[i] != previous[i]:
+                mask |= 1 << i
+                pack_into(self._formats[i], buffer, at, values[i])
+                at += self._sizes[i]
+
+        if not mask:
+            return 0
+        buffer[offset] = self.type | DELTA
+        for i in range(self._mask_size):
+            buffer[offset + 1 + i] = (mask >> (i * 8)) & 0xFF
+        return at - offset
+
+    # Read a full or delta message into values, returns a bitmask of the fields it held.
+    # Raises ValueError if the message is for another schema or is too short
+    def unpack(self, data, values, offset=0):
+        if data[offset] & _TYPE_MASK != self.type:
+            raise ValueError("Wrong message type")
+
+        sizes = self._sizes
+        count = len(sizes)
+        if data[offset] & DELTA:
+            if len(data) < offset + 1 + self._mask_size:
+                raise ValueError("Message too short")
+            mask = 0
+            for i in range(self._mask_size):
+                mask |= data[offset + 1 + i] << (i * 8)
+            at = offset + 1 + self._mask_size
+        else:
+            mask = (1 << count) - 1
+            at = offset + 1
+
+        # Check the length before changing anything, so a bad message leaves values as they were
+        end = at
+        for i in range(count):
+            if mask & (1 << i):
+                end += sizes[i]
+        if len(data) < end:
+            raise ValueError("Message too short")
+
+        for i in range(count):
+            if mask & (1 << i):
+                values[i] = _read(data, at, sizes[i], self._signed[i])
+                at += sizes[i]
+        return mask
+
+'''
+Sending
+'''
+
+# Sends the values of a schema with send(message), which can be BLEPeripheral.notify or BLECentral.write.
+# Each message only has the fields that changed since the last message sent, and every full_every
+# messages (or never with 0) a full message is sent so a receiver that missed one catches up.
+# A message only counts as sent when send returns a number above 0 or True. The peripheral's queueSends and
+# broadcast modes (notify returns False) can replace a message with a newer one, so their messages aren't
+# counted and each update sends every change since the last message that was.
+class DeltaSender:
+    def __init__(self, schema, send, full_every=0):
+        self.schema = schema
+        self._send = send
+        self.full_every = full_every
+        # Set these, by index or with set(), then call update()
+        self.values = schema.values()
+        self._sent = schema.values()
+        self._buffer = bytearray(schema.maxSize)
+        self._view = memoryview(self._buffer)
+        self._count = 0
+        self._full = True
+        self.messages = 0
+        self.bytes = 0
+
+    # Set a field's value by name
+    def set(self, name, value):
+        self.values[self.schema.index(name)] = value
+
+    # Send a full message next, such as when a new central connects
+    def reset(self):
+        self._full = True
+
+    # Send the fields that have changed, returns false if the message wasn't sent (send raised OSError,
+    # or returned False, 0 or None because the stack or pipeline was full or nothing was connected),
+    # in which case the same changes are sent by the next update
+    def update(self):
+        schema = self.schema
+        if self._full or (self.full_every and self._count >= self.full_every):
+            n = schema.pack(self._buffer, self.values)
+            full = True
+        else:
+            n = schema.packDelta(self._buffer, self.values, self._sent)
+            full = False
+            if n == 0:
+                return True
+
+        try:
+            result = self._send(self._view[:n])
+        except OSError:
+            return False
+        if not result:
+            return False
+
+        sent = self._sent
+        values = self.values
+        for i in range(len(values)):
+            sent[i] = values[i]
+        self._full = False
+        self._count = 0 if full else self._count + 1
+        self.messages += 1
+        self.bytes += n
+        return True
+
+'''
+Receiving
+'''
+
+# Passes each message given to feed(), which can be BLECentral.notifyCallback or BLEPeripheral.writeCallback,
+# to the schema for its type. Each schema keeps a values list that its messages update, and its callback
+# is called with (values, mask), where mask has a bit set for each field in the message.
+class Dispatcher:
+    def __init__(self):
+        self._handlers = {}
+        self.unknown = 0
+        self.errors = 0
+
+    # Handle messages for schema with callback, returns the values list that they update
+    def add(self, schema, callback=None):
+        values = schema.values()
+        self._handlers[schema.type] = (schema, values, callback)
+        return values
+
+    # Values list for a message type
+    def values(self, msg_type):
+        return self._handlers[msg_type][1]
+
+    # Handle one received message
+    def feed(self, data):
+        if not len(data):
+            return
+
+        handler = self._handlers.get(data[0] & _TYPE_MASK)
+        if handler is None:
+            self.unknown += 1
+            return
+
+        schema, values, callback = handler
+        try:
+            mask = schema.unpack(data, values)
+        except ValueError:
+            self.errors += 1
+            return
+
+        if callback is not None:
+            callback(values, mask)
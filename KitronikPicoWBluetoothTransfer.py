@@ -0,0 +1,248 @@
+'''
+This code was written and modified by Kitronik Ltd.
+
+Large payload transfer for the KitronikPicoWBluetooth library.
+
+A payload bigger than one packet is split into chunks, each sent with
+BLEPeripheral.notify or BLECentral.write. Every chunk starts with a 2 byte
+header, and the first chunk also carries the total length and a CRC:
+    1 byte sequence number, counting up from 0 and wrapping at 255
+    1 byte flags, FIRST and/or LAST
+    first chunk only: 2 bytes total length, 2 bytes CRC-16/CCITT of the payload
+The receiver copies each chunk into a buffer created once at the maximum size.
+'''
+
+from micropython import const
+from struct import pack_into, unpack_from
+from time import ticks_ms, ticks_diff
+from array import array
+from errno import EOPNOTSUPP, ENOTCONN
+
+_FLAG_FIRST = const(0x01)
+_FLAG_LAST = const(0x02)
+_HEADER_SIZE = const(2)
+_FIRST_HEADER_SIZE = const(6)
+
+# Lookup table for CRC-16/CCITT, one entry for each byte value
+def _crc_table():
+    table = array("H", [0] * 256)
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+        table[i] = crc
+    return table
+
+_CRC_TABLE = _crc_table()
+
+# CRC-16/CCITT-FALSE over data, continuing from crc
+def crc16(data, crc=0xFFFF):
+    table = _CRC_TABLE
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ byte]
+    return crc
+
+# Throughput statistics for a sender or receiver
+class TransferStats:
+    def __init__(self):
+        self.transfers = 0
+        self.bytes = 0
+        self.chunks = 0
+        self.errors = 0
+        # Time taken by the last complete transfer
+        self.last_ms = 0
+        self.last_bytes = 0
+
+    # Bytes per second of the last complete transfer
+    def throughput(self):
+        if self.last_ms <= 0:
+            return 0
+        return self.last_bytes * 1000 // self.last_ms
+
+    def _done(self, size, start_ms):
+        self.transfers += 1
+        self.bytes += size
+        self.last_bytes = size
+        self.last_ms = ticks_diff(ticks_ms(), start_ms)
+
+'''
+Sending
+'''
+
+# Sends payloads in chunks using send(chunk), which can be BLEPeripheral.notify or BLECentral.write.
+# chunk_size is the most bytes sent at once (the ATT payload size, MTU - 3), or a function returning it.
+# Every chunk has to arrive, so the peripheral's queueSends and broadcast modes, which can replace a value
+# with a newer one, can't be used: notify returns False in those modes and pump raises OSError(EOPNOTSUPP).
+# The central's pipelineWrites keeps every write in order, so a full pipeline (write returns 0) is retried
+# like a full stack, as long as its slots are at least chunk_size bytes. If nothing is connected (send
+# returns None) pump gives up on the payload and raises OSError(ENOTCONN).
+# The peripheral sends to one central: notify goes on to the other centrals when the stack is full for one,
+# so with more than one connected, a chunk counts as sent once any central has it and the others can miss it.
+class FrameSender:
+    def __init__(self, send, chunk_size=20):
+        self._send = send
+        self._chunk_size = chunk_size
+        self._chunk = bytearray(chunk_size if isinstance(chunk_size, int) else 20)
+        self._data = None
+        self._crc = 0
+        self._offset = 0
+        self._seq = 0
+        self._start_ms = 0
+        self.stats = TransferStats()
+
+    def _size(self):
+        size = self._chunk_size
+        return size() if callable(size) else size
+
+    # Returns true while a payload is still being sent
+    def busy(self):
+        return self._data is not None
+
+    # Start sending a payload of up to 65535 bytes, call pump() until it returns true
+    def start(self, data):
+        if len(data) > 0xFFFF:
+            raise ValueError("Payload too large")
+        if self._size() <= _FIRST_HEADER_SIZE:
+            raise ValueError("Chunk size too small")
+        
+        self._data = memoryview(data)
+        self._crc = crc16(self._data)
+        self._offset = 0
+        self._start_ms = ticks_ms()
+
+    # Send up to max_chunks chunks, stopping early if the stack has no room (OSError or 0 from send)
+    # Returns true once the whole payload has been sent
+    def pump(self, max_chunks=4):
+        data = self._data
+        if data is None:
+            return True
+        
+        size = self._size()
+        if len(self._chunk) < size:
+            self._chunk = bytearray(size)
+        
+        for _ in range(max_chunks):
+            first = self._offset == 0
+            header = _FIRST_HEADER_SIZE if first else _HEADER_SIZE
+            n = min(size - header, len(data) - self._offset)
+            last = self._offset + n == len(data)
+            
+            chunk = self._chunk
+            chunk[0] = self._seq
+            chunk[1] = (_FLAG_FIRST if first else 0) | (_FLAG_LAST if last else 0)
+            if first:
+                pack_into("<HH", chunk, 2, len(data), self._crc)
+            chunk[header : header + n] = data[self._offset : self._offset + n]
+            
+            try:
+                sent = self._send(memoryview(chunk)[: header + n])
+            except OSError:
+                # Try this chunk again on the next pump
+                return False
+            
+            if sent is False or sent is None:
+                # Left to a send queue or peer table, which could drop chunks, or nothing is connected,
+                # so give up on the payload
+                self._data = None
+                self.stats.errors += 1
+                raise OSError(EOPNOTSUPP if sent is False else ENOTCONN)
+            if sent == 0:
+                # The stack is full for every central, or the write pipeline is full,
+                # try this chunk again on the next pump
+                return False
+            
+            self.stats.chunks += 1
+            self._seq = (self._seq + 1) & 0xFF
+            self._offset += n
+            
+            if last:
+                self._data = None
+                self.stats._done(len(data), self._start_ms)
+                return True
+        return False
+
+    # Send a whole payload, calling wait() (such as a short sleep) whenever the stack is full
+    def send(self, data, wait=None):
+        self.start(data)
+        while not self.pump():
+            if wait is not None:
+                wait()
+
+'''
+Receiving
+'''
+
+# Rebuilds payloads of up to max_size bytes from chunks passed to feed(), which can be used as
+# BLEPeripheral.writeCallback or BLECentral.notifyCallback. callback(payload) is called with a
+# memoryview of each complete payload whose CRC matches, only valid until the next payload starts.
+class FrameReceiver:
+    def __init__(self, callback, max_size=4096):
+        self.callback = callback
+        self._buffer = bytearray(max_size)
+        self._view = memoryview(self._buffer)
+        self._length = 0
+        self._offset = 0
+        self._crc = 0
+        self._seq = 0
+        self._active = False
+        self._start_ms = 0
+        self.stats = TransferStats()
+
+    # Handle one received chunk
+    def feed(self, chunk):
+        if len(chunk) < _HEADER_SIZE:
+            return
+        
+        seq = chunk[0]
+        flags = chunk[1]
+        
+        if flags & _FLAG_FIRST:
+            if len(chunk) < _FIRST_HEADER_SIZE:
+                return
+            self._length, self._crc = unpack_from("<HH", chunk, 2)
+            if self._length > len(self._buffer):
+                # Too big for our buffer, ignore the rest of this payload
+                self.stats.errors += 1
+                self._active = False
+                return
+            self._active = True
+            self._offset = 0
+            self._start_ms = ticks_ms()
+            header = _FIRST_HEADER_SIZE
+        
+        elif not self._active:
+            return
+        
+        elif seq != self._seq:
+            # A chunk went missing, drop the payload
+            self.stats.errors += 1
+            self._active = False
+            return
+        
+        else:
+            header = _HEADER_SIZE
+        
+        n = len(chunk) - header
+        if self._offset + n > self._length:
+            self.stats.errors += 1
+            self._active = False
+            return
+        
+        self._buffer[self._offset : self._offset + n] = chunk[header:]
+        self._offset += n
+        self._seq = (seq + 1) & 0xFF
+        self.stats.chunks += 1
+        
+        if flags & _FLAG_LAST:
+            self._active = False
+            payload = self._view[: self._length]
+            if self._offset != self._length or crc16(payload) != self._crc:
+                self.stats.errors += 1
+                return
+            
+            self.stats._done(self._length, self._start_ms)
+            if self.callback is not None:
+                self.callback(payload)
@@ -0,0 +1,10 @@
+# Freeze the library into a MicroPython build for the Pico W. Frozen modules are compiled to bytecode
+# that runs from flash, so importing them takes far less RAM and time than loading .py files:
+#   cd micropython/ports/rp2
+#   make BOARD=RPI_PICO_W FROZEN_MANIFEST=/path/to/this/manifest.py
+include("$(BOARD_DIR)/manifest.py")
+
+package("KitronikPicoWBluetooth")
+module("KitronikPicoWBluetoothAsync.py")
+module("KitronikPicoWBluetoothTransfer.py")
+module("KitronikPicoWBluetoothCodec.py")